@@ -0,0 +1,27 @@
+"""
+gunicorn settings: gunicorn payment_gateway.wsgi -c gunicorn.conf.py
+
+Each worker keeps its Prometheus samples in PROMETHEUS_MULTIPROC_DIR, so
+/metrics reports totals across all workers whichever one serves the scrape.
+"""
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'payment_gateway_metrics'))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be added to this one
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
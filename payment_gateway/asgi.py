@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'payment_gateway.settings')
+# Serve the PayPal-bound endpoints with the async views unless explicitly disabled
+os.environ.setdefault('PAYMENTS_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
+
+# Resume the verifications persisted before a restart without waiting for the next payment
+from payments.scheduler import get_verification_scheduler  # noqa: E402
+
+get_verification_scheduler().start()
@@ -48,7 +48,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Removed at startup unless PAYMENT_METRICS is on
+    'payments.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # Removed at startup unless PAYMENT_PROFILING is on
+    'payments.profiling.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -96,6 +100,16 @@ DATABASES = {
 
 
 
+# Cache
+# Point CACHE_BACKEND/CACHE_LOCATION at a shared cache (e.g. django.core.cache.backends.redis.RedisCache)
+# so cached reads and invalidations are consistent across worker processes
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='payment-gateway'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -141,22 +155,188 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # REST Framework settings
 REST_FRAMEWORK = {
+    # orjson-backed drop-ins for DRF's JSONRenderer and JSONParser
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'payments.renderers.ORJSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
-        'rest_framework.parsers.JSONParser',
+        'payments.renderers.ORJSONParser',
         'rest_framework.parsers.FormParser',
         'rest_framework.parsers.MultiPartParser',
     ],
     'EXCEPTION_HANDLER': 'rest_framework.views.exception_handler'
 }
 
+# Payment list pagination
+PAYMENT_LIST_PAGE_SIZE = config('PAYMENT_LIST_PAGE_SIZE', default=50, cast=int)
+PAYMENT_LIST_MAX_PAGE_SIZE = config('PAYMENT_LIST_MAX_PAGE_SIZE', default=200, cast=int)
+
+# Rows fetched per database round trip when streaming exports
+PAYMENT_EXPORT_CHUNK_SIZE = config('PAYMENT_EXPORT_CHUNK_SIZE', default=2000, cast=int)
+
+# Raw PayPal payloads (PaymentGatewayEvent) are zlib-compressed from this size up
+PAYMENT_GATEWAY_EVENT_COMPRESSION = config('PAYMENT_GATEWAY_EVENT_COMPRESSION', default=True, cast=bool)
+PAYMENT_GATEWAY_EVENT_COMPRESS_MIN_BYTES = config('PAYMENT_GATEWAY_EVENT_COMPRESS_MIN_BYTES', default=256, cast=int)
+PAYMENT_GATEWAY_EVENT_COMPRESSION_LEVEL = config('PAYMENT_GATEWAY_EVENT_COMPRESSION_LEVEL', default=6, cast=int)
+
+# Payment detail read cache
+PAYMENT_CACHE_ALIAS = config('PAYMENT_CACHE_ALIAS', default='default')
+# Completed, failed and refunded payments
+PAYMENT_CACHE_TERMINAL_TTL = config('PAYMENT_CACHE_TERMINAL_TTL', default=86400, cast=int)
+# Pending and processing payments
+PAYMENT_CACHE_PENDING_TTL = config('PAYMENT_CACHE_PENDING_TTL', default=5, cast=int)
+# Minimum seconds between upstream verifications triggered by reads of the same payment
+PAYMENT_VERIFY_POLL_INTERVAL = config('PAYMENT_VERIFY_POLL_INTERVAL', default=10, cast=int)
+# Cross-process leader election for verifying one payment: 'cache', 'db' (Postgres advisory lock) or 'none'
+PAYMENT_VERIFY_LOCK = config('PAYMENT_VERIFY_LOCK', default='cache')
+PAYMENT_VERIFY_LOCK_TIMEOUT = config('PAYMENT_VERIFY_LOCK_TIMEOUT', default=15, cast=int)
+
+# Idempotency-Key handling for payment initiation
+# Seconds a key and its stored response are kept
+PAYMENT_IDEMPOTENCY_TTL = config('PAYMENT_IDEMPOTENCY_TTL', default=86400, cast=int)
+# Seconds a duplicate request waits for the first one to finish before getting 409
+PAYMENT_IDEMPOTENCY_WAIT_TIMEOUT = config('PAYMENT_IDEMPOTENCY_WAIT_TIMEOUT', default=10, cast=float)
+# Seconds a request holds its key; past that a retry takes the key over (the holder likely died)
+PAYMENT_IDEMPOTENCY_LEASE = config('PAYMENT_IDEMPOTENCY_LEASE', default=60, cast=int)
+
+# Batch payment initiation
+PAYMENT_BATCH_MAX_SIZE = config('PAYMENT_BATCH_MAX_SIZE', default=1000, cast=int)
+# PayPal orders created in parallel per batch
+PAYMENT_BATCH_CONCURRENCY = config('PAYMENT_BATCH_CONCURRENCY', default=10, cast=int)
+
+# Reconciliation sweep (`manage.py reconcile_payments`)
+# Seconds a pending/processing payment goes without an update before it is checked with PayPal
+PAYMENT_RECONCILE_STALE_AFTER = config('PAYMENT_RECONCILE_STALE_AFTER', default=900, cast=int)
+PAYMENT_RECONCILE_CHUNK_SIZE = config('PAYMENT_RECONCILE_CHUNK_SIZE', default=500, cast=int)
+PAYMENT_RECONCILE_WORKERS = config('PAYMENT_RECONCILE_WORKERS', default=8, cast=int)
+# Maximum PayPal calls per second; 0 disables the cap
+PAYMENT_RECONCILE_RATE = config('PAYMENT_RECONCILE_RATE', default=20, cast=float)
+# Seconds between sweeps in periodic mode; 0 runs once
+PAYMENT_RECONCILE_INTERVAL = config('PAYMENT_RECONCILE_INTERVAL', default=0, cast=float)
+
+# Prometheus metrics at /metrics; set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does) to aggregate across workers
+PAYMENT_METRICS = config('PAYMENT_METRICS', default=True, cast=bool)
+# Seconds the payments-per-status gauge is reused, through PAYMENT_CACHE_ALIAS, before it is recounted
+PAYMENT_METRICS_STATUS_TTL = config('PAYMENT_METRICS_STATUS_TTL', default=15, cast=int)
+
+# Request profiling: Server-Timing spans per request and recent percentiles at /api/v1/payments/profile/
+PAYMENT_PROFILING = config('PAYMENT_PROFILING', default=False, cast=bool)
+# Share of requests run under cProfile
+PAYMENT_PROFILING_SAMPLE_RATE = config('PAYMENT_PROFILING_SAMPLE_RATE', default=0.01, cast=float)
+# Sampled requests slower than this are saved as .prof files in PAYMENT_PROFILING_DIR
+PAYMENT_PROFILING_SLOW_MS = config('PAYMENT_PROFILING_SLOW_MS', default=500, cast=float)
+PAYMENT_PROFILING_DIR = config('PAYMENT_PROFILING_DIR', default=os.path.join(BASE_DIR, 'logs', 'profiles'))
+
+# Merchant webhooks for payment status changes, delivered from the outbox by `manage.py dispatch_outbox`
+PAYMENT_WEBHOOK_URL = config('PAYMENT_WEBHOOK_URL', default='')
+# HMAC-SHA256 key for the X-Webhook-Signature header
+PAYMENT_WEBHOOK_SECRET = config('PAYMENT_WEBHOOK_SECRET', default='')
+PAYMENT_WEBHOOK_TIMEOUT = config('PAYMENT_WEBHOOK_TIMEOUT', default=10, cast=float)
+PAYMENT_OUTBOX_BATCH_SIZE = config('PAYMENT_OUTBOX_BATCH_SIZE', default=500, cast=int)
+# Payments delivered in parallel; events of one payment are always delivered in order
+PAYMENT_OUTBOX_WORKERS = config('PAYMENT_OUTBOX_WORKERS', default=8, cast=int)
+PAYMENT_OUTBOX_POLL_INTERVAL = config('PAYMENT_OUTBOX_POLL_INTERVAL', default=1, cast=float)
+# Failed deliveries are retried after PAYMENT_OUTBOX_BACKOFF_BASE * 2^(attempt-1) seconds, up to PAYMENT_OUTBOX_MAX_DELAY
+PAYMENT_OUTBOX_BACKOFF_BASE = config('PAYMENT_OUTBOX_BACKOFF_BASE', default=5, cast=float)
+PAYMENT_OUTBOX_MAX_DELAY = config('PAYMENT_OUTBOX_MAX_DELAY', default=3600, cast=float)
+PAYMENT_OUTBOX_MAX_ATTEMPTS = config('PAYMENT_OUTBOX_MAX_ATTEMPTS', default=15, cast=int)
+# Seconds a dispatcher owns an event before another process may retry it
+PAYMENT_OUTBOX_LEASE = config('PAYMENT_OUTBOX_LEASE', default=60, cast=int)
+
 # PayPal API Settings
 PAYPAL_CLIENT_ID = config('PAYPAL_CLIENT_ID', default='')
 PAYPAL_CLIENT_SECRET = config('PAYPAL_CLIENT_SECRET', default='')
 PAYPAL_API_URL = config('PAYPAL_API_URL', default='https://api-m.sandbox.paypal.com')
+# In DEBUG, answer PayPal calls with in-process stubs; turn off to reach PAYPAL_API_URL (e.g. `manage.py paypal_simulator`)
+PAYPAL_MOCK_RESPONSES = config('PAYPAL_MOCK_RESPONSES', default=True, cast=bool)
+
+# PayPal OAuth token cache
+# 'local' keeps the token per process, 'django' shares it between workers through CACHES
+PAYPAL_TOKEN_CACHE_BACKEND = config('PAYPAL_TOKEN_CACHE_BACKEND', default='local')
+PAYPAL_TOKEN_CACHE_ALIAS = config('PAYPAL_TOKEN_CACHE_ALIAS', default='default')
+# Refresh the token this many seconds before PayPal expires it
+PAYPAL_TOKEN_REFRESH_MARGIN = config('PAYPAL_TOKEN_REFRESH_MARGIN', default=60, cast=int)
+# Lifetime assumed when the token response has no expires_in
+PAYPAL_TOKEN_DEFAULT_TTL = config('PAYPAL_TOKEN_DEFAULT_TTL', default=300, cast=int)
+
+# PayPal HTTP connection pool
+PAYPAL_HTTP_POOL_CONNECTIONS = config('PAYPAL_HTTP_POOL_CONNECTIONS', default=4, cast=int)
+PAYPAL_HTTP_POOL_MAXSIZE = config('PAYPAL_HTTP_POOL_MAXSIZE', default=20, cast=int)
+# Wait for a free connection instead of opening an unpooled one when the pool is exhausted
+PAYPAL_HTTP_POOL_BLOCK = config('PAYPAL_HTTP_POOL_BLOCK', default=False, cast=bool)
+PAYPAL_HTTP_CONNECT_TIMEOUT = config('PAYPAL_HTTP_CONNECT_TIMEOUT', default=3.05, cast=float)
+# (connect, read) timeouts in seconds per PayPal endpoint
+PAYPAL_HTTP_TIMEOUTS = {
+    'token': (PAYPAL_HTTP_CONNECT_TIMEOUT, config('PAYPAL_TOKEN_READ_TIMEOUT', default=10, cast=float)),
+    'create_order': (PAYPAL_HTTP_CONNECT_TIMEOUT, config('PAYPAL_CREATE_ORDER_READ_TIMEOUT', default=20, cast=float)),
+    'capture_payment': (PAYPAL_HTTP_CONNECT_TIMEOUT, config('PAYPAL_CAPTURE_READ_TIMEOUT', default=30, cast=float)),
+    'verify_payment': (PAYPAL_HTTP_CONNECT_TIMEOUT, config('PAYPAL_VERIFY_READ_TIMEOUT', default=10, cast=float)),
+    'verify_webhook': (PAYPAL_HTTP_CONNECT_TIMEOUT, config('PAYPAL_VERIFY_WEBHOOK_READ_TIMEOUT', default=10, cast=float)),
+}
+# Retries of idempotent PayPal calls after a timeout, connection error or 429/5xx,
+# with full-jitter backoff from PAYPAL_RETRY_BACKOFF_BASE up to PAYPAL_RETRY_MAX_DELAY seconds
+PAYPAL_RETRY_MAX = config('PAYPAL_RETRY_MAX', default=2, cast=int)
+PAYPAL_RETRY_BACKOFF_BASE = config('PAYPAL_RETRY_BACKOFF_BASE', default=0.2, cast=float)
+PAYPAL_RETRY_MAX_DELAY = config('PAYPAL_RETRY_MAX_DELAY', default=2.0, cast=float)
+# Retry budget: retries per request made, plus a floor of retries per second
+PAYPAL_RETRY_BUDGET_RATIO = config('PAYPAL_RETRY_BUDGET_RATIO', default=0.1, cast=float)
+PAYPAL_RETRY_BUDGET_MIN_PER_SECOND = config('PAYPAL_RETRY_BUDGET_MIN_PER_SECOND', default=1.0, cast=float)
+# Circuit breaker: opens when PAYPAL_BREAKER_FAILURE_RATE of at least PAYPAL_BREAKER_MIN_CALLS calls
+# in PAYPAL_BREAKER_WINDOW seconds failed, and probes PayPal again after PAYPAL_BREAKER_RESET_TIMEOUT seconds
+PAYPAL_BREAKER_FAILURE_RATE = config('PAYPAL_BREAKER_FAILURE_RATE', default=0.5, cast=float)
+PAYPAL_BREAKER_MIN_CALLS = config('PAYPAL_BREAKER_MIN_CALLS', default=20, cast=int)
+PAYPAL_BREAKER_WINDOW = config('PAYPAL_BREAKER_WINDOW', default=30, cast=float)
+PAYPAL_BREAKER_RESET_TIMEOUT = config('PAYPAL_BREAKER_RESET_TIMEOUT', default=15, cast=float)
+# AIMD limit on outstanding PayPal requests per process; callers wait PAYPAL_CONCURRENCY_WAIT seconds for a slot
+PAYPAL_CONCURRENCY_INITIAL = config('PAYPAL_CONCURRENCY_INITIAL', default=20, cast=int)
+PAYPAL_CONCURRENCY_MIN = config('PAYPAL_CONCURRENCY_MIN', default=2, cast=int)
+PAYPAL_CONCURRENCY_MAX = config('PAYPAL_CONCURRENCY_MAX', default=100, cast=int)
+PAYPAL_CONCURRENCY_BACKOFF = config('PAYPAL_CONCURRENCY_BACKOFF', default=0.9, cast=float)
+PAYPAL_CONCURRENCY_WAIT = config('PAYPAL_CONCURRENCY_WAIT', default=1.0, cast=float)
+# Connection limit of the httpx client used by the async views
+PAYPAL_ASYNC_MAX_CONNECTIONS = config('PAYPAL_ASYNC_MAX_CONNECTIONS', default=200, cast=int)
+
+# Payment status stream (/events/, SSE) and long-poll (/wait/) endpoints; serve them under ASGI
+# Seconds an SSE connection stays open before the client reconnects
+PAYMENT_STREAM_MAX_DURATION = config('PAYMENT_STREAM_MAX_DURATION', default=300, cast=float)
+PAYMENT_STREAM_HEARTBEAT = config('PAYMENT_STREAM_HEARTBEAT', default=15, cast=float)
+# Waiting clients re-read the payment this often, in case a change made by another process
+# was not announced (cross-process notifications need PostgreSQL LISTEN/NOTIFY)
+PAYMENT_STREAM_RECHECK = config('PAYMENT_STREAM_RECHECK', default=30, cast=float)
+PAYMENT_STREAM_RETRY_MS = config('PAYMENT_STREAM_RETRY_MS', default=3000, cast=int)
+# Longest a /wait/ request is held open
+PAYMENT_LONG_POLL_TIMEOUT = config('PAYMENT_LONG_POLL_TIMEOUT', default=30, cast=float)
+
+# Use the async views for the PayPal-bound endpoints (enabled by asgi.py)
+PAYMENTS_ASYNC_VIEWS = config('PAYMENTS_ASYNC_VIEWS', default=False, cast=bool)
+
+# PayPal webhooks, received at /api/v1/payments/paypal/webhook/ and applied by `manage.py process_webhook_events`
+# Id of the webhook registered with PayPal; signatures are verified against it
+PAYPAL_WEBHOOK_ID = config('PAYPAL_WEBHOOK_ID', default='')
+PAYPAL_WEBHOOK_BATCH_SIZE = config('PAYPAL_WEBHOOK_BATCH_SIZE', default=500, cast=int)
+PAYPAL_WEBHOOK_POLL_INTERVAL = config('PAYPAL_WEBHOOK_POLL_INTERVAL', default=1, cast=float)
+# Signature verifications sent to PayPal in parallel per batch
+PAYPAL_WEBHOOK_VERIFY_CONCURRENCY = config('PAYPAL_WEBHOOK_VERIFY_CONCURRENCY', default=8, cast=int)
+# Events whose signature could not be checked are retried after
+# PAYPAL_WEBHOOK_BACKOFF_BASE * 2^(attempt-1) seconds, up to PAYPAL_WEBHOOK_MAX_DELAY
+PAYPAL_WEBHOOK_BACKOFF_BASE = config('PAYPAL_WEBHOOK_BACKOFF_BASE', default=5, cast=float)
+PAYPAL_WEBHOOK_MAX_DELAY = config('PAYPAL_WEBHOOK_MAX_DELAY', default=3600, cast=float)
+# Accept events without checking signatures while PAYPAL_WEBHOOK_ID is unset; honoured only with DEBUG
+PAYPAL_WEBHOOK_SKIP_VERIFICATION = config('PAYPAL_WEBHOOK_SKIP_VERIFICATION', default=False, cast=bool)
+
+# Background payment verification
+# First verification runs PAYMENT_VERIFY_DELAY seconds after the order is created,
+# retries back off by PAYMENT_VERIFY_BACKOFF up to PAYMENT_VERIFY_MAX_DELAY
+PAYMENT_VERIFY_DELAY = config('PAYMENT_VERIFY_DELAY', default=2, cast=float)
+PAYMENT_VERIFY_BACKOFF = config('PAYMENT_VERIFY_BACKOFF', default=2.0, cast=float)
+PAYMENT_VERIFY_MAX_DELAY = config('PAYMENT_VERIFY_MAX_DELAY', default=300, cast=float)
+PAYMENT_VERIFY_MAX_ATTEMPTS = config('PAYMENT_VERIFY_MAX_ATTEMPTS', default=5, cast=int)
+PAYMENT_VERIFY_WORKERS = config('PAYMENT_VERIFY_WORKERS', default=4, cast=int)
+# Maximum verification calls to PayPal in flight at once per process
+PAYMENT_VERIFY_MAX_CONCURRENT = config('PAYMENT_VERIFY_MAX_CONCURRENT', default=4, cast=int)
+# Seconds a worker owns a verification before another process may retry it
+PAYMENT_VERIFY_LEASE = config('PAYMENT_VERIFY_LEASE', default=60, cast=int)
 
 # Logging Configuration
 LOGGING = {
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'payment_gateway.settings')
 
 application = get_wsgi_application()
+
+# Resume the verifications persisted before a restart without waiting for the next payment
+from payments.scheduler import get_verification_scheduler  # noqa: E402
+
+get_verification_scheduler().start()
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import os
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from payments.http_client import IDEMPOTENT_ENDPOINTS, REQUEST_ID_HEADER, configured_timeouts
+from payments.models import PaymentGatewayEvent
+from payments.metrics import PAYPAL_REJECTED, PAYPAL_RETRIES, observe_paypal_call, paypal_operation
+from payments.profiling import span
+from payments.resilience import (
+    OVERLOAD_STATUSES,
+    PayPalUnavailable,
+    get_circuit_breaker,
+    get_retry_budget,
+    parse_retry_after,
+    raise_for_overload,
+    retry_delay,
+)
+from payments.scheduler import get_verification_scheduler
+from payments.services import ORDER_UPDATE_FIELDS, PAYPAL_STATUS_MAP, apply_order, build_order_payload
+from payments.singleflight import AsyncSingleFlight
+from payments.token_cache import get_token_cache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPayPalService:
+    """
+    Asyncio counterpart of PayPalService for ASGI deployments.
+
+    Upstream calls run on a shared httpx.AsyncClient, so a waiting payment
+    holds a coroutine instead of a worker thread. The OAuth token cache is
+    shared with the sync service.
+    """
+
+    def __init__(self, transport=None):
+        self.base_url = os.environ.get('PAYPAL_API_URL', 'https://api-m.sandbox.paypal.com')
+        self.client_id = os.environ.get('PAYPAL_CLIENT_ID', '')
+        self.client_secret = os.environ.get('PAYPAL_CLIENT_SECRET', '')
+        self.token_cache = get_token_cache(self.base_url, self.client_id)
+        self.timeouts = configured_timeouts()
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            limits=httpx.Limits(
+                max_connections=settings.PAYPAL_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.PAYPAL_HTTP_POOL_MAXSIZE,
+            ),
+        )
+        self._token_lock = asyncio.Lock()
+        self.verify_flight = AsyncSingleFlight()
+
+    def _timeout(self, endpoint):
+        connect, read = self.timeouts.get(endpoint, self.timeouts['verify_payment'])
+        return httpx.Timeout(read, connect=connect)
+
+    def _check_token_rejected(self, response):
+        """Drop the cached token when PayPal no longer accepts it"""
+        if response.status_code == 401:
+            self.token_cache.invalidate()
+
+    async def get_access_token(self):
+        """Get PayPal OAuth access token, letting one coroutine refresh it at a time"""
+        token = self.token_cache.cached_token()
+        if token:
+            return token
+
+        async with self._token_lock:
+            token = self.token_cache.cached_token()
+            if token:
+                return token
+            token, expires_in = await self._fetch_access_token()
+            return self.token_cache.store(token, expires_in)
+
+    async def _fetch_access_token(self):
+        """Request a new OAuth access token from PayPal"""
+        url = f"{self.base_url}/v1/oauth2/token"
+
+        headers = {
+            "Accept": "application/json",
+            "Accept-Language": "en_US"
+        }
+
+        try:
+            response = await self._send(
+                'POST', url, 'token',
+                auth=(self.client_id, self.client_secret),
+                data={"grant_type": "client_credentials"},
+                headers=headers,
+            )
+            raise_for_overload(response, "authentication")
+            response_data = response.json()
+
+            if response.status_code != 200:
+                logger.error(f"PayPal token error: {response_data}")
+                raise Exception("Failed to get PayPal access token")
+
+            expires_in = response_data.get("expires_in", settings.PAYPAL_TOKEN_DEFAULT_TTL)
+            return response_data["access_token"], int(expires_in)
+
+        except PayPalUnavailable:
+            raise
+        except Exception as e:
+            logger.error(f"PayPal token exception: {str(e)}")
+            raise Exception(f"PayPal authentication failed: {str(e)}")
+
+    async def _send(self, method, url, endpoint, **kwargs):
+        """
+        One PayPal call through the process-wide circuit breaker, retried on
+        the same terms as PayPalHTTPClient.request
+        """
+        retryable = (
+            method == 'GET' or endpoint in IDEMPOTENT_ENDPOINTS
+            or REQUEST_ID_HEADER in (kwargs.get('headers') or {})
+        )
+        budget = get_retry_budget()
+        budget.deposit()
+
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = await self._attempt(method, url, endpoint, **kwargs)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if response.status_code not in OVERLOAD_STATUSES:
+                    return response
+            except httpx.TransportError as e:
+                response, retry_after, error = None, None, e
+
+            attempt += 1
+            if not retryable or attempt > settings.PAYPAL_RETRY_MAX or not budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            PAYPAL_RETRIES.labels(paypal_operation(endpoint)).inc()
+            await asyncio.sleep(retry_delay(attempt, retry_after))
+
+    async def _attempt(self, method, url, endpoint, **kwargs):
+        """One try, timed for the request profile and the metrics"""
+        breaker = get_circuit_breaker()
+        try:
+            breaker.before_call()
+        except PayPalUnavailable:
+            PAYPAL_REJECTED.labels(paypal_operation(endpoint)).inc()
+            raise
+
+        started = time.perf_counter()
+        error = overloaded = True
+        try:
+            with span(f'paypal.{endpoint}'):
+                response = await self.client.request(method, url, timeout=self._timeout(endpoint), **kwargs)
+            error = response.status_code >= 400
+            overloaded = response.status_code in OVERLOAD_STATUSES
+            return response
+        finally:
+            breaker.record(not overloaded)
+            observe_paypal_call(endpoint, time.perf_counter() - started, error)
+
+    async def _headers(self):
+        access_token = await self.get_access_token()
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {access_token}"
+        }
+
+    async def create_order(self, payment):
+        """Create a PayPal order"""
+        url = f"{self.base_url}/v2/checkout/orders"
+        headers = await self._headers()
+        # Lets the call be retried without creating a second order
+        headers[REQUEST_ID_HEADER] = str(payment.id)
+
+        try:
+            response = await self._send('POST', url, 'create_order', json=build_order_payload(payment), headers=headers)
+            # Still failing after the retries
+            raise_for_overload(response, "order creation")
+            response_data = response.json()
+            self._check_token_rejected(response)
+
+            if response.status_code not in [200, 201]:
+                logger.error(f"PayPal order error: {response_data}")
+                raise Exception("Failed to create PayPal order")
+
+            approval_url = apply_order(payment, response_data)
+            await payment.atransition("processing", ORDER_UPDATE_FIELDS, allowed_from=("pending",))
+            await PaymentGatewayEvent.arecord(payment, 'order', response_data)
+
+            # Verify the payment in the background once the delay has passed
+            get_verification_scheduler().schedule(payment.id, payment.verify_due_at)
+
+            return payment, approval_url
+
+        except PayPalUnavailable as e:
+            # No order exists to resume this payment from; the client's retry starts a new one
+            logger.warning(f"PayPal order refused, PayPal unavailable: {str(e)}")
+            payment.failure_reason = 'paypal_unavailable'
+            await payment.atransition("failed", ['failure_reason'], allowed_from=("pending",))
+            raise
+        except Exception as e:
+            logger.error(f"PayPal order exception: {str(e)}")
+            payment.failure_reason = 'order_rejected'
+            await payment.atransition("failed", ['failure_reason'], allowed_from=("pending",))
+            raise Exception(f"PayPal order creation failed: {str(e)}")
+
+    async def capture_payment(self, payment):
+        """Capture an approved PayPal payment"""
+        url = f"{self.base_url}/v2/checkout/orders/{payment.gateway_order_id}/capture"
+        headers = await self._headers()
+        headers[REQUEST_ID_HEADER] = f"{payment.id}-capture"
+
+        try:
+            response = await self._send('POST', url, 'capture_payment', headers=headers)
+            raise_for_overload(response, "capture")
+            response_data = response.json()
+            self._check_token_rejected(response)
+
+            if response.status_code not in [200, 201]:
+                logger.error(f"PayPal capture error: {response_data}")
+                raise Exception("Failed to capture PayPal payment")
+
+            await PaymentGatewayEvent.arecord(payment, 'capture', response_data)
+            payment.gateway_status = response_data.get("status")
+            await payment.atransition("completed", ['gateway_status'])
+
+            return response_data
+
+        except PayPalUnavailable:
+            raise
+        except Exception as e:
+            logger.error(f"PayPal capture exception: {str(e)}")
+            raise Exception(f"PayPal payment capture failed: {str(e)}")
+
+    async def verify_payment(self, payment):
+        """Verify the status of a PayPal payment, coalescing concurrent verifications of it"""
+        if not payment.gateway_order_id:
+            return payment  # Skip verification if no PayPal order was created
+
+        return await self.verify_flight.do(str(payment.id), lambda: self._verify_payment(payment))
+
+    async def _verify_payment(self, payment):
+        url = f"{self.base_url}/v2/checkout/orders/{payment.gateway_order_id}"
+        headers = await self._headers()
+
+        try:
+            response = await self._send('GET', url, 'verify_payment', headers=headers)
+            raise_for_overload(response, "order lookup")
+            response_data = response.json()
+            self._check_token_rejected(response)
+
+            if response.status_code != 200:
+                logger.error(f"PayPal verification error: {response_data}")
+                return payment
+
+            paypal_status = response_data.get("status", "")
+            await PaymentGatewayEvent.arecord(payment, 'verify', response_data)
+            payment.gateway_status = paypal_status
+            await payment.atransition(PAYPAL_STATUS_MAP.get(paypal_status, payment.status), ['gateway_status'])
+
+            return payment
+
+        except PayPalUnavailable:
+            # Left to the caller, as in PayPalService._verify_payment
+            raise
+        except Exception as e:
+            logger.error(f"PayPal verification exception: {str(e)}")
+            return payment
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# httpx clients are bound to the event loop they were first used on
+_async_services = weakref.WeakKeyDictionary()
+_async_transport = None
+
+
+def use_async_transport(transport):
+    """Route new async services through a custom httpx transport (e.g. the DEBUG mock)"""
+    global _async_transport
+    _async_transport = transport
+    _async_services.clear()
+
+
+def get_async_paypal_service():
+    """Return the AsyncPayPalService for the running event loop"""
+    loop = asyncio.get_running_loop()
+    service = _async_services.get(loop)
+    if service is None:
+        service = AsyncPayPalService(transport=_async_transport)
+        _async_services[loop] = service
+    return service
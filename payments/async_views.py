@@ -0,0 +1,339 @@
+import asyncio
+
+from adrf.views import APIView
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.response import Response
+from .models import Payment
+from .serializers import PaymentCreateSerializer, PaymentResponseSerializer, fast_payment_response_serializer
+from .async_services import get_async_paypal_service, use_async_transport
+from .idempotency import IDEMPOTENCY_HEADER, arun_idempotent
+from .cache import TERMINAL_STATUSES, acache_payment, aclaim_verification, aget_cached_payment
+from .etags import etag_matches, not_modified, payment_etag
+from .renderers import dumps
+from .resilience import PayPalUnavailable, retry_after_header
+from .status_stream import broker
+from .views import IgnoreClientContentNegotiation
+import logging
+
+from django.conf import settings
+from payments.mocks.paypal_mock import mock_paypal_transport
+
+if settings.DEBUG and settings.PAYPAL_MOCK_RESPONSES:
+    use_async_transport(mock_paypal_transport())
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of the views in payments/views.py, used when the gateway
+# runs under ASGI (PAYMENTS_ASYNC_VIEWS). Responses are identical to the sync views.
+
+
+class InitiatePaymentView(APIView):
+    """
+    API endpoint for initiating a PayPal payment
+    """
+    async def post(self, request, format=None):
+        # Retries carrying the same Idempotency-Key replay the first response
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            return await arun_idempotent(request, idempotency_key, self.initiate_payment)
+        return await self.initiate_payment(request)
+
+    async def initiate_payment(self, request):
+        serializer = PaymentCreateSerializer(data=request.data)
+
+        if serializer.is_valid():
+            try:
+                # Save the payment with initial pending status
+                payment = await sync_to_async(serializer.save)(status='pending')
+
+                # Process the payment with PayPal
+                paypal_service = get_async_paypal_service()
+                processed_payment, approval_url = await paypal_service.create_order(payment)
+
+                # Prepare the response
+                response_serializer = PaymentResponseSerializer(processed_payment)
+
+                return Response({
+                    "payment": response_serializer.data,
+                    "redirect_url": approval_url,
+                    "status": "success",
+                    "message": "Payment initiated successfully. Redirect the customer to complete payment."
+                }, status=status.HTTP_201_CREATED)
+
+            except PayPalUnavailable as e:
+                logger.warning(f"Payment initiation refused, PayPal unavailable: {str(e)}")
+                return Response({
+                    "status": "error",
+                    "message": "PayPal is temporarily unavailable. Please try again shortly."
+                }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": retry_after_header(e)})
+            except Exception as e:
+                logger.error(f"Payment initiation error: {str(e)}")
+                # A PayPal failure, not a bad request: 5xx keeps it out of the idempotency store
+                return Response({
+                    "status": "error",
+                    "message": f"Payment processing failed: {str(e)}"
+                }, status=status.HTTP_502_BAD_GATEWAY)
+
+        return Response({
+            "status": "error",
+            "message": "Invalid payment data",
+            "errors": serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+
+class PaymentDetailView(APIView):
+    """
+    API endpoint for retrieving payment details
+    """
+    async def get(self, request, id, format=None):
+        try:
+            # Serve from the cache unless a pending payment is due for an upstream check
+            payment_data, etag = await aget_cached_payment(id)
+            verify_due = False
+            if payment_data is None or payment_data["status"] not in TERMINAL_STATUSES:
+                verify_due = await aclaim_verification(id)
+
+            if etag is None and not verify_due and request.headers.get('If-None-Match'):
+                # Revalidation on a cache miss: compare against updated_at before loading the whole row
+                updated_at = await Payment.objects.filter(id=id).values_list('updated_at', flat=True).afirst()
+                if updated_at is None:
+                    raise Payment.DoesNotExist
+                current_etag = payment_etag(id, updated_at)
+                if etag_matches(request, current_etag):
+                    return not_modified(current_etag)
+
+            if payment_data is None or verify_due:
+                payment = await Payment.objects.aget(id=id)
+
+                # If the payment is still processing, check its status at most once per interval
+                if payment.status in ['pending', 'processing'] and verify_due:
+                    try:
+                        paypal_service = get_async_paypal_service()
+                        payment = await paypal_service.verify_payment(payment)
+                    except Exception as e:
+                        logger.error(f"Payment verification error: {str(e)}")
+
+                payment_data = fast_payment_response_serializer.to_representation(payment)
+                etag = payment_etag(payment.id, payment.updated_at)
+                await acache_payment(id, payment_data, etag)
+
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+            return Response({
+                "payment": payment_data,
+                "status": "success",
+                "message": "Payment details retrieved successfully."
+            }, status=status.HTTP_200_OK, headers={'ETag': etag})
+
+        except Payment.DoesNotExist:
+            return Response({
+                "status": "error",
+                "message": "Payment not found."
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Payment detail error: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": f"Error retrieving payment details: {str(e)}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PayPalSuccessView(APIView):
+    """
+    Webhook endpoint for successful PayPal payments
+    """
+    async def get(self, request, format=None):
+        order_id = request.query_params.get('token')
+
+        if not order_id:
+            return Response({
+                "status": "error",
+                "message": "No order ID provided."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Find the payment by PayPal order ID
+            payment = await Payment.objects.aget(gateway_order_id=order_id)
+
+            # Capture the payment; this also marks it completed
+            paypal_service = get_async_paypal_service()
+            await paypal_service.capture_payment(payment)
+
+            return Response({
+                "status": "success",
+                "message": "Payment completed successfully.",
+                "payment_id": str(payment.id)
+            }, status=status.HTTP_200_OK)
+
+        except Payment.DoesNotExist:
+            return Response({
+                "status": "error",
+                "message": "Payment not found."
+            }, status=status.HTTP_404_NOT_FOUND)
+        except PayPalUnavailable as e:
+            logger.warning(f"Capture refused, PayPal unavailable: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": "PayPal is temporarily unavailable. Reload this page shortly to complete the payment."
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": retry_after_header(e)})
+        except Exception as e:
+            logger.error(f"PayPal success callback error: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": f"Error completing payment: {str(e)}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PayPalCancelView(APIView):
+    """
+    Webhook endpoint for cancelled PayPal payments
+    """
+    async def get(self, request, format=None):
+        order_id = request.query_params.get('token')
+
+        if not order_id:
+            return Response({
+                "status": "error",
+                "message": "No order ID provided."
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Find the payment by PayPal order ID
+            payment = await Payment.objects.aget(gateway_order_id=order_id)
+
+            # Update payment status, unless it was captured in the meantime
+            if not await payment.atransition("failed"):
+                return Response({
+                    "status": "error",
+                    "message": f"Payment is already {payment.status} and can no longer be cancelled.",
+                    "payment_id": str(payment.id)
+                }, status=status.HTTP_409_CONFLICT)
+
+            return Response({
+                "status": "cancelled",
+                "message": "Payment was cancelled.",
+                "payment_id": str(payment.id)
+            }, status=status.HTTP_200_OK)
+
+        except Payment.DoesNotExist:
+            return Response({
+                "status": "error",
+                "message": "Payment not found."
+            }, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"PayPal cancel callback error: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": f"Error processing payment cancellation: {str(e)}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+async def payment_status_data(payment_id):
+    """The payment as the detail endpoint returns it, read fresh from the database"""
+    row = await Payment.objects.values(*fast_payment_response_serializer.fields).aget(id=payment_id)
+    return fast_payment_response_serializer.to_representation(row)
+
+
+def sse_event(payment_data):
+    return f"event: status\ndata: {dumps(payment_data).decode()}\n\n"
+
+
+class PaymentStatusStreamView(APIView):
+    """
+    Server-Sent Events stream of a payment's status: the current status
+    right away, then one event per change until the payment reaches a
+    terminal status. The connection is idle in between apart from
+    heartbeat comments, and is closed after PAYMENT_STREAM_MAX_DURATION
+    seconds (EventSource reconnects by itself).
+    """
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    async def get(self, request, id, format=None):
+        # Subscribe before reading, so a change in between is not missed
+        subscription = broker.subscribe(id)
+        try:
+            payment_data = await payment_status_data(id)
+        except Payment.DoesNotExist:
+            broker.unsubscribe(subscription)
+            return Response({
+                "status": "error",
+                "message": "Payment not found."
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        response = StreamingHttpResponse(self.events(subscription, payment_data), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def events(self, subscription, payment_data):
+        with subscription:
+            loop = asyncio.get_running_loop()
+            yield f"retry: {settings.PAYMENT_STREAM_RETRY_MS}\n\n"
+            yield sse_event(payment_data)
+
+            deadline = loop.time() + settings.PAYMENT_STREAM_MAX_DURATION
+            recheck_at = loop.time() + settings.PAYMENT_STREAM_RECHECK
+            while payment_data["status"] not in TERMINAL_STATUSES:
+                now = loop.time()
+                if now >= deadline:
+                    break
+                wait = min(settings.PAYMENT_STREAM_HEARTBEAT, deadline - now, max(recheck_at - now, 0))
+                changed = await subscription.get(wait)
+                if changed is None and loop.time() < recheck_at:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                # Notified, or time to re-read in case a change in another process went unannounced
+                recheck_at = loop.time() + settings.PAYMENT_STREAM_RECHECK
+                latest = await payment_status_data(subscription.payment_id)
+                if latest["status"] != payment_data["status"]:
+                    payment_data = latest
+                    yield sse_event(payment_data)
+
+
+class PaymentStatusWaitView(APIView):
+    """
+    Long-poll fallback for clients without EventSource: answers as soon as
+    the payment's status differs from `status` (the one the client last
+    saw), or after `timeout` seconds with the status unchanged.
+    """
+
+    async def get(self, request, id, format=None):
+        known_status = request.query_params.get('status')
+        try:
+            timeout = float(request.query_params.get('timeout', settings.PAYMENT_LONG_POLL_TIMEOUT))
+        except ValueError:
+            return Response({
+                "status": "error",
+                "message": "timeout must be a number of seconds."
+            }, status=status.HTTP_400_BAD_REQUEST)
+        timeout = max(0.0, min(timeout, settings.PAYMENT_LONG_POLL_TIMEOUT))
+
+        with broker.subscribe(id) as subscription:
+            try:
+                payment_data = await payment_status_data(id)
+            except Payment.DoesNotExist:
+                return Response({
+                    "status": "error",
+                    "message": "Payment not found."
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while payment_data["status"] == known_status and known_status not in TERMINAL_STATUSES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await subscription.get(min(remaining, settings.PAYMENT_STREAM_RECHECK))
+                payment_data = await payment_status_data(id)
+
+        return Response({
+            "payment": payment_data,
+            "changed": payment_data["status"] != known_status,
+            "status": "success",
+            "message": "Payment details retrieved successfully."
+        }, status=status.HTTP_200_OK)
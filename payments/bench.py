@@ -0,0 +1,340 @@
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from payments.mocks.paypal_server import SimulatorConfig, start_simulator
+from payments.models import Payment
+from payments.renderers import ORJSONRenderer
+from payments.scheduler import get_verification_scheduler
+from payments.serializers import (
+    PaymentResponseSerializer,
+    PaymentSerializer,
+    fast_payment_response_serializer,
+    fast_payment_serializer,
+)
+from payments.services import reset_paypal_service
+
+# Share of requests per operation
+WORKLOADS = {
+    'create-heavy': {'create': 0.7, 'poll': 0.2, 'list': 0.1},
+    'poll-heavy': {'create': 0.1, 'poll': 0.8, 'list': 0.1},
+    'list-heavy': {'create': 0.1, 'poll': 0.2, 'list': 0.7},
+}
+
+OPERATIONS = ('create', 'poll', 'list')
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_client():
+    """Test client sending a Host header the project accepts"""
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+    return Client(HTTP_HOST=hosts[0] if hosts else 'localhost')
+
+
+def summarize(samples, elapsed):
+    """Per-operation results from (latency seconds, query count, ok) samples"""
+    latencies = sorted(latency * 1000 for latency, _, _ in samples)
+    queries = [count for _, count, _ in samples]
+    return {
+        "count": len(samples),
+        "errors": sum(1 for _, _, ok in samples if not ok),
+        "rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(latencies[-1], 2) if latencies else 0.0,
+        },
+        "queries": {
+            "mean": round(sum(queries) / len(queries), 2) if queries else 0.0,
+            "max": max(queries) if queries else 0,
+        },
+    }
+
+
+@contextmanager
+def paypal_endpoint(url):
+    """Point the process-wide PayPalService at `url` for the duration of the block"""
+    previous = os.environ.get('PAYPAL_API_URL')
+    os.environ['PAYPAL_API_URL'] = url
+    reset_paypal_service()
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop('PAYPAL_API_URL', None)
+        else:
+            os.environ['PAYPAL_API_URL'] = previous
+        reset_paypal_service()
+
+
+class Benchmark:
+    """
+    Drives the payment API in-process with concurrent Django test clients
+    and records latency and DB queries per request.
+    """
+
+    def __init__(self, workload='create-heavy', concurrency=8, requests=1000, seed_payments=100, page_size=50, seed=0):
+        self.mix = WORKLOADS[workload]
+        self.workload = workload
+        self.concurrency = concurrency
+        self.requests = requests
+        self.seed_payments = seed_payments
+        self.page_size = page_size
+        self.seed = seed
+        # Marks the payments this run creates, for polling and cleanup
+        self.customer_email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+        self.payment_ids = []
+        self.samples = {operation: [] for operation in OPERATIONS}
+        self._lock = threading.Lock()
+
+    def _payload(self, rng):
+        return {
+            "customer_name": f"Bench {rng.randrange(10 ** 6)}",
+            "customer_email": self.customer_email,
+            "amount": f"{rng.randrange(100, 100000) / 100:.2f}",
+            "currency": "USD",
+        }
+
+    def _request(self, client, operation, rng):
+        if operation == 'create':
+            return client.post(reverse('initiate-payment'), self._payload(rng), content_type='application/json')
+        if operation == 'poll':
+            return client.get(reverse('payment-detail', args=[rng.choice(self.payment_ids)]))
+        return client.get(reverse('payment-list'), {"page_size": self.page_size})
+
+    def seed_data(self):
+        client = bench_client()
+        rng = random.Random(self.seed)
+        for _ in range(self.seed_payments):
+            self._request(client, 'create', rng)
+        # Responses carry a shortened id, so the payments to poll are read back
+        self.payment_ids = list(self.created_payments().values_list('id', flat=True))
+        if not self.payment_ids:
+            raise Exception("Could not create any payment to benchmark against")
+
+    def created_payments(self):
+        return Payment.objects.filter(customer_email=self.customer_email)
+
+    def _worker(self, count, seed):
+        client = bench_client()
+        rng = random.Random(seed)
+        operations, weights = zip(*self.mix.items())
+        samples = {operation: [] for operation in OPERATIONS}
+        for _ in range(count):
+            operation = rng.choices(operations, weights)[0]
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                try:
+                    ok = self._request(client, operation, rng).status_code < 500
+                except Exception:
+                    ok = False
+                latency = time.perf_counter() - started
+            samples[operation].append((latency, len(queries), ok))
+        with self._lock:
+            for operation, operation_samples in samples.items():
+                self.samples[operation].extend(operation_samples)
+
+    def _in_thread(self, count, seed):
+        try:
+            self._worker(count, seed)
+        finally:
+            close_old_connections()
+
+    def run(self):
+        """Run the workload; returns elapsed seconds"""
+        per_worker = [self.requests // self.concurrency] * self.concurrency
+        for i in range(self.requests % self.concurrency):
+            per_worker[i] += 1
+
+        started = time.perf_counter()
+        if self.concurrency == 1:
+            self._worker(per_worker[0], self.seed + 1)
+        else:
+            threads = [
+                threading.Thread(target=self._in_thread, args=(count, self.seed + i + 1), name=f"bench-{i}")
+                for i, count in enumerate(per_worker)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return time.perf_counter() - started
+
+
+def run_benchmark(workload='create-heavy', concurrency=8, requests=1000, seed_payments=100, page_size=50,
+                  simulator=None, paypal_url=None, seed=0):
+    """
+    Run one benchmark against a PayPal simulator (started in-process from
+    `simulator`, a SimulatorConfig, unless paypal_url points at a running
+    one). Returns (results, benchmark); results is JSON-serializable.
+    """
+    server = None
+    if paypal_url is None:
+        simulator = simulator or SimulatorConfig()
+        server = start_simulator(config=simulator)
+        paypal_url = server.url
+
+    benchmark = Benchmark(workload, concurrency, requests, seed_payments, page_size, seed)
+    try:
+        with paypal_endpoint(paypal_url):
+            benchmark.seed_data()
+            calls_before = dict(server.simulator.stats()["calls"]) if server else {}
+            elapsed = benchmark.run()
+            calls_after = dict(server.simulator.stats()["calls"]) if server else {}
+            # Let background verifications finish against the simulator, not the real PAYPAL_API_URL
+            get_verification_scheduler().shutdown()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    total = sum(len(samples) for samples in benchmark.samples.values())
+    results = {
+        "workload": workload,
+        "concurrency": concurrency,
+        "requests": requests,
+        "git_commit": git_commit(),
+        "started_at": timezone.now().isoformat(),
+        "database": connection.vendor,
+        "simulator": vars(simulator).copy() if server else {"url": paypal_url},
+        "elapsed": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "operations": {
+            operation: summarize(samples, elapsed)
+            for operation, samples in benchmark.samples.items() if samples
+        },
+        "upstream_calls": {
+            endpoint: count - calls_before.get(endpoint, 0)
+            for endpoint, count in calls_after.items() if count - calls_before.get(endpoint, 0)
+        },
+    }
+    results["simulator"].pop("random", None)
+    return results, benchmark
+
+
+def compare(baseline, results):
+    """Lines comparing throughput and p99 latency per operation with a baseline run"""
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    lines = [f"throughput: {baseline['throughput_rps']} -> {results['throughput_rps']} rps "
+             f"({change(baseline['throughput_rps'], results['throughput_rps'])})"]
+    for operation, current in results["operations"].items():
+        previous = baseline["operations"].get(operation)
+        if previous is None:
+            continue
+        lines.append(
+            f"{operation}: p99 {previous['latency_ms']['p99']} -> {current['latency_ms']['p99']} ms "
+            f"({change(previous['latency_ms']['p99'], current['latency_ms']['p99'])}), "
+            f"queries {previous['queries']['mean']} -> {current['queries']['mean']}"
+        )
+    return lines
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as results_file:
+        return json.load(results_file)
+
+
+def sample_payments(count, seed=0):
+    """Unsaved payments with realistic values, for benchmarks that need no database"""
+    rng = random.Random(seed)
+    now = timezone.now()
+    statuses = [status for status, _ in Payment.PAYMENT_STATUS_CHOICES]
+    return [
+        Payment(
+            id=uuid.UUID(int=rng.getrandbits(128), version=4),
+            customer_name=f"Customer {i}",
+            customer_email=f"customer{i}@example.com",
+            amount=Decimal(rng.randrange(100, 100000)) / 100,
+            currency=rng.choice(['USD', 'EUR', 'GBP']),
+            status=rng.choice(statuses),
+            created_at=now - timedelta(microseconds=rng.randrange(30 * 86400 * 10 ** 6)),
+        )
+        for i in range(count)
+    ]
+
+
+def _best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def serializer_benchmark(count=1000, repeat=5, seed=0):
+    """
+    Time the DRF serializers and JSONRenderer against the fast paths on
+    `count` payments, best of `repeat` runs, and check both produce the
+    same bytes. Returns {case: {drf_ms, fast_ms, speedup, identical}}.
+    """
+    payments = sample_payments(count, seed)
+    rows = [{name: getattr(payment, name) for name in fast_payment_serializer.fields} for payment in payments]
+    list_data = PaymentSerializer(payments, many=True).data
+    drf_renderer, fast_renderer = JSONRenderer(), ORJSONRenderer()
+
+    cases = {
+        'list': (
+            lambda: PaymentSerializer(payments, many=True).data,
+            lambda: fast_payment_serializer.many(rows),
+        ),
+        'detail': (
+            lambda: [PaymentResponseSerializer(payment).data for payment in payments],
+            lambda: [fast_payment_response_serializer.to_representation(payment) for payment in payments],
+        ),
+        'render': (
+            lambda: drf_renderer.render({"payments": list_data}),
+            lambda: fast_renderer.render({"payments": list_data}),
+        ),
+        'list+render': (
+            lambda: drf_renderer.render({"payments": PaymentSerializer(payments, many=True).data}),
+            lambda: fast_renderer.render({"payments": fast_payment_serializer.many(rows)}),
+        ),
+    }
+
+    results = {}
+    for case, (drf, fast) in cases.items():
+        drf_output, fast_output = drf(), fast()
+        if not isinstance(drf_output, bytes):
+            drf_output, fast_output = drf_renderer.render(drf_output), drf_renderer.render(fast_output)
+        drf_time, fast_time = _best_time(drf, repeat), _best_time(fast, repeat)
+        results[case] = {
+            "drf_ms": round(drf_time * 1000, 2),
+            "fast_ms": round(fast_time * 1000, 2),
+            "speedup": round(drf_time / fast_time, 1) if fast_time else None,
+            "identical": drf_output == fast_output,
+        }
+    return results
@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.core.cache import caches
+
+TERMINAL_STATUSES = ('completed', 'failed', 'refunded')
+
+
+def _cache():
+    return caches[settings.PAYMENT_CACHE_ALIAS]
+
+
+def payment_cache_key(payment_id):
+    return f"payment:{payment_id}"
+
+
+def verify_throttle_key(payment_id):
+    return f"payment:{payment_id}:verify"
+
+
+def payment_cache_ttl(payment_status):
+    """Terminal payments no longer change upstream and can be kept much longer"""
+    if payment_status in TERMINAL_STATUSES:
+        return settings.PAYMENT_CACHE_TERMINAL_TTL
+    return settings.PAYMENT_CACHE_PENDING_TTL
+
+
+def _unpack(entry):
+    if entry is None:
+        return None, None
+    if isinstance(entry, dict):
+        # Cached before ETags were stored alongside the payment
+        return entry, None
+    return entry
+
+
+def get_cached_payment(payment_id):
+    """(serialized payment, ETag) from the cache, or (None, None)"""
+    return _unpack(_cache().get(payment_cache_key(payment_id)))
+
+
+def cache_payment(payment_id, data, etag):
+    _cache().set(payment_cache_key(payment_id), (dict(data), etag), payment_cache_ttl(data["status"]))
+
+
+def invalidate_payment(payment_id):
+    _cache().delete(payment_cache_key(payment_id))
+
+
+def claim_verification(payment_id):
+    """
+    True for at most one caller per PAYMENT_VERIFY_POLL_INTERVAL, so polling
+    clients trigger an upstream verify at most once per interval.
+    """
+    return _cache().add(verify_throttle_key(payment_id), 1, settings.PAYMENT_VERIFY_POLL_INTERVAL)
+
+
+async def aget_cached_payment(payment_id):
+    return _unpack(await _cache().aget(payment_cache_key(payment_id)))
+
+
+async def acache_payment(payment_id, data, etag):
+    await _cache().aset(payment_cache_key(payment_id), (dict(data), etag), payment_cache_ttl(data["status"]))
+
+
+async def aclaim_verification(payment_id):
+    return await _cache().aadd(verify_throttle_key(payment_id), 1, settings.PAYMENT_VERIFY_POLL_INTERVAL)
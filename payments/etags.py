@@ -0,0 +1,37 @@
+import hashlib
+
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def payment_etag(payment_id, updated_at):
+    """Strong ETag of one payment: every save bumps updated_at, so it changes with the payment"""
+    return f'"{payment_id.hex}-{int(updated_at.timestamp())}.{updated_at.microsecond:06d}"'
+
+
+def page_etag(rows, next_cursor=None, query=''):
+    """
+    Strong ETag of a list page from the (id, updated_at) of its rows, without
+    serializing them, plus what else the response carries: the next cursor
+    (a row added past the end of a full page changes only that) and the
+    query string the page was read with.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{query}|{next_cursor or ''}|".encode())
+    for row in rows:
+        digest.update(f"{row['id']}:{row['updated_at'].isoformat()};".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match names `etag` (weak comparison, as for GET)"""
+    header = request.headers.get('If-None-Match')
+    if not header or etag is None:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in {tag.removeprefix('W/') for tag in etags}
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
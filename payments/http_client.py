@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from payments.metrics import PAYPAL_REJECTED, PAYPAL_RETRIES, observe_paypal_call, paypal_operation
+from payments.resilience import (
+    OVERLOAD_STATUSES,
+    AdaptiveLimiter,
+    PayPalUnavailable,
+    get_circuit_breaker,
+    get_retry_budget,
+    parse_retry_after,
+    retry_delay,
+)
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds for each PayPal endpoint
+DEFAULT_TIMEOUTS = {
+    'token': (3.05, 10),
+    'create_order': (3.05, 20),
+    'capture_payment': (3.05, 30),
+    'verify_payment': (3.05, 10),
+    'verify_webhook': (3.05, 10),
+}
+
+# POSTs that change nothing at PayPal; other POSTs are only retried when they carry a PayPal-Request-Id
+IDEMPOTENT_ENDPOINTS = ('token', 'verify_webhook')
+REQUEST_ID_HEADER = 'PayPal-Request-Id'
+
+
+def configured_timeouts():
+    """Default endpoint timeouts overridden by settings.PAYPAL_HTTP_TIMEOUTS"""
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    timeouts.update(getattr(settings, 'PAYPAL_HTTP_TIMEOUTS', {}))
+    return timeouts
+
+
+class PayPalHTTPClient:
+    """
+    Keep-alive HTTP client shared by every PayPal call in the process.
+
+    A single requests.Session holds a urllib3 connection pool, so TCP and
+    TLS handshakes are paid once per connection instead of once per call.
+
+    Every call passes the circuit breaker and the adaptive concurrency
+    limiter; idempotent calls that time out, cannot connect or get a
+    429/5xx are retried with jittered backoff while the retry budget lasts.
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, pool_block=None, timeouts=None,
+                 breaker=None, budget=None, limiter=None, max_retries=None):
+        self.pool_connections = pool_connections or getattr(settings, 'PAYPAL_HTTP_POOL_CONNECTIONS', 4)
+        self.pool_maxsize = pool_maxsize or getattr(settings, 'PAYPAL_HTTP_POOL_MAXSIZE', 20)
+        if pool_block is None:
+            pool_block = getattr(settings, 'PAYPAL_HTTP_POOL_BLOCK', False)
+
+        self.timeouts = configured_timeouts()
+        self.timeouts.update(timeouts or {})
+
+        self.adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=pool_block,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.breaker = breaker or get_circuit_breaker()
+        self.budget = budget or get_retry_budget()
+        self.limiter = limiter or AdaptiveLimiter()
+        self.max_retries = max_retries if max_retries is not None else settings.PAYPAL_RETRY_MAX
+
+        self._lock = threading.Lock()
+        self.requests_total = 0
+        self.retries_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def timeout_for(self, endpoint):
+        return self.timeouts.get(endpoint, DEFAULT_TIMEOUTS['verify_payment'])
+
+    def request(self, method, url, endpoint, **kwargs):
+        """
+        Send a request through the pooled session using the endpoint's timeouts.
+        Raises PayPalUnavailable when the call is refused up front (open
+        circuit, no concurrency slot); a retried call that keeps failing
+        returns its last response or raises its last error.
+        """
+        kwargs.setdefault('timeout', self.timeout_for(endpoint))
+        retryable = (
+            method == 'GET' or endpoint in IDEMPOTENT_ENDPOINTS
+            or REQUEST_ID_HEADER in (kwargs.get('headers') or {})
+        )
+        self.budget.deposit()
+
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = self._attempt(method, url, endpoint, **kwargs)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if response.status_code not in OVERLOAD_STATUSES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, retry_after, error = None, None, e
+
+            attempt += 1
+            if not retryable or attempt > self.max_retries or not self.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            with self._lock:
+                self.retries_total += 1
+            PAYPAL_RETRIES.labels(paypal_operation(endpoint)).inc()
+            delay = retry_delay(attempt, retry_after)
+            logger.warning(f"Retrying PayPal {endpoint} in {delay:.2f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+
+    def _attempt(self, method, url, endpoint, **kwargs):
+        try:
+            self.breaker.before_call()
+            try:
+                self.limiter.acquire()
+            except PayPalUnavailable:
+                # Otherwise the circuit would wait forever for a probe that never ran
+                self.breaker.cancel_probe()
+                raise
+        except PayPalUnavailable:
+            PAYPAL_REJECTED.labels(paypal_operation(endpoint)).inc()
+            raise
+
+        with self._lock:
+            self.requests_total += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        started = time.perf_counter()
+        error = overloaded = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 400
+            overloaded = response.status_code in OVERLOAD_STATUSES
+            return response
+        except requests.RequestException:
+            with self._lock:
+                self.errors_total += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.limiter.release(overloaded)
+            self.breaker.record(not overloaded)
+            observe_paypal_call(endpoint, time.perf_counter() - started, error)
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request('POST', url, endpoint, **kwargs)
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def stats(self):
+        """Request counters plus connection pool usage per upstream host"""
+        pools = {}
+        for pool_key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle_connections": pool.pool.qsize() if pool.pool else 0,
+                "maxsize": self.pool_maxsize,
+            }
+
+        with self._lock:
+            return {
+                "requests_total": self.requests_total,
+                "errors_total": self.errors_total,
+                "retries_total": self.retries_total,
+                "circuit": self.breaker.state,
+                "concurrency_limit": int(self.limiter.limit),
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "pools": pools,
+            }
+
+    def close(self):
+        self.session.close()
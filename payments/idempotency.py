@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from payments.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.1
+
+
+def request_fingerprint(request):
+    """Hash of the method, path and body, to detect a key reused for a different request"""
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(f"{request.method}|{request.path}|{body}".encode()).hexdigest()
+
+
+def lease_expired(record):
+    return record.locked_until is None or record.locked_until <= timezone.now()
+
+
+def claim_key(key, fingerprint):
+    """
+    Record the key as in progress. Returns (record, created); created is False
+    when another request already claimed the key. An in-progress key whose
+    lease ran out is taken over by this request.
+    """
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=settings.PAYMENT_IDEMPOTENCY_LEASE)
+    # An expired key is free to be reused
+    IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                key=key,
+                fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=settings.PAYMENT_IDEMPOTENCY_TTL),
+                locked_until=locked_until,
+            )
+        return record, True
+    except IntegrityError:
+        pass
+
+    taken_over = IdempotencyKey.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lte=now), key=key, fingerprint=fingerprint, state='in_progress'
+    ).update(locked_until=locked_until)
+    record = IdempotencyKey.objects.get(key=key)
+    return record, bool(taken_over)
+
+
+def poll_completed(record):
+    """Reload the record; None if it was released by a failed request"""
+    return IdempotencyKey.objects.filter(pk=record.pk).first()
+
+
+def _held(record):
+    # Writes only apply while the lease is still ours, not after a takeover
+    return IdempotencyKey.objects.filter(pk=record.pk, state='in_progress', locked_until=record.locked_until)
+
+
+def release_key(record):
+    _held(record).delete()
+
+
+def store_response(record, response):
+    if response.status_code >= 500:
+        # Let the client retry requests that failed on our side or upstream
+        release_key(record)
+        return
+    _held(record).update(
+        state='completed',
+        response_status=response.status_code,
+        response_body=response.data,
+        locked_until=None,
+    )
+
+
+def purge_expired():
+    """Delete every expired key; returns how many were removed"""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+def _invalid_key_response():
+    return Response({
+        "status": "error",
+        "message": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters."
+    }, status=status.HTTP_400_BAD_REQUEST)
+
+
+def _mismatch_response():
+    return Response({
+        "status": "error",
+        "message": f"{IDEMPOTENCY_HEADER} was already used with a different request."
+    }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+def _in_progress_response():
+    return Response({
+        "status": "error",
+        "message": f"A request with this {IDEMPOTENCY_HEADER} is still being processed. Retry later."
+    }, status=status.HTTP_409_CONFLICT)
+
+
+def _replay_response(record):
+    return Response(record.response_body, status=record.response_status, headers={'Idempotent-Replayed': 'true'})
+
+
+def run_idempotent(request, key, handler):
+    """
+    Run handler(request) once per Idempotency-Key. Replays return the stored
+    response; a duplicate arriving while the first request is still running
+    waits for it instead of racing, unless the lease of the first one ran
+    out, in which case the duplicate takes over.
+    """
+    if len(key) > MAX_KEY_LENGTH:
+        return _invalid_key_response()
+
+    fingerprint = request_fingerprint(request)
+    record, created = claim_key(key, fingerprint)
+
+    if not created:
+        if record.fingerprint != fingerprint:
+            return _mismatch_response()
+        deadline = time.monotonic() + settings.PAYMENT_IDEMPOTENCY_WAIT_TIMEOUT
+        while record is not None and record.state != 'completed' and time.monotonic() < deadline:
+            if lease_expired(record):
+                break
+            time.sleep(POLL_INTERVAL)
+            record = poll_completed(record)
+        if record is None or (record.state != 'completed' and lease_expired(record)):
+            # The first request failed and released the key, or died holding it; this one takes over
+            return run_idempotent(request, key, handler)
+        if record.state != 'completed':
+            return _in_progress_response()
+        return _replay_response(record)
+
+    try:
+        response = handler(request)
+    except Exception:
+        release_key(record)
+        raise
+    store_response(record, response)
+    return response
+
+
+async def arun_idempotent(request, key, handler):
+    """run_idempotent for async views; handler is a coroutine function"""
+    if len(key) > MAX_KEY_LENGTH:
+        return _invalid_key_response()
+
+    fingerprint = request_fingerprint(request)
+    record, created = await sync_to_async(claim_key)(key, fingerprint)
+
+    if not created:
+        if record.fingerprint != fingerprint:
+            return _mismatch_response()
+        deadline = time.monotonic() + settings.PAYMENT_IDEMPOTENCY_WAIT_TIMEOUT
+        while record is not None and record.state != 'completed' and time.monotonic() < deadline:
+            if lease_expired(record):
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+            record = await sync_to_async(poll_completed)(record)
+        if record is None or (record.state != 'completed' and lease_expired(record)):
+            return await arun_idempotent(request, key, handler)
+        if record.state != 'completed':
+            return _in_progress_response()
+        return _replay_response(record)
+
+    try:
+        response = await handler(request)
+    except Exception:
+        await sync_to_async(release_key)(record)
+        raise
+    await sync_to_async(store_response)(record, response)
+    return response
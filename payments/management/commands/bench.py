@@ -0,0 +1,75 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.bench import WORKLOADS, compare, load_results, run_benchmark
+from payments.mocks.paypal_server import LATENCY_DISTRIBUTIONS, SimulatorConfig
+from payments.models import bulk_delete_payments
+
+
+class Command(BaseCommand):
+    help = "Benchmark the payment API against a local PayPal simulator"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workload', choices=sorted(WORKLOADS), default='create-heavy')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--seed-payments', type=int, default=100, help="Payments created before timing starts")
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--latency', type=float, default=0.05, help="Simulated PayPal latency in seconds")
+        parser.add_argument('--jitter', type=float, default=0.0)
+        parser.add_argument('--distribution', choices=LATENCY_DISTRIBUTIONS, default='fixed')
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--paypal-url', help="Use an already running simulator instead of starting one")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the results as JSON to this file")
+        parser.add_argument('--compare', help="Results JSON of an earlier run to compare against")
+        parser.add_argument('--keep-data', action='store_true', help="Keep the payments the benchmark created")
+
+    def handle(self, *args, **options):
+        if settings.DEBUG and settings.PAYPAL_MOCK_RESPONSES:
+            raise CommandError("Set PAYPAL_MOCK_RESPONSES=False so PayPal calls reach the simulator")
+
+        simulator = SimulatorConfig(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            distribution=options['distribution'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+        )
+        results, benchmark = run_benchmark(
+            workload=options['workload'],
+            concurrency=options['concurrency'],
+            requests=options['requests'],
+            seed_payments=options['seed_payments'],
+            page_size=options['page_size'],
+            simulator=simulator,
+            paypal_url=options['paypal_url'],
+            seed=options['seed'],
+        )
+
+        self.stdout.write(
+            f"{results['workload']}: {results['throughput_rps']} req/s over {results['elapsed']}s "
+            f"with {results['concurrency']} clients"
+        )
+        for operation, stats in results['operations'].items():
+            latency = stats['latency_ms']
+            self.stdout.write(
+                f"  {operation:<7} n={stats['count']} errors={stats['errors']} rps={stats['rps']} "
+                f"p50={latency['p50']}ms p90={latency['p90']}ms p99={latency['p99']}ms max={latency['max']}ms "
+                f"queries/req={stats['queries']['mean']}"
+            )
+        self.stdout.write(f"  upstream calls: {results['upstream_calls']}")
+
+        if options['compare']:
+            for line in compare(load_results(options['compare']), results):
+                self.stdout.write(f"  {line}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if not options['keep_data']:
+            bulk_delete_payments(benchmark.created_payments())
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.bench import serializer_benchmark
+
+
+class Command(BaseCommand):
+    help = "Compare the DRF payment serializers and JSON renderer with the fast paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help="Payments serialized per run")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per case; the fastest is reported")
+
+    def handle(self, *args, **options):
+        results = serializer_benchmark(count=options['count'], repeat=options['repeat'])
+
+        self.stdout.write(f"{options['count']} payments, best of {options['repeat']} runs")
+        for case, stats in results.items():
+            self.stdout.write(
+                f"  {case:<12} drf={stats['drf_ms']}ms fast={stats['fast_ms']}ms "
+                f"speedup={stats['speedup']}x identical={stats['identical']}"
+            )
+
+        if not all(stats['identical'] for stats in results.values()):
+            raise CommandError("The fast path output differs from the DRF serializers")
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.outbox import OutboxDispatcher
+
+
+class Command(BaseCommand):
+    help = "Deliver payment status changes from the outbox as signed merchant webhooks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Deliver one batch and exit")
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None, help="Payments delivered in parallel")
+        parser.add_argument('--poll-interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        if not settings.PAYMENT_WEBHOOK_URL:
+            raise CommandError("PAYMENT_WEBHOOK_URL is not set")
+
+        dispatcher = OutboxDispatcher(batch_size=options['batch_size'], workers=options['workers'])
+
+        if options['once']:
+            delivered = dispatcher.dispatch_once()
+            self.stdout.write(f"Delivered {delivered} webhooks ({dispatcher.failed} failed attempts)")
+            return
+
+        self.stdout.write(f"Dispatching outbox events to {dispatcher.url}")
+        try:
+            dispatcher.run_forever(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(f"Stopped after delivering {dispatcher.delivered} webhooks")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from payments.export import EXPORT_FORMATS, iter_export
+from payments.pagination import parse_datetime_param, parse_uuid_param
+
+
+class Command(BaseCommand):
+    help = "Stream every payment (or those updated since a watermark) as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--since', help="Only export payments updated after this ISO datetime")
+        parser.add_argument('--after', help="With --since: id of the last payment exported at that datetime")
+        parser.add_argument('--output', help="File to write to (default: stdout)")
+        parser.add_argument('--chunk-size', type=int, help="Rows fetched per database round trip")
+
+    def handle(self, *args, **options):
+        since = after = None
+        try:
+            if options['since']:
+                since = parse_datetime_param('since', options['since'])
+            if options['after']:
+                after = parse_uuid_param('after', options['after'])
+        except ValidationError as e:
+            raise CommandError(str(next(iter(e.detail.values()))))
+
+        chunks = iter_export(options['format'], since=since, after=after, chunk_size=options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+            self.stderr.write(f"Exported payments to {options['output']}")
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
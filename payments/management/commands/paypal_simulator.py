@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from payments.mocks.paypal_server import LATENCY_DISTRIBUTIONS, PayPalSimulatorServer, SimulatorConfig
+
+
+class Command(BaseCommand):
+    help = "Run a local PayPal stand-in with stateful orders and injectable latency, errors and throttling"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8070)
+        parser.add_argument('--latency', type=float, default=0.0, help="Typical response delay in seconds")
+        parser.add_argument('--jitter', type=float, default=0.0, help="Spread of the delay (see --distribution)")
+        parser.add_argument('--distribution', choices=LATENCY_DISTRIBUTIONS, default='fixed')
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Share of calls answered with a 500")
+        parser.add_argument('--rate-limit', type=float, default=0.0, help="Requests per second before answering 429")
+        parser.add_argument('--token-ttl', type=int, default=32400, help="Access token lifetime in seconds")
+        parser.add_argument('--approve-after', type=float, default=0.0,
+                            help="Seconds until orders count as approved; negative to require /checkoutnow")
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        config = SimulatorConfig(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            distribution=options['distribution'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'],
+            token_ttl=options['token_ttl'],
+            approve_after=options['approve_after'] if options['approve_after'] >= 0 else None,
+            seed=options['seed'],
+        )
+        server = PayPalSimulatorServer((options['host'], options['port']), config)
+        self.stdout.write(f"PayPal simulator listening on {server.url}")
+        self.stdout.write(f"Run the gateway with PAYPAL_API_URL={server.url} PAYPAL_MOCK_RESPONSES=False")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payments.paypal_webhooks import process_pending_events
+
+
+class Command(BaseCommand):
+    help = "Verify received PayPal webhook events and apply them to payments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process one batch and exit")
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--poll-interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        poll_interval = options['poll_interval'] or settings.PAYPAL_WEBHOOK_POLL_INTERVAL
+
+        while True:
+            try:
+                counts = process_pending_events(options['batch_size'])
+            except Exception as e:
+                self.stderr.write(f"Error processing PayPal webhook events: {str(e)}")
+                counts = None
+
+            if options['once']:
+                if counts:
+                    self.stdout.write(
+                        f"Applied {counts['applied']}, ignored {counts['ignored']}, rejected {counts['rejected']} events"
+                    )
+                return
+
+            if not counts or not any(counts.values()):
+                # Nothing left to do right away
+                close_old_connections()
+                time.sleep(poll_interval)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from payments.pagination import parse_datetime_param
+from payments.stats import rebuild_payment_stats
+
+
+class Command(BaseCommand):
+    help = "Recompute the hourly payment statistics rollup from the payments table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default=None, help="Only rebuild hours from this ISO date or datetime on")
+
+    def handle(self, *args, **options):
+        since = options['since']
+        try:
+            since = parse_datetime_param('since', since) if since else None
+        except ValidationError as e:
+            raise CommandError(str(e.detail['since']))
+
+        rows = rebuild_payment_stats(since)
+        self.stdout.write(f"Rebuilt payment statistics: {rows} rollup rows")
@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payments.reconcile import reconcile_payments
+
+
+class Command(BaseCommand):
+    help = "Verify stale pending/processing payments against PayPal and record their current status"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=int, default=None, help="Seconds without an update before a payment is checked")
+        parser.add_argument('--chunk-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None, help="Payments verified in parallel")
+        parser.add_argument('--rate', type=float, default=None, help="Maximum PayPal calls per second (0 for no limit)")
+        parser.add_argument('--interval', type=float, default=None, help="Run every INTERVAL seconds instead of once")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            interval = settings.PAYMENT_RECONCILE_INTERVAL
+
+        while True:
+            stats = reconcile_payments(
+                stale_after=options['stale_after'],
+                chunk_size=options['chunk_size'],
+                workers=options['workers'],
+                rate=options['rate'],
+            )
+            self.stdout.write(f"Reconciled payments: {stats.summary()}")
+
+            if not interval:
+                return
+            close_old_connections()
+            time.sleep(interval)
@@ -0,0 +1,158 @@
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+# (see gunicorn.conf.py) and /metrics sums them across workers.
+
+REQUESTS = Counter(
+    'payment_http_requests_total', "HTTP requests handled, per view", ['view', 'method', 'status']
+)
+REQUEST_LATENCY = Histogram(
+    'payment_http_request_duration_seconds', "HTTP request latency, per view", ['view', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+PAYPAL_LATENCY = Histogram(
+    'paypal_request_duration_seconds', "PayPal API call latency, per operation", ['operation'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+PAYPAL_ERRORS = Counter(
+    'paypal_request_errors_total', "PayPal API calls that failed or returned an error status", ['operation']
+)
+PAYPAL_RETRIES = Counter(
+    'paypal_request_retries_total', "PayPal API calls retried after a timeout, connection error or 429/5xx", ['operation']
+)
+PAYPAL_REJECTED = Counter(
+    'paypal_requests_rejected_total', "PayPal API calls refused by the circuit breaker or concurrency limit", ['operation']
+)
+TOKEN_CACHE_REQUESTS = Counter(
+    'paypal_token_cache_requests_total', "OAuth token lookups, by whether the cached token was used", ['result']
+)
+VERIFICATIONS_IN_FLIGHT = Gauge(
+    'payment_verifications_in_flight', "Background PayPal verifications currently running",
+    multiprocess_mode='livesum',
+)
+
+# http_client endpoint -> operation label
+PAYPAL_OPERATIONS = {
+    'token': 'get_access_token',
+}
+
+
+def paypal_operation(endpoint):
+    return PAYPAL_OPERATIONS.get(endpoint, endpoint)
+
+
+def observe_paypal_call(endpoint, seconds, error):
+    operation = paypal_operation(endpoint)
+    PAYPAL_LATENCY.labels(operation).observe(seconds)
+    if error:
+        PAYPAL_ERRORS.labels(operation).inc()
+
+
+STATUS_COUNTS_KEY = 'metrics:payment-status-counts'
+
+
+def payment_status_counts():
+    """
+    Payments per status, summed from the hourly statistics rather than the
+    payments table. Kept in the shared cache for PAYMENT_METRICS_STATUS_TTL
+    seconds, so scrapes within that window reuse one count whichever worker serves them.
+    """
+    from django.core.cache import caches
+    from django.db.models import Sum
+    from payments.models import PaymentStatsHour
+
+    cache = caches[settings.PAYMENT_CACHE_ALIAS]
+    counts = cache.get(STATUS_COUNTS_KEY)
+    if counts is None:
+        counts = dict(PaymentStatsHour.objects.values_list('status').annotate(total=Sum('count')).order_by())
+        cache.set(STATUS_COUNTS_KEY, counts, settings.PAYMENT_METRICS_STATUS_TTL)
+    return counts
+
+
+class PaymentStatusCollector:
+    """Payments per status, from payment_status_counts()"""
+
+    def collect(self):
+        from payments.models import Payment
+
+        gauge = GaugeMetricFamily('payments', "Payments per status", labels=['status'])
+        counts = payment_status_counts()
+        for status, _ in Payment.PAYMENT_STATUS_CHOICES:
+            gauge.add_metric([status], counts.get(status) or 0)
+        yield gauge
+
+
+class _ProcessMetrics:
+    """This process's metrics, when not running with PROMETHEUS_MULTIPROC_DIR"""
+
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def metrics_registry():
+    """Registry for one scrape: every worker's samples plus the database gauges"""
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        MultiProcessCollector(registry)
+    else:
+        registry.register(_ProcessMetrics())
+    registry.register(PaymentStatusCollector())
+    return registry
+
+
+def metrics_view(request):
+    return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """
+    Request count and latency per view; removed at startup unless
+    PAYMENT_METRICS is on. Runs natively under ASGI so async views are not
+    pushed through a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PAYMENT_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, started)
+        return response
+
+    def observe(self, request, response, started):
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        REQUEST_LATENCY.labels(view, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(view, request.method, str(response.status_code)).inc()
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='verify_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='verify_due_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_payment_updated_index'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='payment',
+            name='reference_id',
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='gateway_order_id',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:21
+
+import logging
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+
+def backfill_gateway_order_id(apps, schema_editor):
+    """Copy the PayPal order id out of gateway_response, one batch per transaction"""
+    Payment = apps.get_model('payments', 'Payment')
+
+    # Order ids are unique; older rows can share one (e.g. the static DEBUG mock)
+    seen = set(
+        Payment.objects.filter(gateway_order_id__isnull=False).values_list('gateway_order_id', flat=True)
+    )
+    last_pk = None
+
+    while True:
+        queryset = Payment.objects.filter(gateway_order_id__isnull=True, gateway_response__isnull=False)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        batch = list(queryset.order_by('pk').only('pk', 'gateway_response')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        updates = []
+        for payment in batch:
+            response = payment.gateway_response
+            order_id = response.get('id') if isinstance(response, dict) else None
+            if not order_id:
+                continue
+            if order_id in seen:
+                logger.warning(f"Skipping duplicate PayPal order id {order_id} on payment {payment.pk}")
+                continue
+            seen.add(order_id)
+            payment.gateway_order_id = order_id
+            updates.append(payment)
+
+        Payment.objects.bulk_update(updates, ['gateway_order_id'])
+
+
+class Migration(migrations.Migration):
+
+    # Commit each batch on its own instead of holding one long transaction
+    atomic = False
+
+    dependencies = [
+        ('payments', '0005_payment_gateway_order_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_gateway_order_id, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_paypalwebhookevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'updated_at', 'id'], name='payment_status_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_payment_status_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='gateway_status',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.CreateModel(
+            name='PaymentGatewayEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('order', 'Order created'), ('capture', 'Capture'), ('verify', 'Verification'), ('reconcile', 'Reconciliation'), ('legacy', 'Copied from Payment.gateway_response')], max_length=20)),
+                ('provider_status', models.CharField(blank=True, default='', max_length=32)),
+                ('body', models.BinaryField()),
+                ('compressed', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gateway_events', to='payments.payment')),
+            ],
+            options={
+                'get_latest_by': ['created_at', 'id'],
+                'indexes': [models.Index(fields=['payment', 'created_at', 'id'], name='gateway_event_payment_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:55
+
+import json
+import zlib
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def approval_link(response):
+    for link in response.get('links') or ():
+        if isinstance(link, dict) and link.get('rel') == 'approve':
+            return link.get('href')
+    return None
+
+
+def move_gateway_response(apps, schema_editor):
+    """
+    Copy each gateway_response into a compressed PaymentGatewayEvent, one
+    batch per transaction. Payments copied by an interrupted earlier run are
+    skipped, so running it again does not duplicate their events.
+    """
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentGatewayEvent = apps.get_model('payments', 'PaymentGatewayEvent')
+    last_pk = None
+
+    while True:
+        queryset = Payment.objects.filter(gateway_response__isnull=False).exclude(gateway_events__kind='legacy')
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        batch = list(queryset.order_by('pk').only('pk', 'gateway_response', 'approval_url')[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        events = []
+        for payment in batch:
+            response = payment.gateway_response
+            provider_status = response.get('status') if isinstance(response, dict) else None
+            events.append(PaymentGatewayEvent(
+                payment_id=payment.pk,
+                kind='legacy',
+                provider_status=provider_status or '',
+                body=zlib.compress(json.dumps(response).encode()),
+                compressed=True,
+            ))
+            payment.gateway_status = provider_status
+            if isinstance(response, dict) and not payment.approval_url:
+                payment.approval_url = approval_link(response)
+
+        with transaction.atomic():
+            PaymentGatewayEvent.objects.bulk_create(events)
+            Payment.objects.bulk_update(batch, ['gateway_status', 'approval_url'])
+
+
+def restore_gateway_response(apps, schema_editor):
+    """Put each payment's latest payload back into gateway_response"""
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentGatewayEvent = apps.get_model('payments', 'PaymentGatewayEvent')
+
+    latest = {}
+    for event in PaymentGatewayEvent.objects.order_by('payment_id', 'created_at', 'id').iterator(chunk_size=BATCH_SIZE):
+        body = bytes(event.body)
+        latest[event.payment_id] = json.loads(zlib.decompress(body) if event.compressed else body)
+
+    payment_ids = list(latest)
+    for start in range(0, len(payment_ids), BATCH_SIZE):
+        batch = list(Payment.objects.filter(pk__in=payment_ids[start:start + BATCH_SIZE]).only('pk'))
+        for payment in batch:
+            payment.gateway_response = latest[payment.pk]
+        Payment.objects.bulk_update(batch, ['gateway_response'])
+
+
+class Migration(migrations.Migration):
+
+    # Commit each batch on its own instead of holding one long transaction
+    atomic = False
+
+    dependencies = [
+        ('payments', '0011_paymentgatewayevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_gateway_response, restore_gateway_response),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0012_move_gateway_response'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='payment',
+            name='gateway_response',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 00:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0013_remove_payment_gateway_response'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentStatsHour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('currency', models.CharField(max_length=3)),
+                ('status', models.CharField(max_length=20)),
+                ('count', models.BigIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=18)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('hour', 'currency', 'status'), name='payment_stats_hour_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.7 on 2026-10-18 01:05
+
+import datetime
+
+from django.db import migrations
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncHour
+
+
+def backfill_payment_stats(apps, schema_editor):
+    """Seed the hourly rollup from the existing payments"""
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentStatsHour = apps.get_model('payments', 'PaymentStatsHour')
+
+    rows = (
+        Payment.objects.annotate(bucket=TruncHour('created_at', tzinfo=datetime.timezone.utc))
+        .values('bucket', 'currency', 'status')
+        .annotate(total_count=Count('id'), total_amount=Sum('amount'))
+        .order_by()
+    )
+    PaymentStatsHour.objects.bulk_create(
+        [
+            PaymentStatsHour(
+                hour=row['bucket'],
+                currency=row['currency'],
+                status=row['status'],
+                count=row['total_count'],
+                amount=row['total_amount'],
+            )
+            for row in rows
+        ],
+        batch_size=1000,
+    )
+
+
+def clear_payment_stats(apps, schema_editor):
+    apps.get_model('payments', 'PaymentStatsHour').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0014_paymentstatshour'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_payment_stats, clear_payment_stats),
+    ]
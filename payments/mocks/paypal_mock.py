@@ -1,42 +1,60 @@
 import responses
 import json
+import re
+import uuid
+from urllib.parse import urlparse
 
-def mock_paypal_api():
-    """Mock PayPal API endpoints."""
-    # Mock the token endpoint
-    responses.add(
-        responses.POST,
-        "https://api-m.sandbox.paypal.com/v1/oauth2/token",
-        json={"access_token": "mock_access_token", "token_type": "Bearer"},
-        status=200
-    )
-
-    # Mock the create order endpoint
-    responses.add(
-        responses.POST,
-        "https://api-m.sandbox.paypal.com/v2/checkout/orders",
-        json={
-            "id": "mock_order_id",
+PAYPAL_SANDBOX_URL = "https://api-m.sandbox.paypal.com"
+
+MOCK_TOKEN = {"access_token": "mock_access_token", "token_type": "Bearer"}
+
+ORDER_PATH = re.compile(r"^/v2/checkout/orders/(?P<order_id>[^/]+)(?P<capture>/capture)?$")
+
+
+def mock_response(method, path):
+    """Return (status code, body) for a mocked PayPal request."""
+    if method == "POST" and path == "/v1/oauth2/token":
+        return 200, MOCK_TOKEN
+
+    if method == "POST" and path == "/v2/checkout/orders":
+        # Every order gets its own id, like the real API
+        return 201, {
+            "id": f"MOCK{uuid.uuid4().hex[:13].upper()}",
             "status": "CREATED",
             "links": [
                 {"href": "https://approval-url.com", "rel": "approve"}
             ]
-        },
-        status=201
-    )
-
-    # Mock the capture payment endpoint
-    responses.add(
-        responses.POST,
-        "https://api-m.sandbox.paypal.com/v2/checkout/orders/mock_order_id/capture",
-        json={"status": "COMPLETED"},
-        status=201
-    )
-
-    # Mock the verify payment endpoint
-    responses.add(
-        responses.GET,
-        "https://api-m.sandbox.paypal.com/v2/checkout/orders/mock_order_id",
-        json={"id": "mock_order_id", "status": "COMPLETED"},
-        status=200
-    )
+        }
+
+    if method == "POST" and path == "/v1/notifications/verify-webhook-signature":
+        return 200, {"verification_status": "SUCCESS"}
+
+    match = ORDER_PATH.match(path)
+    if match and method == "POST" and match.group("capture"):
+        return 201, {"id": match.group("order_id"), "status": "COMPLETED"}
+    if match and method == "GET" and not match.group("capture"):
+        return 200, {"id": match.group("order_id"), "status": "COMPLETED"}
+
+    return 404, {"name": "RESOURCE_NOT_FOUND"}
+
+
+def mock_paypal_api():
+    """Mock PayPal API endpoints."""
+    def callback(request):
+        status, body = mock_response(request.method, urlparse(request.url).path)
+        return status, {}, json.dumps(body)
+
+    url = re.compile(rf"{re.escape(PAYPAL_SANDBOX_URL)}/.*")
+    for method in (responses.GET, responses.POST):
+        responses.add_callback(method, url, callback=callback, content_type="application/json")
+
+
+def mock_paypal_transport():
+    """Serve the same PayPal stubs to httpx clients (used by the async service)."""
+    import httpx
+
+    def handler(request):
+        status, body = mock_response(request.method, request.url.path)
+        return httpx.Response(status, json=body)
+
+    return httpx.MockTransport(handler)
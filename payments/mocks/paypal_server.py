@@ -0,0 +1,298 @@
+"""
+Local PayPal stand-in for load testing and benchmarks.
+
+Unlike the `responses` stubs in paypal_mock.py this is a real HTTP server:
+orders are stateful (CREATED -> APPROVED -> COMPLETED), access tokens
+expire, and latency, server errors and 429 throttling can be injected.
+Point the gateway at it with PAYPAL_API_URL=http://127.0.0.1:8070 and
+PAYPAL_MOCK_RESPONSES=False.
+"""
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from payments.mocks.paypal_mock import ORDER_PATH
+
+LATENCY_DISTRIBUTIONS = ('fixed', 'uniform', 'normal', 'lognormal')
+
+
+class SimulatorConfig:
+    """
+    latency is the typical delay in seconds. jitter is its spread: +/- seconds
+    for 'uniform', the standard deviation for 'normal', and sigma of the
+    underlying normal for 'lognormal' (where latency is the median).
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, distribution='fixed', error_rate=0.0,
+                 rate_limit=0.0, token_ttl=32400, approve_after=0.0, seed=None):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {distribution!r}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        # Share of API calls answered with a 500
+        self.error_rate = error_rate
+        # Requests per second before answering 429; 0 for no limit
+        self.rate_limit = rate_limit
+        self.token_ttl = token_ttl
+        # Seconds after creation an order counts as approved by the buyer;
+        # None leaves approval to the /checkoutnow link
+        self.approve_after = approve_after
+        self.random = random.Random(seed)
+
+    def sample_latency(self):
+        if self.distribution == 'uniform':
+            delay = self.random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+        elif self.distribution == 'normal':
+            delay = self.random.gauss(self.latency, self.jitter)
+        elif self.distribution == 'lognormal' and self.latency > 0:
+            delay = self.random.lognormvariate(math.log(self.latency), self.jitter)
+        else:
+            delay = self.latency
+        return max(delay, 0.0)
+
+
+class PayPalSimulator:
+    """State shared by every request thread"""
+
+    def __init__(self, config=None):
+        self.config = config or SimulatorConfig()
+        self.lock = threading.Lock()
+        self.orders = {}
+        self.tokens = {}
+        self.calls = {}
+        self._bucket_at = time.monotonic()
+        self._bucket = self.config.rate_limit
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def throttled(self):
+        """Token bucket refilled at rate_limit per second"""
+        rate = self.config.rate_limit
+        if not rate:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self._bucket = min(rate, self._bucket + (now - self._bucket_at) * rate)
+            self._bucket_at = now
+            if self._bucket < 1:
+                return True
+            self._bucket -= 1
+            return False
+
+    def issue_token(self):
+        token = f"A21AA{uuid.uuid4().hex}"
+        with self.lock:
+            self.tokens[token] = time.monotonic() + self.config.token_ttl
+        return {"access_token": token, "token_type": "Bearer", "expires_in": self.config.token_ttl}
+
+    def token_valid(self, authorization):
+        if not authorization or not authorization.startswith("Bearer "):
+            return False
+        with self.lock:
+            expires_at = self.tokens.get(authorization[len("Bearer "):])
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def create_order(self, body, base_url):
+        order_id = uuid.uuid4().hex[:17].upper()
+        order = {
+            "id": order_id,
+            "status": "CREATED",
+            "intent": body.get("intent", "CAPTURE"),
+            "purchase_units": body.get("purchase_units", []),
+            "create_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "links": [
+                {"href": f"{base_url}/v2/checkout/orders/{order_id}", "rel": "self", "method": "GET"},
+                {"href": f"{base_url}/checkoutnow?token={order_id}", "rel": "approve", "method": "GET"},
+                {"href": f"{base_url}/v2/checkout/orders/{order_id}/capture", "rel": "capture", "method": "POST"},
+            ],
+        }
+        with self.lock:
+            self.orders[order_id] = (order, time.monotonic())
+        return order
+
+    def get_order(self, order_id):
+        """The order with buyer approval applied, or None"""
+        with self.lock:
+            entry = self.orders.get(order_id)
+            if entry is None:
+                return None
+            order, created = entry
+            approve_after = self.config.approve_after
+            if order["status"] == "CREATED" and approve_after is not None and time.monotonic() - created >= approve_after:
+                order["status"] = "APPROVED"
+            return dict(order)
+
+    def approve(self, order_id):
+        with self.lock:
+            entry = self.orders.get(order_id)
+            if entry is None:
+                return False
+            if entry[0]["status"] == "CREATED":
+                entry[0]["status"] = "APPROVED"
+            return True
+
+    def capture(self, order_id):
+        """Returns (status code, body)"""
+        order = self.get_order(order_id)
+        if order is None:
+            return 404, {"name": "RESOURCE_NOT_FOUND"}
+        with self.lock:
+            stored = self.orders[order_id][0]
+            if stored["status"] == "COMPLETED":
+                return 422, {"name": "UNPROCESSABLE_ENTITY", "details": [{"issue": "ORDER_ALREADY_CAPTURED"}]}
+            if stored["status"] != "APPROVED":
+                return 422, {"name": "UNPROCESSABLE_ENTITY", "details": [{"issue": "ORDER_NOT_APPROVED"}]}
+            stored["status"] = "COMPLETED"
+            return 201, dict(stored)
+
+    def stats(self):
+        with self.lock:
+            statuses = {}
+            for order, _ in self.orders.values():
+                statuses[order["status"]] = statuses.get(order["status"], 0) + 1
+            return {"calls": dict(self.calls), "orders": statuses, "tokens": len(self.tokens)}
+
+    def reset(self):
+        with self.lock:
+            self.orders.clear()
+            self.tokens.clear()
+            self.calls.clear()
+
+
+class PayPalSimulatorHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the gateway's connection pool behaves as it would against PayPal
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def simulator(self):
+        return self.server.simulator
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/json") and raw:
+            return json.loads(raw)
+        return {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        body = self.read_body() if method == "POST" else {}
+
+        # Simulator controls are never delayed or failed
+        if url.path == "/__simulator/stats":
+            return self.send_json(200, self.simulator.stats())
+        if url.path == "/__simulator/reset" and method == "POST":
+            self.simulator.reset()
+            return self.send_json(200, {"status": "reset"})
+
+        endpoint = self.endpoint(method, url.path)
+        self.simulator.count(endpoint)
+
+        config = self.simulator.config
+        if self.simulator.throttled():
+            return self.send_json(429, {"name": "RATE_LIMIT_REACHED"}, {"Retry-After": "1"})
+        time.sleep(config.sample_latency())
+        if config.error_rate and config.random.random() < config.error_rate:
+            return self.send_json(500, {"name": "INTERNAL_SERVICE_ERROR", "debug_id": uuid.uuid4().hex[:13]})
+
+        status, response = self.respond(method, url, body)
+        self.send_json(status, response)
+
+    @staticmethod
+    def endpoint(method, path):
+        if path == "/v1/oauth2/token":
+            return "token"
+        if path == "/v2/checkout/orders":
+            return "create_order"
+        match = ORDER_PATH.match(path)
+        if match:
+            return "capture_payment" if match.group("capture") else "get_order"
+        if path == "/v1/notifications/verify-webhook-signature":
+            return "verify_webhook"
+        if path == "/checkoutnow":
+            return "checkout"
+        return "unknown"
+
+    def respond(self, method, url, body):
+        if method == "POST" and url.path == "/v1/oauth2/token":
+            if not self.headers.get("Authorization", "").startswith("Basic "):
+                return 401, {"error": "invalid_client"}
+            return 200, self.simulator.issue_token()
+
+        if method == "GET" and url.path == "/checkoutnow":
+            # Stands in for the buyer approving the order on PayPal
+            order_id = parse_qs(url.query).get("token", [""])[0]
+            if not self.simulator.approve(order_id):
+                return 404, {"name": "RESOURCE_NOT_FOUND"}
+            return 200, {"id": order_id, "status": "APPROVED"}
+
+        if not self.simulator.token_valid(self.headers.get("Authorization")):
+            return 401, {"error": "invalid_token", "error_description": "Token signature verification failed"}
+
+        if method == "POST" and url.path == "/v2/checkout/orders":
+            host = self.headers.get("Host") or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+            return 201, self.simulator.create_order(body, f"http://{host}")
+
+        if method == "POST" and url.path == "/v1/notifications/verify-webhook-signature":
+            return 200, {"verification_status": "SUCCESS"}
+
+        match = ORDER_PATH.match(url.path)
+        if match and method == "POST" and match.group("capture"):
+            return self.simulator.capture(match.group("order_id"))
+        if match and method == "GET" and not match.group("capture"):
+            order = self.simulator.get_order(match.group("order_id"))
+            if order is None:
+                return 404, {"name": "RESOURCE_NOT_FOUND"}
+            return 200, order
+
+        return 404, {"name": "RESOURCE_NOT_FOUND"}
+
+
+class PayPalSimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 refuses connections under load
+    request_queue_size = 1024
+
+    def __init__(self, address, config=None):
+        super().__init__(address, PayPalSimulatorHandler)
+        self.simulator = PayPalSimulator(config)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_simulator(host="127.0.0.1", port=0, config=None):
+    """Serve the simulator on a background thread; port 0 picks a free port. Call shutdown() when done."""
+    server = PayPalSimulatorServer((host, port), config)
+    thread = threading.Thread(target=server.serve_forever, name="paypal-simulator", daemon=True)
+    thread.start()
+    return server
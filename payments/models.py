@@ -1,5 +1,16 @@
-from django.db import models
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
+import datetime
 import uuid
+import zlib
+from decimal import Decimal
+import orjson
+from asgiref.sync import sync_to_async
+from payments.cache import invalidate_payment
+from payments.status_stream import notify_status_change
 
 class Payment(models.Model):
     PAYMENT_STATUS_CHOICES = [
@@ -10,16 +21,436 @@ class Payment(models.Model):
         ('refunded', 'Refunded'),
     ]
     
+    # Stored statuses a payment may move to each status from; a captured payment is never failed or reopened
+    STATUS_TRANSITIONS = {
+        'pending': ('pending',),
+        'processing': ('pending', 'processing'),
+        'completed': ('pending', 'processing', 'failed'),
+        'failed': ('pending', 'processing'),
+        'refunded': ('completed',),
+    }
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     customer_name = models.CharField(max_length=100)
     customer_email = models.EmailField()
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='USD')
     status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default='pending')
-    gateway_response = models.JSONField(blank=True, null=True)
+    # PayPal order id, the token PayPal passes back to the success/cancel callbacks
+    gateway_order_id = models.CharField(max_length=64, unique=True, blank=True, null=True)
+    # Order status last reported by PayPal; the raw payloads are PaymentGatewayEvents
+    gateway_status = models.CharField(max_length=32, blank=True, null=True)
     approval_url = models.URLField(blank=True, null=True)
+    # create_time of the last PayPal webhook event applied, to ignore older ones delivered late
+    gateway_event_at = models.DateTimeField(blank=True, null=True)
+    # When the background verification is next due; cleared once it is done
+    verify_due_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    verify_attempts = models.PositiveSmallIntegerField(default=0)
+    # Why order creation failed: 'paypal_unavailable' (an outage; the client retries with a new payment) or 'order_rejected'
+    failure_reason = models.CharField(max_length=32, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Keyset pagination over (created_at, id), optionally narrowed by a filter column
+            models.Index(fields=['created_at', 'id'], name='payment_created_id_idx'),
+            models.Index(fields=['status', 'created_at', 'id'], name='payment_status_created_idx'),
+            models.Index(fields=['currency', 'created_at', 'id'], name='payment_currency_created_idx'),
+            models.Index(fields=['customer_email', 'created_at', 'id'], name='payment_email_created_idx'),
+            # Incremental exports since an updated_at watermark
+            models.Index(fields=['updated_at', 'id'], name='payment_updated_id_idx'),
+            # Reconciliation sweep over stale non-terminal payments
+            models.Index(fields=['status', 'updated_at', 'id'], name='payment_status_updated_idx'),
+        ]
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Status as stored, to detect changes on save
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+    
+    def save(self, *args, **kwargs):
+        previous_status = getattr(self, '_loaded_status', None)
+        update_fields = kwargs.get('update_fields')
+        status_saved = update_fields is None or 'status' in update_fields
+        adding = self._state.adding
+        
+        # The outbox event and statistics commit or roll back together with the status change
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                PaymentStatsHour.record([(self, None, self.status)])
+            elif status_saved and previous_status is not None and previous_status != self.status:
+                OutboxEvent.for_status_change(self, previous_status).save()
+                notify_status_change(self.pk, self.status)
+                PaymentStatsHour.record([(self, previous_status, self.status)])
+        if status_saved:
+            self._loaded_status = self.status
+        
+        # Drop the cached read now, and again once the write is visible to other connections
+        invalidate_payment(self.pk)
+        transaction.on_commit(lambda: invalidate_payment(self.pk))
+    
+    def transition(self, status, update_fields=(), allowed_from=None):
+        """
+        Move the payment to `status` with one conditional UPDATE that writes
+        only status, updated_at and `update_fields` (taken from the instance),
+        and only while the stored status is still the one this instance was
+        loaded with and one of `allowed_from` (STATUS_TRANSITIONS by default).
+        If another writer changed the status in between, the stored status is
+        re-read and the transition retried while it is still allowed.
+        Returns whether the payment moved; if not, the instance's status is
+        set to the stored one.
+        """
+        allowed_from = self.STATUS_TRANSITIONS[status] if allowed_from is None else allowed_from
+        values = {name: getattr(self, name) for name in update_fields if name not in ('status', 'updated_at')}
+        previous_status = getattr(self, '_loaded_status', None) or self._stored_status()
+        now = timezone.now()
+        
+        moved = False
+        while not moved and previous_status in allowed_from:
+            # The outbox event and statistics commit or roll back together with the status change
+            with transaction.atomic():
+                moved = Payment.objects.filter(pk=self.pk, status=previous_status).update(
+                    status=status, updated_at=now, **values
+                ) == 1
+                if moved:
+                    self.status = status
+                    self.updated_at = now
+                    if previous_status != status:
+                        OutboxEvent.for_status_change(self, previous_status).save()
+                        notify_status_change(self.pk, status)
+                        PaymentStatsHour.record([(self, previous_status, status)])
+            if not moved:
+                previous_status = self._stored_status()
+        
+        if not moved:
+            if previous_status is not None:
+                self.status = self._loaded_status = previous_status
+            return False
+        
+        self._loaded_status = status
+        invalidate_payment(self.pk)
+        transaction.on_commit(lambda: invalidate_payment(self.pk))
+        return True
+    
+    async def atransition(self, status, update_fields=(), allowed_from=None):
+        return await sync_to_async(self.transition)(status, update_fields, allowed_from)
+    
+    def _stored_status(self):
+        return Payment.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+    
+    def delete(self, *args, **kwargs):
+        payment_id = self.pk
+        stored_status = getattr(self, '_loaded_status', None) or self.status
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            PaymentStatsHour.record([(self, stored_status, None)])
+        invalidate_payment(payment_id)
+        return result
+    
     def __str__(self):
         return f"PAY-{str(self.id)[:8]} - {self.customer_name} - {self.amount} {self.currency}"
+
+
+def bulk_update_payments(payments, fields, previous_statuses):
+    """
+    bulk_update for payments that keeps what Payment.save guarantees: an
+    outbox event and a status notification per status change in the same
+    transaction, and cache invalidation. previous_statuses holds each payment's stored status.
+    """
+    now = timezone.now()
+    events = []
+    changed = []
+    for payment, previous_status in zip(payments, previous_statuses):
+        payment.updated_at = now
+        if payment.status != previous_status:
+            events.append(OutboxEvent.for_status_change(payment, previous_status))
+            changed.append(payment)
+    
+    with transaction.atomic():
+        Payment.objects.bulk_update(payments, list(fields) + ['updated_at'])
+        OutboxEvent.objects.bulk_create(events)
+        PaymentStatsHour.record([
+            (payment, previous_status, payment.status)
+            for payment, previous_status in zip(payments, previous_statuses)
+            if payment.status != previous_status
+        ])
+        for payment in changed:
+            notify_status_change(payment.pk, payment.status)
+        payment_ids = [payment.pk for payment in payments]
+        transaction.on_commit(lambda: [invalidate_payment(payment_id) for payment_id in payment_ids])
+    
+    for payment in payments:
+        payment._loaded_status = payment.status
+        invalidate_payment(payment.pk)
+
+
+def bulk_create_payments(payments):
+    """bulk_create for payments that counts them in the hourly statistics in the same transaction"""
+    with transaction.atomic():
+        payments = Payment.objects.bulk_create(payments)
+        PaymentStatsHour.record([(payment, None, payment.status) for payment in payments])
+    return payments
+
+
+def bulk_delete_payments(queryset):
+    """QuerySet.delete for payments that takes them out of the hourly statistics; returns how many were deleted"""
+    with transaction.atomic():
+        payments = list(queryset.select_for_update().only('id', 'created_at', 'currency', 'amount', 'status'))
+        Payment.objects.filter(pk__in=[payment.pk for payment in payments]).delete()
+        PaymentStatsHour.record([(payment, payment.status, None) for payment in payments])
+    for payment in payments:
+        invalidate_payment(payment.pk)
+    return len(payments)
+
+
+class IdempotencyKey(models.Model):
+    """Response stored for an Idempotency-Key so retried requests can be replayed"""
+    STATE_CHOICES = [
+        ('in_progress', 'In progress'),
+        ('completed', 'Completed'),
+    ]
+    
+    key = models.CharField(max_length=255, unique=True)
+    # Hash of the request the key was first used with
+    fingerprint = models.CharField(max_length=64)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='in_progress')
+    response_status = models.PositiveSmallIntegerField(blank=True, null=True)
+    response_body = models.JSONField(blank=True, null=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    # Lease of the request processing the key; an in-progress key past it can be taken over
+    locked_until = models.DateTimeField(blank=True, null=True)
+    
+    def __str__(self):
+        return f"{self.key} - {self.state}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Payment status change waiting to be delivered as a merchant webhook.
+    Written in the same transaction as the change itself, so no change is
+    lost and none is announced that did not commit.
+    """
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='outbox_events')
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When delivery is next due; cleared when the dispatcher gives up
+    next_attempt_at = models.DateTimeField(blank=True, null=True, default=timezone.now)
+    delivered_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, default='')
+    
+    class Meta:
+        indexes = [
+            # Dispatcher scan over undelivered events
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                condition=models.Q(delivered_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+            # Per-payment delivery order
+            models.Index(fields=['payment', 'id'], name='outbox_payment_id_idx'),
+        ]
+    
+    @classmethod
+    def for_status_change(cls, payment, previous_status):
+        """Unsaved event announcing that `payment` moved from previous_status to its current status"""
+        return cls(
+            payment_id=payment.pk,
+            event_type=f"payment.{payment.status}",
+            payload={
+                "payment_id": payment.pk,
+                "status": payment.status,
+                "previous_status": previous_status,
+                "amount": payment.amount,
+                "currency": payment.currency,
+                "customer_email": payment.customer_email,
+                "gateway_order_id": payment.gateway_order_id,
+                "failure_reason": payment.failure_reason,
+                "updated_at": payment.updated_at,
+            },
+        )
+    
+    def __str__(self):
+        return f"{self.event_type} - PAY-{str(self.payment_id)[:8]}"
+
+
+class PayPalWebhookEvent(models.Model):
+    """
+    Webhook event received from PayPal, stored as delivered and applied to
+    its payment later by `manage.py process_webhook_events`.
+    """
+    STATE_CHOICES = [
+        ('received', 'Received'),
+        ('applied', 'Applied'),
+        ('ignored', 'Ignored'),
+        ('rejected', 'Rejected'),
+    ]
+    
+    # PayPal's event id; a redelivered event is stored once
+    event_id = models.CharField(max_length=64, unique=True)
+    event_type = models.CharField(max_length=100)
+    # PayPal order the event is about
+    gateway_order_id = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    payload = models.JSONField()
+    # PAYPAL-TRANSMISSION-* headers, needed to verify the signature
+    headers = models.JSONField(default=dict)
+    event_time = models.DateTimeField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='received')
+    processed_at = models.DateTimeField(blank=True, null=True)
+    # Signature checks that failed to reach PayPal, and when the next one is due (null: right away)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        indexes = [
+            # Worker scan over events not yet processed
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='paypal_event_pending_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_id} - {self.event_type} - {self.state}"
+
+
+def encode_gateway_payload(payload):
+    """(body, compressed) for a provider payload; zlib only when enabled and worth it"""
+    body = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    if settings.PAYMENT_GATEWAY_EVENT_COMPRESSION and len(body) >= settings.PAYMENT_GATEWAY_EVENT_COMPRESS_MIN_BYTES:
+        packed = zlib.compress(body, settings.PAYMENT_GATEWAY_EVENT_COMPRESSION_LEVEL)
+        if len(packed) < len(body):
+            return packed, True
+    return body, False
+
+
+def decode_gateway_payload(body, compressed):
+    body = bytes(body)
+    return orjson.loads(zlib.decompress(body) if compressed else body)
+
+
+class PaymentGatewayEvent(models.Model):
+    """
+    Raw PayPal payload received for a payment, append-only. Kept out of the
+    payments table so its rows stay narrow and every payload PayPal ever
+    returned is kept; read one with `payment.gateway_events.latest()`.
+    """
+    KIND_CHOICES = [
+        ('order', 'Order created'),
+        ('capture', 'Capture'),
+        ('verify', 'Verification'),
+        ('reconcile', 'Reconciliation'),
+        ('legacy', 'Copied from Payment.gateway_response'),
+    ]
+    
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='gateway_events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # PayPal's order status in the payload, if any
+    provider_status = models.CharField(max_length=32, blank=True, default='')
+    # JSON, zlib-compressed when `compressed`
+    body = models.BinaryField()
+    compressed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        get_latest_by = ['created_at', 'id']
+        indexes = [
+            # A payment's history, newest first
+            models.Index(fields=['payment', 'created_at', 'id'], name='gateway_event_payment_idx'),
+        ]
+    
+    @classmethod
+    def for_payload(cls, payment, kind, payload):
+        """Unsaved event holding `payload` as received for `payment`"""
+        body, compressed = encode_gateway_payload(payload)
+        provider_status = payload.get("status", "") if isinstance(payload, dict) else ""
+        return cls(
+            payment_id=payment.pk,
+            kind=kind,
+            provider_status=provider_status or "",
+            body=body,
+            compressed=compressed,
+        )
+    
+    @classmethod
+    def record(cls, payment, kind, payload):
+        event = cls.for_payload(payment, kind, payload)
+        event.save()
+        return event
+    
+    @classmethod
+    async def arecord(cls, payment, kind, payload):
+        event = cls.for_payload(payment, kind, payload)
+        await event.asave()
+        return event
+    
+    @property
+    def payload(self):
+        return decode_gateway_payload(self.body, self.compressed)
+    
+    def __str__(self):
+        return f"{self.kind} - PAY-{str(self.payment_id)[:8]} - {self.provider_status}"
+
+
+def stats_hour(created_at):
+    """The UTC hour a payment is counted under"""
+    return created_at.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class PaymentStatsHour(models.Model):
+    """
+    Count and total amount of payments per creation hour (UTC), currency and
+    status. Updated in the same transaction as every payment creation and
+    status change, so statistics never scan the payments table;
+    `manage.py rebuild_payment_stats` recomputes it from the payments.
+    """
+    hour = models.DateTimeField()
+    currency = models.CharField(max_length=3)
+    status = models.CharField(max_length=20)
+    count = models.BigIntegerField(default=0)
+    amount = models.DecimalField(max_digits=18, decimal_places=2, default=0)
+    
+    class Meta:
+        constraints = [
+            # Also the index for range queries over hours
+            models.UniqueConstraint(fields=['hour', 'currency', 'status'], name='payment_stats_hour_key'),
+        ]
+    
+    @classmethod
+    def record(cls, changes):
+        """
+        Apply (payment, previous_status, status) changes; previous_status is
+        None for a new payment and status None for a deleted one. Must run
+        in the transaction that makes the changes.
+        """
+        deltas = {}
+        for payment, previous_status, status in changes:
+            hour = stats_hour(payment.created_at)
+            amount = Decimal(str(payment.amount))
+            for key_status, sign in ((previous_status, -1), (status, 1)):
+                if key_status is None:
+                    continue
+                delta = deltas.setdefault((hour, payment.currency, key_status), [0, Decimal(0)])
+                delta[0] += sign
+                delta[1] += sign * amount
+        
+        # A fixed order, so concurrent transactions lock the rows they share in the same order
+        for (hour, currency, status), (count, amount) in sorted(deltas.items()):
+            if not count and not amount:
+                continue
+            rows = cls.objects.filter(hour=hour, currency=currency, status=status)
+            if rows.update(count=F('count') + count, amount=F('amount') + amount):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(hour=hour, currency=currency, status=status, count=count, amount=amount)
+            except IntegrityError:
+                # Another transaction created the row first
+                rows.update(count=F('count') + count, amount=F('amount') + amount)
+    
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} {self.currency} {self.status}: {self.count}"
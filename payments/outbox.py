@@ -0,0 +1,193 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils import timezone
+
+from payments.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+
+
+def sign_payload(body, timestamp, secret=None):
+    """
+    Signature header value for a webhook body: 't=<timestamp>,v1=<hex>', where
+    v1 is HMAC-SHA256 over '<timestamp>.<body>'. Signing the timestamp lets
+    receivers reject replayed deliveries.
+    """
+    secret = secret if secret is not None else settings.PAYMENT_WEBHOOK_SECRET
+    message = f"{timestamp}.".encode() + body
+    digest = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def delivery_delay(attempts):
+    """Seconds to wait after the `attempts`-th failed delivery"""
+    delay = settings.PAYMENT_OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1))
+    return min(delay, settings.PAYMENT_OUTBOX_MAX_DELAY)
+
+
+def webhook_body(event):
+    return json.dumps({
+        "id": event.pk,
+        "type": event.event_type,
+        "created_at": event.created_at,
+        "data": event.payload,
+    }, cls=DjangoJSONEncoder).encode()
+
+
+class OutboxDispatcher:
+    """
+    Delivers outbox events to PAYMENT_WEBHOOK_URL.
+
+    Events of one payment are delivered strictly in the order they were
+    written: a payment's chain stops at its first failure and resumes with
+    that event once its backoff has passed (an event given up on after
+    max_attempts no longer holds the chain back). Different payments are
+    delivered in parallel on a thread pool. Each event is leased with a
+    conditional UPDATE before it is sent, so several dispatcher processes can
+    share the table.
+    """
+
+    def __init__(self, url=None, secret=None, batch_size=None, workers=None, max_attempts=None, lease=None, session=None):
+        self.url = url or settings.PAYMENT_WEBHOOK_URL
+        self.secret = secret if secret is not None else settings.PAYMENT_WEBHOOK_SECRET
+        self.batch_size = batch_size or settings.PAYMENT_OUTBOX_BATCH_SIZE
+        self.workers = workers or settings.PAYMENT_OUTBOX_WORKERS
+        self.max_attempts = max_attempts or settings.PAYMENT_OUTBOX_MAX_ATTEMPTS
+        self.lease = lease or settings.PAYMENT_OUTBOX_LEASE
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+
+    def due_chains(self, now=None):
+        """Due events grouped per payment, each group in delivery order"""
+        now = now or timezone.now()
+        events = list(
+            OutboxEvent.objects
+            .filter(delivered_at__isnull=True, next_attempt_at__lte=now)
+            .order_by('id')[:self.batch_size]
+        )
+        if not events:
+            return []
+
+        # An earlier event still backing off (or leased elsewhere) holds back the rest of its payment
+        blocked = {}
+        for payment_id, event_id in (
+            OutboxEvent.objects
+            .filter(
+                payment_id__in={event.payment_id for event in events},
+                delivered_at__isnull=True,
+                next_attempt_at__gt=now,
+            )
+            .order_by('id')
+            .values_list('payment_id', 'id')
+        ):
+            blocked.setdefault(payment_id, event_id)
+
+        chains = OrderedDict()
+        for event in events:
+            first_blocked = blocked.get(event.payment_id)
+            if first_blocked is not None and first_blocked < event.pk:
+                continue
+            chains.setdefault(event.payment_id, []).append(event)
+        return list(chains.values())
+
+    def dispatch_once(self, now=None):
+        """Deliver one batch of due events; returns how many were delivered"""
+        chains = self.due_chains(now)
+        if not chains:
+            return 0
+
+        delivered_before = self.delivered
+        if self.workers == 1 or len(chains) == 1:
+            for chain in chains:
+                self._deliver_chain(chain)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(chains)), thread_name_prefix='outbox') as executor:
+                list(executor.map(self._in_worker, chains))
+        return self.delivered - delivered_before
+
+    def run_forever(self, poll_interval=None):
+        poll_interval = poll_interval or settings.PAYMENT_OUTBOX_POLL_INTERVAL
+        while True:
+            try:
+                if self.dispatch_once():
+                    continue  # There may be more due right away
+            except Exception as e:
+                logger.error(f"Outbox dispatch error: {str(e)}")
+            close_old_connections()
+            time.sleep(poll_interval)
+
+    def _in_worker(self, chain):
+        # Worker threads hold their own DB connections; release them between jobs
+        try:
+            self._deliver_chain(chain)
+        finally:
+            close_old_connections()
+
+    def _deliver_chain(self, chain):
+        for event in chain:
+            if not self._deliver(event):
+                break
+
+    def _deliver(self, event):
+        """Send one event; returns True when it was delivered"""
+        lease_until = timezone.now() + timedelta(seconds=self.lease)
+        claimed = OutboxEvent.objects.filter(
+            pk=event.pk, next_attempt_at=event.next_attempt_at, delivered_at__isnull=True
+        ).update(next_attempt_at=lease_until)
+        if not claimed:
+            # Another dispatcher already handled this event
+            return False
+
+        body = webhook_body(event)
+        headers = {
+            "Content-Type": "application/json",
+            "X-Webhook-Id": str(event.pk),
+            "X-Webhook-Event": event.event_type,
+            SIGNATURE_HEADER: sign_payload(body, int(time.time()), self.secret),
+        }
+        attempts = event.attempts + 1
+
+        try:
+            response = self.session.post(self.url, data=body, headers=headers, timeout=settings.PAYMENT_WEBHOOK_TIMEOUT)
+            if not 200 <= response.status_code < 300:
+                raise Exception(f"Webhook endpoint returned {response.status_code}")
+        except Exception as e:
+            self._fail(event, attempts, str(e))
+            return False
+
+        OutboxEvent.objects.filter(pk=event.pk).update(
+            delivered_at=timezone.now(), attempts=attempts, last_error=''
+        )
+        with self._lock:
+            self.delivered += 1
+        return True
+
+    def _fail(self, event, attempts, error):
+        """Back off and retry later, or give up after max_attempts"""
+        with self._lock:
+            self.failed += 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up on webhook {event.pk} ({event.event_type}) after {attempts} attempts: {error}")
+            next_attempt_at = None
+        else:
+            logger.warning(f"Webhook {event.pk} ({event.event_type}) failed, attempt {attempts}: {error}")
+            next_attempt_at = timezone.now() + timedelta(seconds=delivery_delay(attempts))
+        OutboxEvent.objects.filter(pk=event.pk).update(
+            next_attempt_at=next_attempt_at, attempts=attempts, last_error=error[:1000]
+        )
@@ -0,0 +1,138 @@
+import base64
+import json
+import uuid
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from payments.models import Payment
+
+
+def parse_datetime_param(name, value):
+    """Accept an ISO datetime or a plain date (midnight, in the current timezone)"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: f"'{value}' is not a valid date or datetime."})
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_uuid_param(name, value):
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        raise ValidationError({name: f"'{value}' is not a valid UUID."})
+
+
+def filter_payments(queryset, params):
+    """
+    Apply the list filters from the query string:
+    status (comma separated), currency, customer_email, created_after, created_before
+    """
+    statuses = params.get('status')
+    if statuses:
+        queryset = queryset.filter(status__in=statuses.split(','))
+
+    currency = params.get('currency')
+    if currency:
+        queryset = queryset.filter(currency=currency.upper())
+
+    customer_email = params.get('customer_email')
+    if customer_email:
+        queryset = queryset.filter(customer_email=customer_email)
+
+    created_after = params.get('created_after')
+    if created_after:
+        queryset = queryset.filter(created_at__gte=parse_datetime_param('created_after', created_after))
+
+    created_before = params.get('created_before')
+    if created_before:
+        queryset = queryset.filter(created_at__lt=parse_datetime_param('created_before', created_before))
+
+    return queryset
+
+
+def encode_cursor(payment_created_at, payment_id):
+    raw = json.dumps({"c": payment_created_at.isoformat(), "i": str(payment_id)})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = parse_datetime(data["c"])
+        if created_at is None:
+            raise ValueError(cursor)
+        return created_at, uuid.UUID(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise ValidationError({"cursor": "Invalid cursor."})
+
+
+class PaymentKeysetPaginator:
+    """
+    Keyset pagination over (created_at, id), newest first.
+
+    The cursor holds the last row of the previous page, so every page is an
+    index range scan starting right after it, no matter how deep it is.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.page_size = self._page_size(request.query_params.get('page_size'))
+        cursor = request.query_params.get('cursor')
+        self.cursor = decode_cursor(cursor) if cursor else None
+        self.next_cursor = None
+
+    def _page_size(self, value):
+        if not value:
+            return settings.PAYMENT_LIST_PAGE_SIZE
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({"page_size": "A valid integer is required."})
+        if page_size < 1:
+            raise ValidationError({"page_size": "Must be at least 1."})
+        return min(page_size, settings.PAYMENT_LIST_MAX_PAGE_SIZE)
+
+    def paginate_queryset(self, queryset):
+        if self.cursor:
+            created_at, payment_id = self.cursor
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=payment_id)
+            )
+
+        # Fetch one extra row to learn whether another page follows
+        page = list(queryset.order_by('-created_at', '-id')[:self.page_size + 1])
+        if len(page) > self.page_size:
+            page = page[:self.page_size]
+            last = page[-1]
+            if isinstance(last, dict):
+                # A .values() queryset
+                self.next_cursor = encode_cursor(last['created_at'], last['id'])
+            else:
+                self.next_cursor = encode_cursor(last.created_at, last.id)
+        return page
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        params = self.request.query_params.copy()
+        params['cursor'] = self.next_cursor
+        return self.request.build_absolute_uri(f"{self.request.path}?{params.urlencode()}")
+
+
+def paginate_payments(request, queryset=None):
+    """Filter and paginate payments for a list request; returns (page, paginator)"""
+    queryset = Payment.objects.all() if queryset is None else queryset
+    paginator = PaymentKeysetPaginator(request)
+    page = paginator.paginate_queryset(filter_payments(queryset, request.query_params))
+    return page, paginator
@@ -0,0 +1,177 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from payments.models import Payment, PayPalWebhookEvent, bulk_update_payments
+
+logger = logging.getLogger(__name__)
+
+# Headers PayPal signs a webhook delivery with
+TRANSMISSION_HEADERS = (
+    'PAYPAL-AUTH-ALGO',
+    'PAYPAL-CERT-URL',
+    'PAYPAL-TRANSMISSION-ID',
+    'PAYPAL-TRANSMISSION-SIG',
+    'PAYPAL-TRANSMISSION-TIME',
+)
+
+# Webhook event type -> Payment status; other event types are ignored
+WEBHOOK_EVENT_STATUS = {
+    "CHECKOUT.ORDER.APPROVED": "processing",
+    "CHECKOUT.ORDER.COMPLETED": "completed",
+    "CHECKOUT.ORDER.VOIDED": "failed",
+    "PAYMENT.CAPTURE.COMPLETED": "completed",
+    "PAYMENT.CAPTURE.DENIED": "failed",
+    "PAYMENT.CAPTURE.DECLINED": "failed",
+    "PAYMENT.CAPTURE.REFUNDED": "refunded",
+    "PAYMENT.CAPTURE.REVERSED": "refunded",
+}
+
+
+
+def event_order_id(payload):
+    """PayPal order id an event refers to; capture events carry it in related_ids"""
+    resource = payload.get("resource") or {}
+    if payload.get("event_type", "").startswith("CHECKOUT.ORDER."):
+        return resource.get("id")
+    return ((resource.get("supplementary_data") or {}).get("related_ids") or {}).get("order_id")
+
+
+def record_event(payload, headers):
+    """Append a received event; a redelivery of a stored event is dropped"""
+    PayPalWebhookEvent.objects.bulk_create([
+        PayPalWebhookEvent(
+            event_id=payload["id"],
+            event_type=payload["event_type"],
+            gateway_order_id=event_order_id(payload),
+            payload=payload,
+            headers={name: headers.get(name) for name in TRANSMISSION_HEADERS},
+            event_time=parse_datetime(payload.get("create_time") or ""),
+        )
+    ], ignore_conflicts=True)
+
+
+def verify_events(events, service=None):
+    """
+    Check each event's signature with PayPal, in parallel.
+    Returns {event pk: True/False}; events that could not be checked are left out.
+    """
+    if not settings.PAYPAL_WEBHOOK_ID:
+        if settings.DEBUG and settings.PAYPAL_WEBHOOK_SKIP_VERIFICATION:
+            logger.warning("PAYPAL_WEBHOOK_ID is not set; accepting PayPal webhook events unverified")
+            return {event.pk: True for event in events}
+        logger.error("PAYPAL_WEBHOOK_ID is not set; rejecting PayPal webhook events")
+        return {event.pk: False for event in events}
+
+    if service is None:
+        from payments.services import get_paypal_service
+        service = get_paypal_service()
+
+    def verify(event):
+        try:
+            return event.pk, service.verify_webhook_signature(event.headers, event.payload)
+        except Exception as e:
+            logger.error(f"PayPal webhook {event.event_id} verification exception: {str(e)}")
+            return event.pk, None
+
+    max_workers = min(settings.PAYPAL_WEBHOOK_VERIFY_CONCURRENCY, len(events)) or 1
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='paypal-webhook') as executor:
+        return {pk: verified for pk, verified in executor.map(verify, events) if verified is not None}
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the `attempts`-th signature check that could not reach PayPal"""
+    delay = settings.PAYPAL_WEBHOOK_BACKOFF_BASE * (2 ** (attempts - 1))
+    return min(delay, settings.PAYPAL_WEBHOOK_MAX_DELAY)
+
+
+def _defer(events, now):
+    """Push back events whose signature could not be checked, so they do not hold up the queue"""
+    for event in events:
+        event.attempts += 1
+        event.next_attempt_at = now + timedelta(seconds=retry_delay(event.attempts))
+        logger.warning(f"Deferring PayPal webhook {event.event_id}, attempt {event.attempts}")
+    PayPalWebhookEvent.objects.bulk_update(events, ['attempts', 'next_attempt_at'])
+
+
+def _apply(payment, event):
+    """Apply one event to a payment; returns False when the event is stale"""
+    new_status = WEBHOOK_EVENT_STATUS.get(event.event_type)
+    if new_status is None:
+        return False
+    if payment.gateway_event_at and event.event_time and event.event_time <= payment.gateway_event_at:
+        return False
+    # Same rules as Payment.transition: e.g. a captured payment is never failed or reopened
+    if new_status != payment.status and payment.status not in Payment.STATUS_TRANSITIONS[new_status]:
+        return False
+    payment.status = new_status
+    if event.event_time:
+        payment.gateway_event_at = event.event_time
+    return True
+
+
+def process_pending_events(batch_size=None, service=None):
+    """
+    Verify and apply one batch of received events to their payments.
+    Returns the number of events that were applied, ignored and rejected.
+    """
+    batch_size = batch_size or settings.PAYPAL_WEBHOOK_BATCH_SIZE
+    counts = {'applied': 0, 'ignored': 0, 'rejected': 0}
+
+    now = timezone.now()
+    events = list(
+        PayPalWebhookEvent.objects
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now), processed_at__isnull=True)
+        .order_by('id')[:batch_size]
+    )
+    if not events:
+        return counts
+
+    verified = verify_events(events, service)
+    _defer([event for event in events if event.pk not in verified], now)
+
+    with transaction.atomic():
+        # Another worker may have taken some of the batch meanwhile
+        queryset = PayPalWebhookEvent.objects.filter(pk__in=list(verified), processed_at__isnull=True)
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        events = sorted(queryset, key=lambda e: (e.event_time or e.received_at, e.pk))
+
+        order_ids = {event.gateway_order_id for event in events if verified[event.pk] and event.gateway_order_id}
+        payments = {
+            payment.gateway_order_id: payment
+            for payment in Payment.objects.select_for_update().filter(gateway_order_id__in=order_ids)
+        }
+        previous_statuses = {payment.pk: payment.status for payment in payments.values()}
+        touched = {}
+
+        now = timezone.now()
+        for event in events:
+            payment = payments.get(event.gateway_order_id)
+            if not verified[event.pk]:
+                event.state = 'rejected'
+                logger.warning(f"Rejected PayPal webhook {event.event_id} with an invalid signature")
+            elif payment is not None and _apply(payment, event):
+                event.state = 'applied'
+                touched[payment.pk] = payment
+            else:
+                event.state = 'ignored'
+            event.processed_at = now
+            counts[event.state] += 1
+
+        PayPalWebhookEvent.objects.bulk_update(events, ['state', 'processed_at'])
+        if touched:
+            touched = list(touched.values())
+            bulk_update_payments(
+                touched,
+                ['status', 'gateway_event_at'],
+                [previous_statuses[payment.pk] for payment in touched],
+            )
+
+    return counts
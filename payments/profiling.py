@@ -0,0 +1,205 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Profile of the request being handled, None when profiling is off
+_current = ContextVar('payment_request_profile', default=None)
+
+_NOOP = nullcontext()
+
+
+class RequestProfile:
+    """Time spent per span name during one request"""
+
+    def __init__(self):
+        self.spans = defaultdict(float)
+        self.queries = 0
+
+    def add(self, name, seconds):
+        self.spans[name] += seconds
+
+
+@contextmanager
+def _timed_span(profile, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def span(name):
+    """Time a block under `name` in the current request's profile; a no-op when not profiling"""
+    profile = _current.get()
+    if profile is None:
+        return _NOOP
+    return _timed_span(profile, name)
+
+
+class RollingHistogram:
+    """Last `size` durations per (view, span), for percentiles over recent traffic"""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.size))
+
+    def record(self, view, spans):
+        with self._lock:
+            for name, seconds in spans.items():
+                self._samples[(view, name)].append(seconds * 1000)
+
+    def snapshot(self):
+        """{view: {span: {count, p50, p90, p99, max}}} in milliseconds"""
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+        result = defaultdict(dict)
+        for (view, name), values in samples.items():
+            result[view][name] = {
+                "count": len(values),
+                "p50": round(values[int(len(values) * 0.50)], 2),
+                "p90": round(values[int(len(values) * 0.90)], 2),
+                "p99": round(values[min(len(values) - 1, int(len(values) * 0.99))], 2),
+                "max": round(values[-1], 2),
+            }
+        return dict(result)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+histogram = RollingHistogram()
+
+# cProfile can only profile one request at a time per process
+_profiler_lock = threading.Lock()
+
+
+def server_timing(profile, total):
+    """Server-Timing header value, e.g. 'db;dur=4.1;desc="3 queries", total;dur=52.0'"""
+    entries = []
+    for name, seconds in profile.spans.items():
+        entry = f"{name};dur={seconds * 1000:.1f}"
+        if name == 'db':
+            entry += f';desc="{profile.queries} queries"'
+        entries.append(entry)
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def query_recorder(profile):
+    """Connection execute wrapper counting and timing queries into `profile`"""
+    def record_query(execute, sql, params, many, context):
+        profile.queries += 1
+        with _timed_span(profile, 'db'):
+            return execute(sql, params, many, context)
+    return record_query
+
+
+def _wrap_queries(wrapper):
+    """Install an execute wrapper on this thread's connection; returns the function removing it"""
+    installed = connection.execute_wrapper(wrapper)
+    installed.__enter__()
+    return lambda: installed.__exit__(None, None, None)
+
+
+class ProfilingMiddleware:
+    """
+    Records timing spans (db, paypal.*, serialize) and the query count for
+    every request, returns them in a Server-Timing header and feeds the
+    rolling histogram. A PAYMENT_PROFILING_SAMPLE_RATE share of requests
+    also runs under cProfile, kept in PAYMENT_PROFILING_DIR when slower
+    than PAYMENT_PROFILING_SLOW_MS. Removed at startup unless
+    PAYMENT_PROFILING is on. Runs natively under ASGI; there cProfile only
+    sees the event loop thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PAYMENT_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile, token, profiler = self.start()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(query_recorder(profile)):
+                response = self.get_response(request)
+        finally:
+            total = time.perf_counter() - started
+            self.stop(token, profiler)
+        return self.finish(request, response, profile, profiler, total)
+
+    async def __acall__(self, request):
+        profile, token, profiler = self.start()
+        started = time.perf_counter()
+        try:
+            # Async views run their queries in the request's sync thread; count them there
+            undo = await sync_to_async(_wrap_queries)(query_recorder(profile))
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(undo)()
+        finally:
+            total = time.perf_counter() - started
+            self.stop(token, profiler)
+        return self.finish(request, response, profile, profiler, total)
+
+    def start(self):
+        profile = RequestProfile()
+        token = _current.set(profile)
+        profiler = None
+        if random.random() < settings.PAYMENT_PROFILING_SAMPLE_RATE and _profiler_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active in this process
+                _profiler_lock.release()
+                profiler = None
+        return profile, token, profiler
+
+    def stop(self, token, profiler):
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+        _current.reset(token)
+
+    def finish(self, request, response, profile, profiler, total):
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        histogram.record(view, dict(profile.spans, total=total))
+        response['Server-Timing'] = server_timing(profile, total)
+
+        if profiler is not None and total * 1000 >= settings.PAYMENT_PROFILING_SLOW_MS:
+            self.dump(profiler, view, total)
+        return response
+
+    def dump(self, profiler, view, total):
+        directory = settings.PAYMENT_PROFILING_DIR
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{view}-{total * 1000:.0f}ms.prof")
+            profiler.dump_stats(path)
+            logger.warning(f"Slow request to {view} took {total * 1000:.0f}ms; profile saved to {path}")
+        except OSError as e:
+            logger.error(f"Could not save request profile: {str(e)}")
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from payments.cache import invalidate_payment
+from payments.models import Payment, PaymentGatewayEvent
+from payments.scheduler import NON_TERMINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by worker threads: at most `rate` acquisitions per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ReconcileStats:
+    def __init__(self):
+        self.scanned = 0
+        self.verified = 0
+        self.changed = 0
+        self.errors = 0
+        # Age of the stalest payment found, in seconds
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        return self.verified / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mean_lag(self):
+        return self.total_lag / self.scanned if self.scanned else 0.0
+
+    def summary(self):
+        return (
+            f"scanned={self.scanned} verified={self.verified} changed={self.changed} errors={self.errors} "
+            f"elapsed={self.elapsed:.2f}s throughput={self.throughput:.1f}/s "
+            f"max_lag={self.max_lag:.0f}s mean_lag={self.mean_lag:.0f}s"
+        )
+
+
+def iter_stale_chunks(cutoff, chunk_size):
+    """
+    Non-terminal payments with a PayPal order, last updated before `cutoff`,
+    in chunks. Each status is walked in (updated_at, id) order so every
+    chunk is a range scan on payment_status_updated_idx.
+    """
+    for payment_status in NON_TERMINAL_STATUSES:
+        queryset = Payment.objects.filter(
+            status=payment_status, updated_at__lt=cutoff, gateway_order_id__isnull=False
+        ).order_by('updated_at', 'id')
+        last = None
+        while True:
+            chunk_queryset = queryset
+            if last is not None:
+                updated_at, payment_id = last
+                chunk_queryset = queryset.filter(
+                    Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=payment_id)
+                )
+            chunk = list(chunk_queryset[:chunk_size])
+            if not chunk:
+                break
+            # Taken before yielding: the caller's write-back moves updated_at
+            last = (chunk[-1].updated_at, chunk[-1].id)
+            yield chunk
+
+
+def reconcile_payments(stale_after=None, chunk_size=None, workers=None, rate=None, service=None):
+    """
+    Verify every stale pending/processing payment against PayPal and write
+    the results back one chunk at a time. Returns a ReconcileStats.
+    """
+    from payments.services import PAYPAL_STATUS_MAP, get_paypal_service
+
+    stale_after = stale_after if stale_after is not None else settings.PAYMENT_RECONCILE_STALE_AFTER
+    chunk_size = chunk_size or settings.PAYMENT_RECONCILE_CHUNK_SIZE
+    workers = workers or settings.PAYMENT_RECONCILE_WORKERS
+    limiter = RateLimiter(rate if rate is not None else settings.PAYMENT_RECONCILE_RATE)
+    service = service or get_paypal_service()
+
+    stats = ReconcileStats()
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=stale_after)
+
+    def check(payment):
+        limiter.acquire()
+        try:
+            return service.fetch_order(payment.gateway_order_id)
+        except Exception as e:
+            logger.error(f"Reconciliation of payment {payment.id} failed: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as executor:
+        for chunk in iter_stale_chunks(cutoff, chunk_size):
+            stats.scanned += len(chunk)
+            for payment in chunk:
+                lag = (now - payment.updated_at).total_seconds()
+                stats.max_lag = max(stats.max_lag, lag)
+                stats.total_lag += lag
+
+            unchanged = defaultdict(list)
+            gateway_events = []
+            for payment, order in zip(chunk, executor.map(check, chunk)):
+                if order is None:
+                    stats.errors += 1
+                    continue
+                stats.verified += 1
+                loaded_status = payment.status
+                new_status = PAYPAL_STATUS_MAP.get(order.get("status", ""), loaded_status)
+                payment.gateway_status = order.get("status")
+                gateway_events.append(PaymentGatewayEvent.for_payload(payment, 'reconcile', order))
+                if new_status == loaded_status:
+                    unchanged[(loaded_status, payment.gateway_status)].append(payment.pk)
+                # Conditional on the status loaded before the slow PayPal calls, so a capture made meanwhile is kept
+                elif payment.transition(new_status, ['gateway_status']):
+                    stats.changed += 1
+
+            # Unchanged payments are touched too, so their updated_at moves past the next cutoff
+            for (loaded_status, gateway_status), payment_ids in unchanged.items():
+                Payment.objects.filter(pk__in=payment_ids, status=loaded_status).update(
+                    gateway_status=gateway_status, updated_at=timezone.now()
+                )
+                for payment_id in payment_ids:
+                    invalidate_payment(payment_id)
+            PaymentGatewayEvent.objects.bulk_create(gateway_events)
+
+    stats.elapsed = time.monotonic() - stats.started
+    return stats
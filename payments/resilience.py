@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+# Upstream answers that mean PayPal is struggling rather than rejecting the request
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PayPalUnavailable(Exception):
+    """PayPal is failing or overloaded; the call was not made or gave up. Safe to try again later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff before retry number `attempt` (1-based), honouring a short Retry-After"""
+    cap = settings.PAYPAL_RETRY_MAX_DELAY
+    if retry_after is not None and 0 <= retry_after <= cap:
+        return retry_after
+    return random.uniform(0, min(cap, settings.PAYPAL_RETRY_BACKOFF_BASE * (2 ** (attempt - 1))))
+
+
+def retry_after_header(error):
+    """Retry-After value (whole seconds) for a response to a PayPalUnavailable"""
+    return str(max(1, int(error.retry_after or 1)))
+
+
+def parse_retry_after(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_overload(response, action):
+    """Raise PayPalUnavailable when PayPal still answered `response` with an overload status after the retries"""
+    if response.status_code in OVERLOAD_STATUSES:
+        raise PayPalUnavailable(
+            f"PayPal {action} returned {response.status_code}",
+            retry_after=parse_retry_after(response.headers.get('Retry-After')),
+        )
+
+
+class RetryBudget:
+    """
+    Caps retries at a share of recent traffic: every request deposits `ratio`
+    of a retry, and `min_per_second` more trickle in so quiet periods can
+    still retry. During an outage retries stop once the budget is spent
+    instead of multiplying the load on PayPal.
+    """
+
+    def __init__(self, ratio=None, min_per_second=None):
+        self.ratio = ratio if ratio is not None else settings.PAYPAL_RETRY_BUDGET_RATIO
+        self.min_per_second = min_per_second if min_per_second is not None else settings.PAYPAL_RETRY_BUDGET_MIN_PER_SECOND
+        # Unused retries do not pile up beyond a ten second burst
+        self.capacity = max(1.0, self.min_per_second * 10)
+        self.balance = self.capacity
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Take one retry from the budget; False when it is spent"""
+        with self._lock:
+            now = time.monotonic()
+            self.balance = min(self.capacity, self.balance + (now - self._refilled_at) * self.min_per_second)
+            self._refilled_at = now
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens when at least `min_calls` calls in the last `window` seconds failed
+    at `failure_rate` or more. While open every call fails fast with
+    PayPalUnavailable; after `reset_timeout` one probe call is let through
+    (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_rate=None, min_calls=None, window=None, reset_timeout=None):
+        self.failure_rate = failure_rate or settings.PAYPAL_BREAKER_FAILURE_RATE
+        self.min_calls = min_calls or settings.PAYPAL_BREAKER_MIN_CALLS
+        self.window = window or settings.PAYPAL_BREAKER_WINDOW
+        self.reset_timeout = reset_timeout or settings.PAYPAL_BREAKER_RESET_TIMEOUT
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._calls = deque()
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until the circuit lets a probe through"""
+        with self._lock:
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        """Raise PayPalUnavailable unless a call may go ahead now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                wait = self._opened_at + self.reset_timeout - time.monotonic()
+                if wait > 0:
+                    raise PayPalUnavailable("PayPal circuit breaker is open", retry_after=wait)
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise PayPalUnavailable("PayPal circuit breaker is half-open", retry_after=1.0)
+                self._probing = True
+
+    def cancel_probe(self):
+        """Give back a half-open probe reserved by before_call() when the call was not made after all"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+    def record(self, ok):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                    self._failures = 0
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+
+            self._calls.append((now, ok))
+            if not ok:
+                self._failures += 1
+            while self._calls and self._calls[0][0] < now - self.window:
+                if not self._calls.popleft()[1]:
+                    self._failures -= 1
+            if len(self._calls) >= self.min_calls and self._failures / len(self._calls) >= self.failure_rate:
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self._failures = 0
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on outstanding PayPal requests: every successful call raises
+    the limit by 1/limit (about +1 per round trip of the whole window), every
+    overloaded or timed-out call multiplies it by `backoff`. Callers wait up
+    to `wait` seconds for a slot and then fail fast with PayPalUnavailable,
+    so threads never pile up behind a slow upstream.
+    """
+
+    def __init__(self, initial=None, min_limit=None, max_limit=None, backoff=None, wait=None):
+        self.min_limit = min_limit or settings.PAYPAL_CONCURRENCY_MIN
+        self.max_limit = max_limit or settings.PAYPAL_CONCURRENCY_MAX
+        self.limit = float(initial or settings.PAYPAL_CONCURRENCY_INITIAL)
+        self.backoff = backoff or settings.PAYPAL_CONCURRENCY_BACKOFF
+        self.wait = wait if wait is not None else settings.PAYPAL_CONCURRENCY_WAIT
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), self.wait):
+                raise PayPalUnavailable(f"Too many PayPal requests in flight (limit {int(self.limit)})", retry_after=1.0)
+            self.in_flight += 1
+
+    def release(self, overloaded):
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify()
+
+
+_lock = threading.Lock()
+_breaker = None
+_budget = None
+
+
+def get_circuit_breaker():
+    """The process-wide PayPal circuit breaker, shared by the sync and async services"""
+    global _breaker
+    with _lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker()
+        return _breaker
+
+
+def get_retry_budget():
+    """The process-wide PayPal retry budget"""
+    global _budget
+    with _lock:
+        if _budget is None:
+            _budget = RetryBudget()
+        return _budget
+
+
+def reset_resilience():
+    """Forget breaker and budget state, e.g. after pointing the services at another PayPal"""
+    global _breaker, _budget
+    with _lock:
+        _breaker = None
+        _budget = None
@@ -0,0 +1,227 @@
+import atexit
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from payments.metrics import VERIFICATIONS_IN_FLIGHT
+from payments.models import Payment
+from payments.resilience import PayPalUnavailable
+
+logger = logging.getLogger(__name__)
+
+NON_TERMINAL_STATUSES = ('pending', 'processing')
+
+
+def verification_delay(attempt):
+    """Seconds to wait before verification attempt number `attempt` (0-based)"""
+    delay = settings.PAYMENT_VERIFY_DELAY * (settings.PAYMENT_VERIFY_BACKOFF ** attempt)
+    return min(delay, settings.PAYMENT_VERIFY_MAX_DELAY)
+
+
+def verification_due_at(attempt=0):
+    return timezone.now() + timedelta(seconds=verification_delay(attempt))
+
+
+def _default_verify(payment):
+    from payments.services import get_paypal_service
+    return get_paypal_service().verify_payment(payment)
+
+
+class VerificationScheduler:
+    """
+    Runs delayed PayPal verifications on a fixed pool of worker threads.
+
+    Due times live in a heap watched by a single dispatcher thread, so
+    thousands of pending verifications cost no threads at all. Each due time
+    is also persisted on the Payment row (verify_due_at), which lets a
+    restarted process recover what was still outstanding. Before running a
+    verification the row is leased with a conditional UPDATE, so several
+    worker processes recovering the same rows verify each payment only once.
+    """
+
+    def __init__(self, verify=None, workers=None, max_concurrent=None, max_attempts=None, lease=None):
+        self.verify = verify or _default_verify
+        self.workers = workers or settings.PAYMENT_VERIFY_WORKERS
+        self.max_attempts = max_attempts or settings.PAYMENT_VERIFY_MAX_ATTEMPTS
+        self.lease = lease or settings.PAYMENT_VERIFY_LEASE
+        self._upstream = threading.BoundedSemaphore(max_concurrent or settings.PAYMENT_VERIFY_MAX_CONCURRENT)
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._dispatcher = None
+        self._stopping = False
+        self.in_flight = 0
+
+    def start(self):
+        """Start the dispatcher and worker pool, then reload persisted verifications"""
+        with self._cond:
+            if self._dispatcher is not None:
+                return
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payment-verify')
+            self._dispatcher = threading.Thread(target=self._run, name='payment-verify-dispatcher', daemon=True)
+            self._dispatcher.start()
+        atexit.register(self.shutdown)
+        self._executor.submit(self._in_worker, self.recover)
+
+    def recover(self):
+        """Queue every verification persisted on a non-terminal payment"""
+        try:
+            rows = (
+                Payment.objects.filter(verify_due_at__isnull=False, status__in=NON_TERMINAL_STATUSES)
+                .values_list('id', 'verify_due_at', 'verify_attempts')
+                .iterator(chunk_size=1000)
+            )
+            recovered = 0
+            for payment_id, due_at, attempts in rows:
+                self._push(payment_id, due_at, attempts)
+                recovered += 1
+            if recovered:
+                logger.info(f"Recovered {recovered} pending payment verifications")
+        except Exception as e:
+            logger.error(f"Error recovering pending payment verifications: {str(e)}")
+
+    def schedule(self, payment_id, due_at, attempt=0):
+        """Queue a verification whose due time is already persisted on the payment"""
+        if self._dispatcher is None:
+            self.start()
+        self._push(payment_id, due_at, attempt)
+
+    def _push(self, payment_id, due_at, attempt):
+        with self._cond:
+            heapq.heappush(self._heap, (due_at.timestamp(), next(self._counter), payment_id, due_at, attempt))
+            self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _pop_due(self, now_ts):
+        due = []
+        while self._heap and self._heap[0][0] <= now_ts:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                due = self._pop_due(timezone.now().timestamp())
+                if not due:
+                    timeout = self._heap[0][0] - timezone.now().timestamp() if self._heap else None
+                    self._cond.wait(timeout)
+                    continue
+                executor = self._executor
+            for _, _, payment_id, due_at, attempt in due:
+                try:
+                    executor.submit(self._in_worker, self._verify, payment_id, due_at, attempt)
+                except RuntimeError:
+                    # The pool is shutting down; the due time stays persisted for recovery
+                    return
+
+    def run_pending(self, now=None):
+        """Run every verification due at `now` in the calling thread"""
+        now = now or timezone.now()
+        with self._cond:
+            due = self._pop_due(now.timestamp())
+        for _, _, payment_id, due_at, attempt in due:
+            self._verify(payment_id, due_at, attempt)
+        return len(due)
+
+    def _verify(self, payment_id, due_at, attempt):
+        with self._cond:
+            self.in_flight += 1
+        VERIFICATIONS_IN_FLIGHT.inc()
+        try:
+            lease_until = timezone.now() + timedelta(seconds=self.lease)
+            claimed = Payment.objects.filter(id=payment_id, verify_due_at=due_at).update(verify_due_at=lease_until)
+            if not claimed:
+                # Another process already ran or rescheduled this verification
+                return
+
+            payment = Payment.objects.get(id=payment_id)
+            if payment.status in NON_TERMINAL_STATUSES:
+                with self._upstream:
+                    payment = self.verify(payment)
+                logger.info(f"Auto-verified payment {payment.id} with status {payment.status}")
+
+            self._finish(payment_id, attempt, payment.status in NON_TERMINAL_STATUSES)
+
+        except Payment.DoesNotExist:
+            logger.error(f"Payment {payment_id} does not exist for auto-verification")
+        except PayPalUnavailable as e:
+            logger.warning(f"Deferring verification of payment {payment_id}: {str(e)}")
+            self._defer(payment_id, attempt, e.retry_after)
+        except Exception as e:
+            logger.error(f"Error during auto-verification of payment {payment_id}: {str(e)}")
+            self._finish(payment_id, attempt, True)
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+            VERIFICATIONS_IN_FLIGHT.dec()
+
+    def _in_worker(self, func, *args):
+        # Worker threads hold their own DB connections; release them between jobs
+        try:
+            func(*args)
+        finally:
+            close_old_connections()
+
+    def _defer(self, payment_id, attempt, delay):
+        """Run the same attempt again once PayPal is reachable; an outage does not use up attempts"""
+        due_at = timezone.now() + timedelta(seconds=max(delay or 0, settings.PAYMENT_VERIFY_DELAY))
+        Payment.objects.filter(id=payment_id).update(verify_due_at=due_at)
+        self._push(payment_id, due_at, attempt)
+
+    def _finish(self, payment_id, attempt, retry):
+        """Reschedule with backoff, or clear the persisted due time when done"""
+        next_attempt = attempt + 1
+        if retry and next_attempt < self.max_attempts:
+            due_at = verification_due_at(next_attempt)
+            Payment.objects.filter(id=payment_id).update(verify_due_at=due_at, verify_attempts=next_attempt)
+            self._push(payment_id, due_at, next_attempt)
+        else:
+            Payment.objects.filter(id=payment_id).update(verify_due_at=None, verify_attempts=next_attempt)
+
+    def shutdown(self, wait=True):
+        """
+        Stop dispatching and let in-flight verifications finish. Verifications
+        that have not started keep their persisted due time and are recovered
+        by the next process.
+        """
+        with self._cond:
+            if self._dispatcher is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+            dispatcher, executor = self._dispatcher, self._executor
+            self._dispatcher = None
+            self._executor = None
+            self._heap = []
+
+        dispatcher.join(timeout=5)
+        executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_verification_scheduler():
+    """Return the process-wide verification scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = VerificationScheduler()
+    return _scheduler
@@ -1,3 +1,8 @@
+import decimal
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Payment
 
@@ -31,4 +36,84 @@ class PaymentResponseSerializer(serializers.ModelSerializer):
         fields = ['id', 'customer_name', 'customer_email', 'amount', 'currency', 'status']
         
     def get_id(self, obj):
-        return f"PAY-{str(obj.id)[:8]}"
\ No newline at end of file
+        return short_payment_id(obj.id)
+
+
+def short_payment_id(payment_id):
+    return f"PAY-{str(payment_id)[:8]}"
+
+
+_amount_field = Payment._meta.get_field('amount')
+_AMOUNT_QUANTUM = decimal.Decimal('.1') ** _amount_field.decimal_places
+_AMOUNT_CONTEXT = decimal.Context(prec=_amount_field.max_digits)
+
+
+def decimal_representation(value):
+    """DecimalField output: quantized to the model's decimal places, as a string"""
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(str(value).strip())
+    return '{:f}'.format(value.quantize(_AMOUNT_QUANTUM, context=_AMOUNT_CONTEXT))
+
+
+def datetime_representation(value, tz=None):
+    """DateTimeField output: ISO 8601 in `tz` (default: the current timezone), with UTC as 'Z'"""
+    if settings.USE_TZ:
+        tz = tz or timezone.get_current_timezone()
+        if timezone.is_aware(value):
+            value = value.astimezone(tz)
+        else:
+            value = timezone.make_aware(value, tz)
+    elif timezone.is_aware(value):
+        value = timezone.make_naive(value, dt_timezone.utc)
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+# How PaymentSerializer renders each field type; other fields are passed through
+PAYMENT_FIELD_REPRESENTATIONS = {
+    'id': str,
+    'amount': decimal_representation,
+    'created_at': datetime_representation,
+    'updated_at': datetime_representation,
+}
+
+
+class PaymentRowSerializer:
+    """
+    Same output as one of the Payment ModelSerializers above, built straight
+    from .values() rows (or Payment instances) instead of going through DRF's
+    per-field machinery. Used on the hot read paths (list and detail).
+    """
+
+    def __init__(self, serializer_class, representations=None):
+        representations = dict(PAYMENT_FIELD_REPRESENTATIONS, **(representations or {}))
+        self.fields = list(serializer_class.Meta.fields)
+        self._converters = [
+            (name, representations.get(name), representations.get(name) is datetime_representation)
+            for name in self.fields
+        ]
+
+    def to_representation(self, row, tz=None):
+        if not isinstance(row, dict):
+            row = {name: getattr(row, name) for name in self.fields}
+        data = {}
+        for name, convert, is_datetime in self._converters:
+            value = row[name]
+            if convert is None or value is None:
+                data[name] = value
+            elif is_datetime:
+                data[name] = convert(value, tz)
+            else:
+                data[name] = convert(value)
+        return data
+
+    def many(self, rows):
+        # Looking up the current timezone costs more than converting a datetime; do it once
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        return [self.to_representation(row, tz) for row in rows]
+
+
+fast_payment_serializer = PaymentRowSerializer(PaymentSerializer)
+fast_payment_response_serializer = PaymentRowSerializer(PaymentResponseSerializer, {'id': short_payment_id})
\ No newline at end of file
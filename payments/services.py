@@ -1,26 +1,91 @@
-import requests
 import os
 import json
 import uuid
 from django.conf import settings
 import logging
 import threading
-import time
-from payments.models import Payment
+from concurrent.futures import ThreadPoolExecutor
+from payments.http_client import REQUEST_ID_HEADER, PayPalHTTPClient
+from payments.models import Payment, PaymentGatewayEvent, bulk_update_payments
+from payments.profiling import span
+from payments.resilience import PayPalUnavailable, raise_for_overload, reset_resilience
+from payments.scheduler import get_verification_scheduler, verification_due_at
+from payments.singleflight import SingleFlight, cross_process_lock
+from payments.token_cache import get_token_cache
 
 logger = logging.getLogger(__name__)
 
+# PayPal order status -> Payment status; statuses not listed leave the payment unchanged
+PAYPAL_STATUS_MAP = {
+    "COMPLETED": "completed",
+    "APPROVED": "processing",
+    "VOIDED": "failed",
+    "DECLINED": "failed",
+}
+
+
+def build_order_payload(payment):
+    """Request body for creating a PayPal order for a payment"""
+    return {
+        "intent": "CAPTURE",
+        "purchase_units": [
+            {
+                "amount": {
+                    "currency_code": payment.currency,
+                    "value": str(payment.amount)
+                },
+                "description": f"Payment for {payment.customer_name}"
+            }
+        ],
+        "application_context": {
+            "return_url": f"{settings.BASE_URL}/api/v1/payments/paypal/success",
+            "cancel_url": f"{settings.BASE_URL}/api/v1/payments/paypal/cancel"
+        }
+    }
+
+
+def find_approval_url(order_data):
+    """Find the approve link the customer is redirected to"""
+    return next(
+        link["href"] for link in order_data["links"]
+        if link["rel"] == "approve"
+    )
+
+
+# Payment fields written when an order is created
+ORDER_UPDATE_FIELDS = ['gateway_order_id', 'gateway_status', 'approval_url', 'status', 'verify_due_at', 'verify_attempts']
+
+
+def apply_order(payment, order_data):
+    """Record a created PayPal order on the payment (without saving); returns the approval URL"""
+    approval_url = find_approval_url(order_data)
+    payment.gateway_order_id = order_data["id"]
+    payment.gateway_status = order_data.get("status")
+    payment.approval_url = approval_url
+    payment.status = "processing"
+    payment.verify_due_at = verification_due_at()
+    payment.verify_attempts = 0
+    return approval_url
+
+
 class PayPalService:
     """PayPal payment gateway service using Sandbox"""
     
-    def __init__(self):
+    def __init__(self, http_client=None):
         # PayPal Sandbox API URLs
         self.base_url = os.environ.get('PAYPAL_API_URL', 'https://api-m.sandbox.paypal.com')
         self.client_id = os.environ.get('PAYPAL_CLIENT_ID', '')
         self.client_secret = os.environ.get('PAYPAL_CLIENT_SECRET', '')
+        self.token_cache = get_token_cache(self.base_url, self.client_id)
+        self.http = http_client or PayPalHTTPClient()
+        self.verify_flight = SingleFlight()
     
     def get_access_token(self):
-        """Get PayPal OAuth access token for API calls"""
+        """Get PayPal OAuth access token for API calls, reusing the cached one until it nears expiry"""
+        return self.token_cache.get_token(self._fetch_access_token)
+
+    def _fetch_access_token(self):
+        """Request a new OAuth access token from PayPal"""
         url = f"{self.base_url}/v1/oauth2/token"
         
         headers = {
@@ -33,12 +98,15 @@ class PayPalService:
         }
         
         try:
-            response = requests.post(
-                url, 
-                auth=(self.client_id, self.client_secret),
-                data=data,
-                headers=headers
-            )
+            with span('paypal.token'):
+                response = self.http.post(
+                    url,
+                    'token',
+                    auth=(self.client_id, self.client_secret),
+                    data=data,
+                    headers=headers
+                )
+            raise_for_overload(response, "authentication")
             
             response_data = response.json()
             
@@ -46,123 +114,179 @@ class PayPalService:
                 logger.error(f"PayPal token error: {response_data}")
                 raise Exception("Failed to get PayPal access token")
             
-            return response_data["access_token"]
+            expires_in = response_data.get("expires_in", settings.PAYPAL_TOKEN_DEFAULT_TTL)
+            return response_data["access_token"], int(expires_in)
             
+        except PayPalUnavailable:
+            raise
         except Exception as e:
             logger.error(f"PayPal token exception: {str(e)}")
             raise Exception(f"PayPal authentication failed: {str(e)}")
     
+    def _check_token_rejected(self, response):
+        """Drop the cached token when PayPal no longer accepts it"""
+        if response.status_code == 401:
+            self.token_cache.invalidate()
+
     def create_order(self, payment):
         """Create a PayPal order"""
+        try:
+            order_data = self.submit_order(payment)
+            approval_url = apply_order(payment, order_data)
+            payment.transition("processing", ORDER_UPDATE_FIELDS, allowed_from=("pending",))
+            PaymentGatewayEvent.record(payment, 'order', order_data)
+
+            # Verify the payment in the background once the delay has passed
+            get_verification_scheduler().schedule(payment.id, payment.verify_due_at)
+            
+            return payment, approval_url
+            
+        except PayPalUnavailable as e:
+            # No order exists to resume this payment from; the client's retry starts a new one
+            logger.warning(f"PayPal order refused, PayPal unavailable: {str(e)}")
+            payment.failure_reason = 'paypal_unavailable'
+            payment.transition("failed", ['failure_reason'], allowed_from=("pending",))
+            raise
+        except Exception as e:
+            logger.error(f"PayPal order exception: {str(e)}")
+            payment.failure_reason = 'order_rejected'
+            payment.transition("failed", ['failure_reason'], allowed_from=("pending",))
+            raise Exception(f"PayPal order creation failed: {str(e)}")
+
+    def submit_order(self, payment):
+        """Create the PayPal order for a payment and return PayPal's response, without saving the payment"""
         url = f"{self.base_url}/v2/checkout/orders"
         
         access_token = self.get_access_token()
         
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}"
+            "Authorization": f"Bearer {access_token}",
+            # Lets the call be retried without creating a second order
+            REQUEST_ID_HEADER: str(payment.id),
         }
         
-        payload = {
-            "intent": "CAPTURE",
-            "purchase_units": [
-                {
-                    "amount": {
-                        "currency_code": payment.currency,
-                        "value": str(payment.amount)
-                    },
-                    "description": f"Payment for {payment.customer_name}"
-                }
-            ],
-            "application_context": {
-                "return_url": f"{settings.BASE_URL}/api/v1/payments/paypal/success",
-                "cancel_url": f"{settings.BASE_URL}/api/v1/payments/paypal/cancel"
-            }
-        }
-        
-        try:
-            response = requests.post(
+        with span('paypal.create_order'):
+            response = self.http.post(
                 url,
-                json=payload,
+                'create_order',
+                json=build_order_payload(payment),
                 headers=headers
             )
-            
-            response_data = response.json()
-            
-            if response.status_code not in [200, 201]:
-                logger.error(f"PayPal order error: {response_data}")
-                raise Exception("Failed to create PayPal order")
-            
-            # Find the approve link for redirect
-            approval_url = next(
-                link["href"] for link in response_data["links"] 
-                if link["rel"] == "approve"
-            )
-            
-            payment.gateway_response = response_data
-            payment.status = "processing"
-            payment.save()
+        
+        # Still failing after the client's retries
+        raise_for_overload(response, "order creation")
+        
+        response_data = response.json()
+        self._check_token_rejected(response)
+        
+        if response.status_code not in [200, 201]:
+            logger.error(f"PayPal order error: {response_data}")
+            raise Exception("Failed to create PayPal order")
+        
+        return response_data
 
-            # Start a background thread to verify the payment after 2 seconds
-            threading.Thread(target=self._auto_verify_payment, args=(payment.id,), daemon=True).start()
-            
-            return payment, approval_url
-            
-        except Exception as e:
-            logger.error(f"PayPal order exception: {str(e)}")
-            payment.status = "failed"
-            payment.save()
-            raise Exception(f"PayPal order creation failed: {str(e)}")
+    def create_orders(self, payments, max_workers=None):
+        """
+        Create PayPal orders for many saved payments with bounded parallelism,
+        then persist every outcome in a single transaction.
+        Returns (payment, approval_url, error) per payment, in order.
+        """
+        max_workers = min(max_workers or settings.PAYMENT_BATCH_CONCURRENCY, len(payments)) or 1
+
+        def submit(payment):
+            try:
+                return self.submit_order(payment), None
+            except Exception as e:
+                logger.error(f"PayPal order exception for payment {payment.id}: {str(e)}")
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='paypal-order') as executor:
+            outcomes = list(executor.map(submit, payments))
+
+        previous_statuses = [payment.status for payment in payments]
+        results = []
+        for payment, (order_data, error) in zip(payments, outcomes):
+            approval_url = None
+            if error is None:
+                try:
+                    approval_url = apply_order(payment, order_data)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                payment.status = "failed"
+                payment.failure_reason = 'paypal_unavailable' if isinstance(error, PayPalUnavailable) else 'order_rejected'
+            results.append((payment, approval_url, error))
+
+        bulk_update_payments(payments, ORDER_UPDATE_FIELDS + ['failure_reason'], previous_statuses)
+        PaymentGatewayEvent.objects.bulk_create([
+            PaymentGatewayEvent.for_payload(payment, 'order', order_data)
+            for payment, (order_data, _) in zip(payments, outcomes) if order_data is not None
+        ])
+
+        scheduler = get_verification_scheduler()
+        for payment, approval_url, error in results:
+            if error is None:
+                scheduler.schedule(payment.id, payment.verify_due_at)
+
+        return results
 
-    def _auto_verify_payment(self, payment_id):
-        """Automatically verify the payment after 2 seconds"""
-        time.sleep(2)  # Wait for 2 seconds
-        try:
-            payment = Payment.objects.get(id=payment_id)
-            self.verify_payment(payment)
-            logger.info(f"Auto-verified payment {payment.id} with status {payment.status}")
-        except Payment.DoesNotExist:
-            logger.error(f"Payment {payment_id} does not exist for auto-verification")
-        except Exception as e:
-            logger.error(f"Error during auto-verification of payment {payment_id}: {str(e)}")
-    
     def capture_payment(self, payment):
         """Capture an approved PayPal payment"""
-        order_id = payment.gateway_response["id"]
-        url = f"{self.base_url}/v2/checkout/orders/{order_id}/capture"
+        url = f"{self.base_url}/v2/checkout/orders/{payment.gateway_order_id}/capture"
         
         access_token = self.get_access_token()
         
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {access_token}"
+            "Authorization": f"Bearer {access_token}",
+            REQUEST_ID_HEADER: f"{payment.id}-capture",
         }
         
         try:
-            response = requests.post(url, headers=headers)
+            with span('paypal.capture_payment'):
+                response = self.http.post(url, 'capture_payment', headers=headers)
+            raise_for_overload(response, "capture")
             response_data = response.json()
+            self._check_token_rejected(response)
             
             if response.status_code not in [200, 201]:
                 logger.error(f"PayPal capture error: {response_data}")
                 raise Exception("Failed to capture PayPal payment")
             
-            # Update payment status to "completed"
-            payment.status = "completed"
-            payment.gateway_response = response_data
-            payment.save()
+            # Mark the payment completed, unless a concurrent callback or verification already did
+            PaymentGatewayEvent.record(payment, 'capture', response_data)
+            payment.gateway_status = response_data.get("status")
+            payment.transition("completed", ['gateway_status'])
             
             return response_data
             
+        except PayPalUnavailable:
+            raise
         except Exception as e:
             logger.error(f"PayPal capture exception: {str(e)}")
             raise Exception(f"PayPal payment capture failed: {str(e)}")
     
     def verify_payment(self, payment):
-        """Verify the status of a PayPal payment"""
-        if not payment.gateway_response or "id" not in payment.gateway_response:
-            return payment  # Skip verification if no gateway response is available
+        """
+        Verify the status of a PayPal payment. Concurrent verifications of the
+        same payment are coalesced: one leader calls PayPal and every waiter
+        gets the leader's result.
+        """
+        if not payment.gateway_order_id:
+            return payment  # Skip verification if no PayPal order was created
 
-        order_id = payment.gateway_response["id"]
+        return self.verify_flight.do(str(payment.id), lambda: self._lead_verification(payment))
+
+    def _lead_verification(self, payment):
+        with cross_process_lock(f"payment-verify:{payment.id}") as leader:
+            if not leader:
+                # Another worker process just verified this payment; reuse what it saved
+                return Payment.objects.get(pk=payment.pk)
+            return self._verify_payment(payment)
+
+    def fetch_order(self, order_id):
+        """Get a PayPal order; raises when PayPal does not return it"""
         url = f"{self.base_url}/v2/checkout/orders/{order_id}"
 
         access_token = self.get_access_token()
@@ -172,29 +296,94 @@ class PayPalService:
             "Authorization": f"Bearer {access_token}"
         }
 
-        try:
-            response = requests.get(url, headers=headers)
-            response_data = response.json()
+        with span('paypal.verify_payment'):
+            response = self.http.get(url, 'verify_payment', headers=headers)
+        raise_for_overload(response, "order lookup")
+        response_data = response.json()
+        self._check_token_rejected(response)
 
-            if response.status_code != 200:
-                logger.error(f"PayPal verification error: {response_data}")
-                return payment
+        if response.status_code != 200:
+            logger.error(f"PayPal verification error: {response_data}")
+            raise Exception("Failed to get PayPal order")
 
-            # Update payment status based on PayPal status
-            paypal_status = response_data.get("status", "")
+        return response_data
 
-            if paypal_status == "COMPLETED":
-                payment.status = "completed"
-            elif paypal_status == "APPROVED":
-                payment.status = "processing"
-            elif paypal_status in ["VOIDED", "DECLINED"]:
-                payment.status = "failed"
+    def _verify_payment(self, payment):
+        try:
+            response_data = self.fetch_order(payment.gateway_order_id)
 
-            payment.gateway_response = response_data
-            payment.save()
+            # Update payment status based on PayPal status; a stale answer never moves a payment backwards
+            paypal_status = response_data.get("status", "")
+            PaymentGatewayEvent.record(payment, 'verify', response_data)
+            payment.gateway_status = paypal_status
+            payment.transition(PAYPAL_STATUS_MAP.get(paypal_status, payment.status), ['gateway_status'])
 
             return payment
 
+        except PayPalUnavailable:
+            # Left to the caller, e.g. the scheduler defers the verification
+            raise
         except Exception as e:
             logger.error(f"PayPal verification exception: {str(e)}")
             return payment
+
+    def verify_webhook_signature(self, headers, event):
+        """Ask PayPal whether a webhook event was signed by PayPal for our webhook; returns True if so"""
+        url = f"{self.base_url}/v1/notifications/verify-webhook-signature"
+
+        access_token = self.get_access_token()
+
+        request_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {access_token}"
+        }
+
+        data = {
+            "auth_algo": headers.get("PAYPAL-AUTH-ALGO"),
+            "cert_url": headers.get("PAYPAL-CERT-URL"),
+            "transmission_id": headers.get("PAYPAL-TRANSMISSION-ID"),
+            "transmission_sig": headers.get("PAYPAL-TRANSMISSION-SIG"),
+            "transmission_time": headers.get("PAYPAL-TRANSMISSION-TIME"),
+            "webhook_id": settings.PAYPAL_WEBHOOK_ID,
+            "webhook_event": event,
+        }
+
+        response = self.http.post(url, 'verify_webhook', json=data, headers=request_headers)
+        response_data = response.json()
+        self._check_token_rejected(response)
+
+        if response.status_code != 200:
+            logger.error(f"PayPal webhook verification error: {response_data}")
+            raise Exception("Failed to verify PayPal webhook signature")
+
+        return response_data.get("verification_status") == "SUCCESS"
+
+
+_paypal_service = None
+_paypal_service_pid = None
+_paypal_service_lock = threading.Lock()
+
+
+def get_paypal_service():
+    """Return the process-wide PayPalService so its connection pool is reused between requests"""
+    global _paypal_service, _paypal_service_pid
+
+    # A forked worker must not share the parent's sockets
+    if _paypal_service is not None and _paypal_service_pid == os.getpid():
+        return _paypal_service
+
+    with _paypal_service_lock:
+        if _paypal_service is None or _paypal_service_pid != os.getpid():
+            _paypal_service = PayPalService()
+            _paypal_service_pid = os.getpid()
+        return _paypal_service
+
+
+def reset_paypal_service():
+    """Drop the process-wide PayPalService so the next call builds one from the current environment"""
+    global _paypal_service
+    with _paypal_service_lock:
+        if _paypal_service is not None:
+            _paypal_service.http.close()
+        _paypal_service = None
+    reset_resilience()
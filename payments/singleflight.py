@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller (the leader)
+    runs the function and every caller arriving meanwhile gets its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines running on one event loop. If the leader is
+    cancelled, a waiter takes over and runs the function itself.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        while (future := self._calls.get(key)) is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # Only the leader was cancelled; try again
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when nobody was waiting
+            raise
+        finally:
+            del self._calls[key]
+            if not future.done():
+                future.cancel()
+
+
+def _advisory_lock_id(key):
+    # pg advisory locks take a signed 64-bit key
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big', signed=True)
+
+
+@contextmanager
+def _db_lock(key, timeout):
+    lock_id = _advisory_lock_id(key)
+    deadline = time.monotonic() + timeout
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+        if cursor.fetchone()[0]:
+            try:
+                yield True
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+            return
+
+        # Another process is the leader; wait for it to release the lock
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [lock_id])
+            if cursor.fetchone()[0]:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+                break
+    yield False
+
+
+@contextmanager
+def _cache_lock(key, timeout):
+    cache = caches[settings.PAYMENT_CACHE_ALIAS]
+    lock_key = f"lock:{key}"
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, timeout):
+        try:
+            yield True
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+        return
+
+    # Another process is the leader; wait for it to release the lock
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and cache.get(lock_key) is not None:
+        time.sleep(0.05)
+    yield False
+
+
+@contextmanager
+def cross_process_lock(key, timeout=None):
+    """
+    Elect one leader for `key` across worker processes. Yields True to the
+    leader; other callers block until the leader finishes (or `timeout`
+    passes) and get False.
+
+    settings.PAYMENT_VERIFY_LOCK selects the mechanism: 'db' uses Postgres
+    advisory locks (falling back to the cache elsewhere), 'cache' uses
+    cache.add on PAYMENT_CACHE_ALIAS, 'none' disables cross-process election.
+    """
+    timeout = timeout or settings.PAYMENT_VERIFY_LOCK_TIMEOUT
+    backend = settings.PAYMENT_VERIFY_LOCK
+
+    if backend == 'db' and connection.vendor == 'postgresql':
+        lock = _db_lock(key, timeout)
+    elif backend in ('db', 'cache'):
+        lock = _cache_lock(key, timeout)
+    else:
+        yield True
+        return
+
+    with lock as acquired:
+        yield acquired
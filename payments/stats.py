@@ -0,0 +1,105 @@
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth
+from rest_framework.exceptions import ValidationError
+
+from payments.models import Payment, PaymentStatsHour
+from payments.pagination import parse_datetime_param
+
+# ?interval= values; 'total' sums the whole range
+STATS_INTERVALS = ('hour', 'day', 'month', 'total')
+
+_TRUNCATE = {'day': TruncDay, 'month': TruncMonth}
+
+
+def payment_stats(params):
+    """
+    Counts and amounts per period, currency and status from the hourly
+    rollup. Query string: since, until (ISO date or datetime), currency,
+    status (comma separated), interval (hour, day, month or total; default day).
+    Periods are UTC.
+    """
+    interval = params.get('interval', 'day')
+    if interval not in STATS_INTERVALS:
+        raise ValidationError({"interval": f"Must be one of {', '.join(STATS_INTERVALS)}."})
+
+    queryset = PaymentStatsHour.objects.all()
+    since = params.get('since')
+    if since:
+        queryset = queryset.filter(hour__gte=parse_datetime_param('since', since))
+    until = params.get('until')
+    if until:
+        queryset = queryset.filter(hour__lt=parse_datetime_param('until', until))
+    currency = params.get('currency')
+    if currency:
+        queryset = queryset.filter(currency=currency.upper())
+    statuses = params.get('status')
+    if statuses:
+        queryset = queryset.filter(status__in=statuses.split(','))
+
+    group_by = ['currency', 'status']
+    if interval != 'total':
+        if interval == 'hour':
+            queryset = queryset.annotate(period=F('hour'))
+        else:
+            queryset = queryset.annotate(period=_TRUNCATE[interval]('hour', tzinfo=datetime.timezone.utc))
+        group_by.insert(0, 'period')
+
+    rows = (
+        queryset.values(*group_by)
+        .annotate(total_count=Sum('count'), total_amount=Sum('amount'))
+        .filter(total_count__gt=0)
+        .order_by(*group_by)
+    )
+    return [
+        dict(
+            {name: row[name] for name in group_by},
+            count=row['total_count'],
+            amount=row['total_amount'],
+        )
+        for row in rows
+    ]
+
+
+def rebuild_payment_stats(since=None):
+    """
+    Recompute the rollup from the payments table, for hours from `since`
+    (everything when None). Returns the number of rollup rows written.
+    """
+    if since is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    payments = Payment.objects.all()
+    rollup = PaymentStatsHour.objects.all()
+    if since is not None:
+        payments = payments.filter(created_at__gte=since)
+        rollup = rollup.filter(hour__gte=since)
+
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Writers wait until the rebuild commits, then apply their change on top of it
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {PaymentStatsHour._meta.db_table} IN EXCLUSIVE MODE")
+        rollup.delete()
+        rows = (
+            payments.annotate(bucket=TruncHour('created_at', tzinfo=datetime.timezone.utc))
+            .values('bucket', 'currency', 'status')
+            .annotate(total_count=Count('id'), total_amount=Sum('amount'))
+            .order_by()
+        )
+        created = PaymentStatsHour.objects.bulk_create(
+            (
+                PaymentStatsHour(
+                    hour=row['bucket'],
+                    currency=row['currency'],
+                    status=row['status'],
+                    count=row['total_count'],
+                    amount=row['total_amount'],
+                )
+                for row in rows.iterator()
+            ),
+            batch_size=1000,
+        )
+    return len(created)
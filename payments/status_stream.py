@@ -0,0 +1,166 @@
+"""
+Fan-out of payment status changes to clients waiting on the stream and
+long-poll endpoints.
+
+Every process keeps a StatusBroker with the asyncio queues of its waiting
+clients. On PostgreSQL a status change is sent with NOTIFY inside the
+transaction that makes it (so it is delivered on commit, to every worker)
+and a listener thread per process feeds the broker. On other databases the
+change is published to the local broker on commit; other processes notice
+it when their waiting clients re-read the row (PAYMENT_STREAM_RECHECK).
+"""
+import asyncio
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'payment_status'
+
+
+class Subscription:
+    """Status changes of one payment, for one waiting client on one event loop"""
+
+    def __init__(self, broker, payment_id):
+        self.broker = broker
+        self.payment_id = payment_id
+        self.queue = asyncio.Queue()
+        # Bound by the first get(): a streaming response may be iterated on another loop than the view ran on
+        self._loop = None
+        self._backlog = []
+        self._lock = threading.Lock()
+
+    def deliver(self, status):
+        with self._lock:
+            if self._loop is None:
+                self._backlog.append(status)
+                return
+            loop = self._loop
+        try:
+            loop.call_soon_threadsafe(self.queue.put_nowait, status)
+        except RuntimeError:
+            # The client's event loop is gone
+            self.broker.unsubscribe(self)
+
+    async def get(self, timeout):
+        """Next status, or None after `timeout` seconds without a change"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+                for status in self._backlog:
+                    self.queue.put_nowait(status)
+                self._backlog.clear()
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.broker.unsubscribe(self)
+
+
+class StatusBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, payment_id):
+        """Start receiving status changes; use as a context manager"""
+        subscription = Subscription(self, str(payment_id))
+        with self._lock:
+            self._subscriptions[subscription.payment_id].add(subscription)
+        ensure_listener()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.payment_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.payment_id]
+
+    def publish(self, payment_id, status):
+        """Hand a status change to every client waiting on the payment; safe from any thread"""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(str(payment_id), ()))
+        for subscription in subscriptions:
+            subscription.deliver(status)
+        return len(subscriptions)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+broker = StatusBroker()
+
+
+def _uses_notify(using='default'):
+    return connections[using].vendor == 'postgresql'
+
+
+def notify_status_change(payment_id, status, using='default'):
+    """Announce a payment's new status once the current transaction commits"""
+    if _uses_notify(using):
+        # NOTIFY is transactional: delivered on commit, dropped on rollback
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [NOTIFY_CHANNEL, f"{payment_id}:{status}"])
+    else:
+        transaction.on_commit(lambda: broker.publish(payment_id, status), using=using)
+
+
+class PostgresStatusListener(threading.Thread):
+    """LISTENs on a dedicated psycopg2 connection and publishes every notification to the local broker"""
+
+    def __init__(self, using='default'):
+        super().__init__(name='payment-status-listener', daemon=True)
+        self.using = using
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                logger.error(f"Payment status listener error: {str(e)}")
+                time.sleep(1)
+
+    def listen(self):
+        wrapper = connections[self.using]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    payment_id, _, status = conn.notifies.pop(0).payload.partition(':')
+                    broker.publish(payment_id, status)
+        finally:
+            conn.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def ensure_listener():
+    """Start this process's NOTIFY listener the first time a client waits (PostgreSQL only)"""
+    global _listener
+    if _listener is not None or not _uses_notify():
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = PostgresStatusListener()
+            _listener.start()
@@ -1,19 +1,70 @@
 
 # Create your tests here.
-from django.test import TestCase
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, AsyncRequestFactory, override_settings
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
+import asyncio
+import os
+import sys
 import uuid
+import requests
 import responses
-from .mocks.paypal_mock import mock_paypal_api
-from .models import Payment
+import csv
+import io
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.http import HttpResponse
+from django.utils import timezone
+from .mocks.paypal_mock import mock_paypal_api, mock_paypal_transport
+from .mocks.paypal_server import SimulatorConfig, start_simulator
+from .models import (
+    Payment,
+    IdempotencyKey,
+    OutboxEvent,
+    PaymentGatewayEvent,
+    PaymentStatsHour,
+    PayPalWebhookEvent,
+    bulk_create_payments,
+    bulk_delete_payments,
+    bulk_update_payments,
+)
+from . import async_views
+from .async_services import AsyncPayPalService, use_async_transport
+from .bench import compare, run_benchmark, serializer_benchmark
+from .http_client import PayPalHTTPClient
+from .metrics import REQUESTS, MetricsMiddleware
+from .outbox import OutboxDispatcher, sign_payload
+from .profiling import ProfilingMiddleware, histogram
+from .paypal_webhooks import process_pending_events
+from .reconcile import reconcile_payments
+from .resilience import AdaptiveLimiter, CircuitBreaker, PayPalUnavailable, RetryBudget
+from .serializers import PaymentSerializer, fast_payment_serializer
+from .scheduler import VerificationScheduler
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .status_stream import broker
+from .services import PayPalService, get_paypal_service
+from .token_cache import TokenCache, LocalTokenBackend, clear_token_caches
 
 
 
 class PaymentAPITest(TestCase):
     def setUp(self):
         self.client = APIClient()
+        mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
         
         # Create a test payment
         self.test_payment = Payment.objects.create(
@@ -80,3 +131,1629 @@ class PaymentAPITest(TestCase):
         
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data['status'], 'error')
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        clear_token_caches()
+
+    @responses.activate
+    def test_token_reused_across_calls(self):
+        """Test that consecutive PayPal calls share one OAuth token"""
+        mock_paypal_api()
+        service = PayPalService()
+
+        self.assertEqual(service.get_access_token(), "mock_access_token")
+        self.assertEqual(service.get_access_token(), "mock_access_token")
+
+        token_calls = [c for c in responses.calls if c.request.url.endswith("/v1/oauth2/token")]
+        self.assertEqual(len(token_calls), 1)
+
+    def test_token_refreshed_near_expiry(self):
+        """Test that a token inside the refresh margin is fetched again"""
+        token_cache = TokenCache(LocalTokenBackend("test"), refresh_margin=60)
+        fetch = mock.Mock(side_effect=[("first", 120), ("second", 3600)])
+
+        self.assertEqual(token_cache.get_token(fetch), "first")
+        self.assertEqual(token_cache.get_token(fetch), "first")
+        with mock.patch('payments.token_cache.time.time', return_value=time.time() + 61):
+            self.assertEqual(token_cache.get_token(fetch), "second")
+        self.assertEqual(token_cache.get_token(fetch), "second")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_short_lived_token_is_reused(self):
+        """Test that a token living less than the refresh margin is still reused for part of its lifetime"""
+        token_cache = TokenCache(LocalTokenBackend("test"), refresh_margin=60)
+        fetch = mock.Mock(side_effect=[("first", 30), ("second", 3600)])
+
+        self.assertEqual(token_cache.get_token(fetch), "first")
+        self.assertEqual(token_cache.get_token(fetch), "first")
+        with mock.patch('payments.token_cache.time.time', return_value=time.time() + 16):
+            self.assertEqual(token_cache.get_token(fetch), "second")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_token_invalidated_on_401(self):
+        """Test that a rejected token is dropped from the cache"""
+        service = PayPalService()
+        service.token_cache.backend.set({"access_token": "stale", "expires_at": float("inf")}, 3600)
+
+        service._check_token_rejected(mock.Mock(status_code=401))
+
+        self.assertIsNone(service.token_cache.backend.get())
+
+
+class PayPalHTTPClientTest(TestCase):
+    def test_service_is_process_singleton(self):
+        """Test that views share one PayPalService and connection pool"""
+        self.assertIs(get_paypal_service(), get_paypal_service())
+        self.assertIs(get_paypal_service().http, get_paypal_service().http)
+
+    @responses.activate
+    def test_requests_use_endpoint_timeouts_and_counters(self):
+        """Test that calls carry per-endpoint timeouts and are counted"""
+        mock_paypal_api()
+        client = PayPalHTTPClient(timeouts={'token': (1, 2)})
+
+        with mock.patch.object(client.session, 'request', wraps=client.session.request) as request:
+            client.post("https://api-m.sandbox.paypal.com/v1/oauth2/token", 'token')
+
+        self.assertEqual(request.call_args.kwargs['timeout'], (1, 2))
+        stats = client.stats()
+        self.assertEqual(stats['requests_total'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['peak_in_flight'], 1)
+
+
+class VerificationSchedulerTest(TestCase):
+    def setUp(self):
+        self.due_at = timezone.now() - timedelta(seconds=1)
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="processing",
+            gateway_status="CREATED",
+            gateway_order_id="mock_order_id",
+            verify_due_at=self.due_at
+        )
+
+    def test_scheduler_starts_with_the_application(self):
+        """Test that loading the WSGI or ASGI application starts the scheduler, recovering persisted verifications"""
+        for module in ('payment_gateway.wsgi', 'payment_gateway.asgi'):
+            scheduler = mock.Mock()
+            with self.subTest(module=module), \
+                    mock.patch('payments.scheduler.get_verification_scheduler', return_value=scheduler), \
+                    mock.patch.dict(os.environ):
+                sys.modules.pop(module, None)
+                import_module(module)
+
+            scheduler.start.assert_called_once_with()
+
+    @responses.activate
+    def test_create_order_persists_and_schedules_verification(self):
+        """Test that order creation queues a persisted verification instead of a thread"""
+        mock_paypal_api()
+        payment = Payment.objects.create(customer_name="John Doe", customer_email="john@example.com", amount=50, currency="USD")
+        scheduler = mock.Mock()
+
+        with mock.patch('payments.services.get_verification_scheduler', return_value=scheduler):
+            PayPalService().create_order(payment)
+
+        payment.refresh_from_db()
+        self.assertIsNotNone(payment.verify_due_at)
+        scheduler.schedule.assert_called_once_with(payment.id, payment.verify_due_at)
+
+    def test_completed_verification_is_cleared(self):
+        """Test that a verification reaching a terminal status is not retried"""
+        def verify(payment):
+            payment.status = "completed"
+            payment.save()
+            return payment
+
+        scheduler = VerificationScheduler(verify=verify)
+        scheduler._push(self.payment.id, self.due_at, 0)
+
+        self.assertEqual(scheduler.run_pending(), 1)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertIsNone(self.payment.verify_due_at)
+        self.assertEqual(scheduler.pending_count(), 0)
+
+    def test_pending_verification_backs_off(self):
+        """Test that a payment still processing is retried later"""
+        scheduler = VerificationScheduler(verify=lambda payment: payment)
+        scheduler._push(self.payment.id, self.due_at, 0)
+
+        scheduler.run_pending()
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.verify_attempts, 1)
+        self.assertGreater(self.payment.verify_due_at, timezone.now())
+        self.assertEqual(scheduler.pending_count(), 1)
+
+    def test_recovered_verification_runs_once(self):
+        """Test that two processes recovering the same row verify it only once"""
+        verify = mock.Mock(side_effect=lambda payment: payment)
+        first = VerificationScheduler(verify=verify)
+        second = VerificationScheduler(verify=verify)
+        first.recover()
+        second.recover()
+
+        first.run_pending()
+        second.run_pending()
+
+        self.assertEqual(verify.call_count, 1)
+
+
+class AsyncPaymentViewsTest(TestCase):
+    def setUp(self):
+        clear_token_caches()
+        use_async_transport(mock_paypal_transport())
+        self.factory = AsyncRequestFactory()
+        self.scheduler = mock.patch('payments.async_services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+
+    async def test_async_service_creates_order(self):
+        """Test that the async service creates an order over httpx"""
+        payment = await Payment.objects.acreate(customer_name="John Doe", customer_email="john@example.com", amount=50, currency="USD")
+        service = AsyncPayPalService(transport=mock_paypal_transport())
+
+        payment, approval_url = await service.create_order(payment)
+
+        self.assertEqual(approval_url, "https://approval-url.com")
+        self.assertEqual(payment.status, "processing")
+        event = await payment.gateway_events.alatest()
+        self.assertEqual(payment.gateway_order_id, event.payload["id"])
+        await service.aclose()
+
+    async def test_async_initiate_payment(self):
+        """Test creating a payment through the async view"""
+        request = self.factory.post('/api/v1/payments/', {
+            "customer_name": "John Doe",
+            "customer_email": "john@example.com",
+            "amount": 50.00,
+            "currency": "USD"
+        }, content_type='application/json')
+
+        response = await async_views.InitiatePaymentView.as_view()(request)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], 'success')
+        self.assertEqual(response.data['redirect_url'], 'https://approval-url.com')
+
+    async def test_async_get_nonexistent_payment(self):
+        """Test retrieving a non-existent payment through the async view"""
+        request = self.factory.get('/api/v1/payments/')
+
+        response = await async_views.PaymentDetailView.as_view()(request, id=uuid.uuid4())
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PaymentListPaginationTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        for i in range(5):
+            Payment.objects.create(
+                customer_name=f"User {i}",
+                customer_email=f"user{i}@example.com",
+                amount=10 + i,
+                currency="EUR" if i % 2 else "USD",
+                status="completed" if i < 3 else "pending"
+            )
+
+    def test_pages_follow_cursor_without_overlap(self):
+        """Test walking every page with the next cursor"""
+        url = reverse('payment-list')
+        seen = []
+        params = {"page_size": 2}
+
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(p['id'] for p in response.data['payments'])
+            if not response.data['next_cursor']:
+                break
+            params['cursor'] = response.data['next_cursor']
+
+        expected = [str(pk) for pk in Payment.objects.order_by('-created_at', '-id').values_list('id', flat=True)]
+        self.assertEqual(seen, expected)
+
+    def test_filters(self):
+        """Test filtering the list by status and currency"""
+        response = self.client.get(reverse('payment-list'), {"status": "completed", "currency": "usd"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['payments']), 2)
+        self.assertTrue(all(p['status'] == 'completed' and p['currency'] == 'USD' for p in response.data['payments']))
+
+    @override_settings(PAYMENT_LIST_MAX_PAGE_SIZE=3)
+    def test_page_size_is_capped(self):
+        """Test that page_size cannot exceed the configured maximum"""
+        response = self.client.get(reverse('payment-list'), {"page_size": 1000})
+
+        self.assertEqual(len(response.data['payments']), 3)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.client.get(reverse('payment-list'), {"cursor": "not-a-cursor"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['status'], 'error')
+
+
+class PaymentExportTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.old = Payment.objects.create(customer_name="Old User", customer_email="old@example.com", amount=10, currency="USD")
+        self.watermark = self.old.updated_at
+        self.new = Payment.objects.create(customer_name="New User", customer_email="new@example.com", amount=20, currency="EUR")
+
+    def test_ndjson_export_streams_every_payment(self):
+        """Test streaming all payments as NDJSON"""
+        response = self.client.get(reverse('payment-export'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [str(self.old.id), str(self.new.id)])
+        self.assertEqual(rows[1]['amount'], "20.00")
+
+    def test_csv_export_since_watermark(self):
+        """Test an incremental CSV export only includes newer updates"""
+        response = self.client.get(reverse('payment-export'), {"output": "csv", "since": self.watermark.isoformat()})
+
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0][0], "id")
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.new.id)])
+
+    def test_export_resumes_from_cursor(self):
+        """Test that payments sharing the watermark's updated_at are exported after the cursor's id"""
+        first, second = sorted([self.old, self.new], key=lambda payment: payment.id)
+        Payment.objects.filter(pk__in=[first.pk, second.pk]).update(updated_at=self.watermark)
+
+        response = self.client.get(reverse('payment-export'), {"since": self.watermark.isoformat(), "after": str(first.id)})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [str(second.id)])
+
+        response = self.client.get(reverse('payment-export'), {"since": self.watermark.isoformat(), "after": "not-an-id"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(PAYMENT_EXPORT_CHUNK_SIZE=1)
+    async def test_asgi_export_streams_page_by_page(self):
+        """Test that under ASGI the export is an async stream that reads one page at a time"""
+        response = await AsyncClient().get(reverse('payment-export'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_async)
+        chunks = aiter(response.streaming_content)
+        first = json.loads(await anext(chunks))
+        # Written after the first page was sent, so it is only exported if pages are read lazily
+        newest = await Payment.objects.acreate(customer_name="Newest User", customer_email="newest@example.com", amount=30, currency="USD")
+        rest = [json.loads(chunk) async for chunk in chunks]
+
+        self.assertEqual([first["id"]] + [row["id"] for row in rest], [str(self.old.id), str(self.new.id), str(newest.id)])
+
+    def test_export_command(self):
+        """Test the export_payments management command"""
+        out = io.StringIO()
+
+        call_command('export_payments', '--format', 'ndjson', stdout=out)
+
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class PayPalCallbackTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="processing",
+            gateway_status="CREATED",
+            gateway_order_id="ORDER123"
+        )
+
+    @responses.activate
+    def test_success_callback_resolves_payment_by_order_id(self):
+        """Test that the success callback captures the payment PayPal returns to"""
+        mock_paypal_api()
+
+        response = self.client.get(reverse('paypal-success'), {"token": "ORDER123"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['payment_id'], str(self.payment.id))
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertEqual(self.payment.gateway_order_id, "ORDER123")
+
+    def test_cancel_callback_resolves_payment_by_order_id(self):
+        """Test that the cancel callback fails the matching payment"""
+        response = self.client.get(reverse('paypal-cancel'), {"token": "ORDER123"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "failed")
+
+    def test_unknown_order_id(self):
+        """Test that an unknown PayPal token is a 404"""
+        response = self.client.get(reverse('paypal-cancel'), {"token": "UNKNOWN"})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class PaymentReadCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="completed"
+        )
+        self.url = reverse('payment-detail', args=[self.payment.id])
+
+    def test_terminal_payment_served_from_cache(self):
+        """Test that a repeated read of a completed payment skips the database"""
+        self.client.get(self.url)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['payment']['status'], 'completed')
+
+    def test_save_invalidates_cached_payment(self):
+        """Test that Payment.save() drops the cached entry"""
+        self.client.get(self.url)
+
+        self.payment.status = "refunded"
+        self.payment.save()
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['payment']['status'], 'refunded')
+
+    def test_pending_payment_verified_once_per_interval(self):
+        """Test that polling a pending payment verifies upstream at most once per interval"""
+        self.payment.status = "processing"
+        self.payment.save()
+        service = mock.Mock()
+        service.verify_payment.side_effect = lambda payment: payment
+
+        with mock.patch('payments.views.get_paypal_service', return_value=service):
+            for _ in range(3):
+                response = self.client.get(self.url)
+                self.assertEqual(response.data['payment']['status'], 'processing')
+
+        self.assertEqual(service.verify_payment.call_count, 1)
+
+
+class VerifyCoalescingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="processing",
+            gateway_order_id="ORDER123"
+        )
+
+    def test_concurrent_calls_share_one_execution(self):
+        """Test that concurrent callers with the same key run the function once"""
+        flight = SingleFlight()
+        calls = []
+        results = []
+        started = threading.Event()
+
+        def work():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "verified"
+
+        leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+        leader.start()
+        started.wait()
+        waiters = [threading.Thread(target=lambda: results.append(flight.do("key", work))) for _ in range(5)]
+        for thread in waiters:
+            thread.start()
+        for thread in [leader] + waiters:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["verified"] * 6)
+
+    async def test_waiter_takes_over_when_leader_is_cancelled(self):
+        """Test that cancelling the async leader does not leave its waiters hanging"""
+        flight = AsyncSingleFlight()
+        started = asyncio.Event()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            started.set()
+            await asyncio.sleep(0 if len(calls) > 1 else 10)
+            return "verified"
+
+        leader = asyncio.create_task(flight.do("key", work))
+        await started.wait()
+        waiter = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        self.assertEqual(await asyncio.wait_for(waiter, 1), "verified")
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(len(calls), 2)
+
+    def test_verify_waits_for_leader_in_other_process(self):
+        """Test that a payment being verified by another process is not verified again"""
+        cache.add(f"lock:payment-verify:{self.payment.id}", "other-process", 1)
+        service = PayPalService()
+
+        with override_settings(PAYMENT_VERIFY_LOCK_TIMEOUT=1), \
+                mock.patch.object(service, '_verify_payment') as upstream_verify:
+            payment = service.verify_payment(self.payment)
+
+        upstream_verify.assert_not_called()
+        self.assertEqual(payment.pk, self.payment.pk)
+
+
+class IdempotencyKeyTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('initiate-payment')
+        self.data = {
+            "customer_name": "John Doe",
+            "customer_email": "john@example.com",
+            "amount": 50.00,
+            "currency": "USD"
+        }
+
+    @responses.activate
+    def test_replay_returns_stored_response(self):
+        """Test that a retried request replays the first response without a second order"""
+        mock_paypal_api()
+
+        with mock.patch('payments.services.get_verification_scheduler'):
+            first = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-1")
+            second = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-1")
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.filter(customer_email="john@example.com").count(), 1)
+        order_calls = [c for c in responses.calls if c.request.url.endswith("/v2/checkout/orders")]
+        self.assertEqual(len(order_calls), 1)
+
+    def test_key_reused_with_different_request(self):
+        """Test that reusing a key for another payload is rejected"""
+        IdempotencyKey.objects.create(key="checkout-2", fingerprint="other", state="completed",
+                                      response_status=201, response_body={}, expires_at=timezone.now() + timedelta(hours=1))
+
+        response = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-2")
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    @override_settings(PAYMENT_IDEMPOTENCY_WAIT_TIMEOUT=0.2)
+    def test_duplicate_waits_for_in_progress_request(self):
+        """Test that a duplicate of a request still running gets 409 once the wait times out"""
+        IdempotencyKey.objects.create(key="checkout-3", fingerprint="pending", expires_at=timezone.now() + timedelta(hours=1),
+                                      locked_until=timezone.now() + timedelta(minutes=1))
+
+        with mock.patch('payments.idempotency.request_fingerprint', return_value="pending"):
+            response = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-3")
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(Payment.objects.filter(customer_email="john@example.com").exists())
+
+    @responses.activate
+    def test_stale_in_progress_key_is_taken_over(self):
+        """Test that a key left in progress by a request that died is taken over once its lease runs out"""
+        mock_paypal_api()
+        IdempotencyKey.objects.create(key="checkout-4", fingerprint="stale", expires_at=timezone.now() + timedelta(hours=1),
+                                      locked_until=timezone.now() - timedelta(seconds=1))
+
+        with mock.patch('payments.idempotency.request_fingerprint', return_value="stale"), \
+                mock.patch('payments.services.get_verification_scheduler'):
+            response = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-4")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        record = IdempotencyKey.objects.get(key="checkout-4")
+        self.assertEqual(record.state, 'completed')
+        self.assertEqual(record.response_status, status.HTTP_201_CREATED)
+
+    @responses.activate
+    def test_upstream_failure_is_not_replayed(self):
+        """Test that a PayPal failure answers 502 and releases the key for the retry"""
+        mock_paypal_api()
+        with mock.patch('payments.services.get_verification_scheduler'), \
+                mock.patch.object(PayPalService, 'submit_order', side_effect=Exception("declined")):
+            first = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-5")
+
+        self.assertEqual(first.status_code, status.HTTP_502_BAD_GATEWAY)
+        self.assertFalse(IdempotencyKey.objects.filter(key="checkout-5").exists())
+
+        with mock.patch('payments.services.get_verification_scheduler'):
+            second = self.client.post(self.url, self.data, format='json', HTTP_IDEMPOTENCY_KEY="checkout-5")
+
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', second)
+
+    def test_purge_expired_keys(self):
+        """Test that expired keys are purged"""
+        IdempotencyKey.objects.create(key="old", fingerprint="x", expires_at=timezone.now() - timedelta(seconds=1))
+        IdempotencyKey.objects.create(key="new", fingerprint="x", expires_at=timezone.now() + timedelta(hours=1))
+
+        call_command('purge_idempotency_keys', stdout=io.StringIO())
+
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ["new"])
+
+
+class BatchInitiatePaymentTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('batch-initiate-payment')
+        self.scheduler = mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _item(self, i, **overrides):
+        item = {"customer_name": f"User {i}", "customer_email": f"user{i}@example.com", "amount": 10 + i, "currency": "USD"}
+        item.update(overrides)
+        return item
+
+    @responses.activate
+    def test_batch_creates_every_payment(self):
+        """Test initiating a batch of valid payments"""
+        mock_paypal_api()
+
+        response = self.client.post(self.url, {"payments": [self._item(i) for i in range(3)]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([r['status'] for r in response.data['results']], ['success'] * 3)
+        self.assertEqual(Payment.objects.filter(status='processing').count(), 3)
+        self.assertEqual(len(set(Payment.objects.values_list('gateway_order_id', flat=True))), 3)
+
+    @responses.activate
+    def test_batch_reports_partial_failures(self):
+        """Test that invalid items and PayPal failures are reported per item"""
+        mock_paypal_api()
+        items = [self._item(0), self._item(1, amount=-5), self._item(2, customer_name="Declined")]
+        original_submit = PayPalService.submit_order
+
+        def submit_order(service, payment):
+            if payment.customer_name == "Declined":
+                raise Exception("Failed to create PayPal order")
+            return original_submit(service, payment)
+
+        with mock.patch.object(PayPalService, 'submit_order', submit_order):
+            response = self.client.post(self.url, items, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['status'], 'partial')
+        results = response.data['results']
+        self.assertEqual(results[0]['status'], 'success')
+        self.assertIn('amount', results[1]['errors'])
+        self.assertEqual(results[2]['status'], 'error')
+        self.assertEqual(results[2]['payment']['status'], 'failed')
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_batch_answers_503_when_paypal_is_unavailable(self):
+        """Test that a batch refused only by a PayPal outage asks the client to retry after the longest wait"""
+        def submit_order(service, payment):
+            raise PayPalUnavailable("PayPal order creation returned 503", retry_after=30 if payment.customer_name == "User 1" else 5)
+
+        with mock.patch.object(PayPalService, 'submit_order', submit_order):
+            response = self.client.post(self.url, [self._item(i) for i in range(3)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(response.data['status'], 'error')
+        self.assertEqual(Payment.objects.filter(status='failed', failure_reason='paypal_unavailable').count(), 3)
+
+    @override_settings(PAYMENT_BATCH_MAX_SIZE=2)
+    def test_batch_size_is_capped(self):
+        """Test that oversized batches are rejected"""
+        response = self.client.post(self.url, [self._item(i) for i in range(3)], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(PAYMENT_WEBHOOK_URL="https://merchant.example.com/webhooks", PAYMENT_WEBHOOK_SECRET="whsec")
+class OutboxTest(TestCase):
+    def _payment(self, name="Outbox User"):
+        return Payment.objects.create(
+            customer_name=name, customer_email="outbox@example.com", amount=20, currency="USD", status="pending"
+        )
+
+    def test_status_changes_are_written_to_the_outbox(self):
+        """Test that each status change, and only a change, records an outbox event"""
+        payment = self._payment()
+        self.assertFalse(OutboxEvent.objects.exists())
+
+        payment.status = "processing"
+        payment.save()
+        payment.save()
+        Payment.objects.get(pk=payment.pk).save()
+
+        payment = Payment.objects.get(pk=payment.pk)
+        payment.status = "completed"
+        payment.save()
+
+        events = list(OutboxEvent.objects.order_by('id'))
+        self.assertEqual([e.event_type for e in events], ["payment.processing", "payment.completed"])
+        self.assertEqual(events[1].payload["previous_status"], "processing")
+        self.assertEqual(events[1].payload["payment_id"], str(payment.pk))
+
+    @responses.activate
+    def test_dispatcher_delivers_signed_webhooks_in_order(self):
+        """Test webhook delivery, signing and per-payment ordering"""
+        responses.add(responses.POST, "https://merchant.example.com/webhooks", status=200)
+        payment = self._payment()
+        for new_status in ("processing", "completed"):
+            payment.status = new_status
+            payment.save()
+
+        delivered = OutboxDispatcher(workers=1).dispatch_once()
+
+        self.assertEqual(delivered, 2)
+        self.assertFalse(OutboxEvent.objects.filter(delivered_at__isnull=True).exists())
+        bodies = [json.loads(call.request.body) for call in responses.calls]
+        self.assertEqual([b["type"] for b in bodies], ["payment.processing", "payment.completed"])
+
+        request = responses.calls[0].request
+        timestamp = request.headers["X-Webhook-Signature"].split(",")[0][2:]
+        self.assertEqual(request.headers["X-Webhook-Signature"], sign_payload(request.body, timestamp, "whsec"))
+
+    @responses.activate
+    def test_failed_delivery_backs_off_and_holds_back_later_events(self):
+        """Test that a failure blocks only the same payment's later events"""
+        failing, other = self._payment("Failing"), self._payment("Other")
+
+        def callback(request):
+            body = json.loads(request.body)
+            code = 500 if body["data"]["payment_id"] == str(failing.pk) else 200
+            return code, {}, ""
+
+        responses.add_callback(responses.POST, "https://merchant.example.com/webhooks", callback=callback)
+        for payment in (failing, other):
+            for new_status in ("processing", "completed"):
+                payment.status = new_status
+                payment.save()
+
+        dispatcher = OutboxDispatcher(workers=1)
+        self.assertEqual(dispatcher.dispatch_once(), 2)
+        self.assertEqual(dispatcher.failed, 1)
+
+        first, second = OutboxEvent.objects.filter(payment=failing).order_by('id')
+        self.assertEqual(first.attempts, 1)
+        self.assertGreater(first.next_attempt_at, timezone.now())
+        self.assertEqual(second.attempts, 0)
+
+        # Even once the later event is due, it waits for the first one
+        self.assertEqual(dispatcher.dispatch_once(now=timezone.now()), 0)
+        self.assertEqual(len(responses.calls), 3)
+
+
+@override_settings(PAYPAL_WEBHOOK_ID="WH-TEST")
+class PayPalWebhookTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('paypal-webhook')
+        self.headers = {
+            "HTTP_PAYPAL_AUTH_ALGO": "SHA256withRSA",
+            "HTTP_PAYPAL_CERT_URL": "https://api.sandbox.paypal.com/cert.pem",
+            "HTTP_PAYPAL_TRANSMISSION_ID": "transmission",
+            "HTTP_PAYPAL_TRANSMISSION_SIG": "signature",
+            "HTTP_PAYPAL_TRANSMISSION_TIME": "2025-03-24T10:00:00Z",
+        }
+        self.payment = Payment.objects.create(
+            customer_name="Webhook User", customer_email="webhook@example.com", amount=30, currency="USD",
+            status="processing", gateway_order_id="ORDER-WH-1",
+        )
+
+    def _event(self, event_id, event_type, create_time):
+        if event_type.startswith("CHECKOUT.ORDER."):
+            resource = {"id": "ORDER-WH-1"}
+        else:
+            resource = {"id": "CAPTURE-1", "supplementary_data": {"related_ids": {"order_id": "ORDER-WH-1"}}}
+        return {"id": event_id, "event_type": event_type, "create_time": create_time, "resource": resource}
+
+    def test_receiver_stores_each_event_once(self):
+        """Test that events are stored without touching the payment, and redeliveries are dropped"""
+        event = self._event("WH-1", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:00:00Z")
+
+        for _ in range(2):
+            response = self.client.post(self.url, event, format='json', **self.headers)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        stored = PayPalWebhookEvent.objects.get()
+        self.assertEqual(stored.gateway_order_id, "ORDER-WH-1")
+        self.assertEqual(stored.headers["PAYPAL-TRANSMISSION-ID"], "transmission")
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "processing")
+
+        response = self.client.post(self.url, event, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @responses.activate
+    def test_late_events_do_not_override_newer_ones(self):
+        """Test that events delivered out of order never move a payment backwards"""
+        mock_paypal_api()
+        self.client.post(self.url, self._event("WH-2", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:05:00Z"), format='json', **self.headers)
+
+        self.assertEqual(process_pending_events(), {'applied': 1, 'ignored': 0, 'rejected': 0})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertEqual(OutboxEvent.objects.get().event_type, "payment.completed")
+
+        # An older event delivered late, and a newer one that would regress the status
+        self.client.post(self.url, self._event("WH-1", "CHECKOUT.ORDER.APPROVED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+        self.client.post(self.url, self._event("WH-3", "CHECKOUT.ORDER.APPROVED", "2025-03-24T10:06:00Z"), format='json', **self.headers)
+
+        self.assertEqual(process_pending_events(), {'applied': 0, 'ignored': 2, 'rejected': 0})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertFalse(PayPalWebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+    @responses.activate
+    def test_completed_payment_is_not_failed_by_a_later_event(self):
+        """Test that completed and failed are not swapped back and forth by events of either kind"""
+        mock_paypal_api()
+        self.client.post(self.url, self._event("WH-1", "PAYMENT.CAPTURE.DENIED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+        self.client.post(self.url, self._event("WH-2", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:05:00Z"), format='json', **self.headers)
+        self.client.post(self.url, self._event("WH-3", "CHECKOUT.ORDER.VOIDED", "2025-03-24T10:06:00Z"), format='json', **self.headers)
+
+        self.assertEqual(process_pending_events(), {'applied': 2, 'ignored': 1, 'rejected': 0})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertEqual(PayPalWebhookEvent.objects.get(event_id="WH-3").state, 'ignored')
+
+    def test_unverified_events_are_rejected(self):
+        """Test that events PayPal did not sign leave the payment unchanged"""
+        self.client.post(self.url, self._event("WH-1", "CHECKOUT.ORDER.VOIDED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+        service = mock.Mock(verify_webhook_signature=mock.Mock(return_value=False))
+
+        counts = process_pending_events(service=service)
+
+        self.assertEqual(counts['rejected'], 1)
+        self.assertEqual(PayPalWebhookEvent.objects.get().state, 'rejected')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "processing")
+
+    def test_unverifiable_event_does_not_block_the_queue(self):
+        """Test that an event whose signature check fails is retried later while the next one is applied"""
+        self.client.post(self.url, self._event("WH-1", "CHECKOUT.ORDER.VOIDED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+        self.client.post(self.url, self._event("WH-2", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:05:00Z"), format='json', **self.headers)
+
+        def verify(headers, payload):
+            if payload["id"] == "WH-1":
+                raise Exception("PayPal unreachable")
+            return True
+
+        service = mock.Mock(verify_webhook_signature=mock.Mock(side_effect=verify))
+
+        self.assertEqual(process_pending_events(batch_size=1, service=service), {'applied': 0, 'ignored': 0, 'rejected': 0})
+        deferred = PayPalWebhookEvent.objects.get(event_id="WH-1")
+        self.assertEqual(deferred.attempts, 1)
+        self.assertGreater(deferred.next_attempt_at, timezone.now())
+
+        self.assertEqual(process_pending_events(batch_size=1, service=service), {'applied': 1, 'ignored': 0, 'rejected': 0})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "completed")
+        self.assertIsNone(PayPalWebhookEvent.objects.get(event_id="WH-1").processed_at)
+
+    @override_settings(PAYPAL_WEBHOOK_ID="", DEBUG=True)
+    def test_missing_webhook_id_rejects_events_in_debug(self):
+        """Test that events are only accepted unverified when explicitly allowed"""
+        self.client.post(self.url, self._event("WH-1", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+        self.assertEqual(process_pending_events(), {'applied': 0, 'ignored': 0, 'rejected': 1})
+
+        self.client.post(self.url, self._event("WH-2", "PAYMENT.CAPTURE.COMPLETED", "2025-03-24T10:05:00Z"), format='json', **self.headers)
+        with override_settings(PAYPAL_WEBHOOK_SKIP_VERIFICATION=True):
+            self.assertEqual(process_pending_events(), {'applied': 1, 'ignored': 0, 'rejected': 0})
+
+    @responses.activate
+    def test_refund_event_needs_a_completed_payment(self):
+        """Test that events follow Payment.STATUS_TRANSITIONS, e.g. processing cannot jump to refunded"""
+        mock_paypal_api()
+        self.client.post(self.url, self._event("WH-1", "PAYMENT.CAPTURE.REFUNDED", "2025-03-24T10:00:00Z"), format='json', **self.headers)
+
+        self.assertEqual(process_pending_events(), {'applied': 0, 'ignored': 1, 'rejected': 0})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, "processing")
+
+
+class ReconcilePaymentsTest(TestCase):
+    def _payment(self, status, order_id=None, age=3600):
+        payment = Payment.objects.create(
+            customer_name="Reconcile User", customer_email="reconcile@example.com", amount=40, currency="USD",
+            status=status, gateway_order_id=order_id,
+        )
+        Payment.objects.filter(pk=payment.pk).update(updated_at=timezone.now() - timedelta(seconds=age))
+        return payment
+
+    @responses.activate
+    def test_stale_payments_are_verified_in_chunks(self):
+        """Test that only stale payments with an order are checked, and changes are recorded"""
+        mock_paypal_api()
+        stale = [self._payment("processing", f"ORDER-R{i}") for i in range(3)]
+        fresh = self._payment("processing", "ORDER-FRESH", age=10)
+        no_order = self._payment("pending")
+
+        stats = reconcile_payments(stale_after=600, chunk_size=2, workers=2, rate=0, service=PayPalService())
+
+        self.assertEqual((stats.scanned, stats.verified, stats.changed, stats.errors), (3, 3, 3, 0))
+        self.assertGreaterEqual(stats.max_lag, 3600)
+        for payment in stale:
+            payment.refresh_from_db()
+            self.assertEqual(payment.status, "completed")
+        fresh.refresh_from_db()
+        no_order.refresh_from_db()
+        self.assertEqual((fresh.status, no_order.status), ("processing", "pending"))
+        self.assertEqual(OutboxEvent.objects.filter(event_type="payment.completed").count(), 3)
+
+        # Verified payments are not rechecked by the next sweep
+        self.assertEqual(reconcile_payments(stale_after=600, rate=0, service=PayPalService()).scanned, 0)
+
+    def test_failed_verifications_are_counted_and_left_unchanged(self):
+        """Test that PayPal errors leave the payment for the next sweep"""
+        payment = self._payment("processing", "ORDER-ERR")
+        service = mock.Mock(fetch_order=mock.Mock(side_effect=Exception("PayPal unavailable")))
+
+        stats = reconcile_payments(stale_after=600, rate=0, service=service)
+
+        self.assertEqual((stats.scanned, stats.verified, stats.errors), (1, 0, 1))
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, "processing")
+        self.assertEqual(reconcile_payments(stale_after=600, rate=0, service=service).scanned, 1)
+
+    def test_capture_during_sweep_is_kept(self):
+        """Test that a payment captured while PayPal was being asked is not written back to its old status"""
+        payment = self._payment("processing", "ORDER-RACE")
+        # Loaded by the sweep, then captured before PayPal's (older) answer is applied
+        swept = Payment.objects.get(pk=payment.pk)
+        payment.transition("completed")
+        service = mock.Mock(fetch_order=mock.Mock(return_value={"id": "ORDER-RACE", "status": "APPROVED"}))
+
+        with mock.patch('payments.reconcile.iter_stale_chunks', return_value=[[swept]]):
+            stats = reconcile_payments(stale_after=600, rate=0, service=service)
+
+        self.assertEqual((stats.verified, stats.changed), (1, 0))
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, "completed")
+        self.assertEqual(PaymentStatsHour.objects.get(status="completed").count, 1)
+
+
+class PayPalSimulatorTest(TestCase):
+    def _start(self, **config):
+        server = start_simulator(config=SimulatorConfig(**config))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_service_runs_the_order_lifecycle_against_the_simulator(self):
+        """Test create, verify and capture through PAYPAL_API_URL"""
+        server = self._start()
+        with mock.patch.dict(os.environ, {"PAYPAL_API_URL": server.url, "PAYPAL_CLIENT_ID": "simulator"}):
+            service = PayPalService(http_client=PayPalHTTPClient())
+        self.addCleanup(service.http.close)
+        self.addCleanup(service.token_cache.clear)
+        mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+
+        payments = [
+            Payment.objects.create(customer_name=f"Sim {i}", customer_email="sim@example.com", amount=10, currency="USD")
+            for i in range(2)
+        ]
+        for payment in payments:
+            service.create_order(payment)
+        self.assertNotEqual(payments[0].gateway_order_id, payments[1].gateway_order_id)
+
+        payment = service.verify_payment(payments[0])
+        self.assertEqual(payment.status, "processing")  # APPROVED
+
+        service.capture_payment(payment)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, "completed")
+        with self.assertRaises(Exception):
+            service.capture_payment(payment)
+
+        calls = requests.get(f"{server.url}/__simulator/stats").json()["calls"]
+        self.assertEqual(calls["token"], 1)
+        self.assertEqual(calls["create_order"], 2)
+
+    def test_expired_tokens_and_throttling(self):
+        """Test 401 for an expired token and 429 above the rate limit"""
+        server = self._start(token_ttl=0)
+        token = requests.post(f"{server.url}/v1/oauth2/token", auth=("id", "secret")).json()["access_token"]
+        response = requests.get(f"{server.url}/v2/checkout/orders/UNKNOWN", headers={"Authorization": f"Bearer {token}"})
+        self.assertEqual(response.status_code, 401)
+
+        server = self._start(rate_limit=2)
+        codes = [requests.post(f"{server.url}/v1/oauth2/token", auth=("id", "secret")).status_code for _ in range(4)]
+        self.assertEqual(codes[:2], [200, 200])
+        self.assertIn(429, codes[2:])
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark_reports_every_operation(self):
+        """Test a small benchmark run against the in-process simulator"""
+        mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+
+        results, benchmark = run_benchmark(
+            workload='poll-heavy', concurrency=1, requests=30, seed_payments=3, simulator=SimulatorConfig(), seed=1,
+        )
+
+        self.assertEqual(sum(op["count"] for op in results["operations"].values()), 30)
+        self.assertEqual(sum(op["errors"] for op in results["operations"].values()), 0)
+        self.assertGreater(results["operations"]["poll"]["count"], results["operations"]["create"]["count"])
+        self.assertIn("p99", results["operations"]["poll"]["latency_ms"])
+        self.assertEqual(results["upstream_calls"]["create_order"], results["operations"]["create"]["count"])
+        self.assertEqual(benchmark.created_payments().count(), 3 + results["operations"]["create"]["count"])
+        json.dumps(results)
+
+        self.assertTrue(compare(results, results)[0].startswith("throughput"))
+
+
+class ProfilingMiddlewareTest(TestCase):
+    def setUp(self):
+        mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(histogram.clear)
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        self.profile_dir = profile_dir.name
+
+    @responses.activate
+    def test_spans_are_reported_per_request(self):
+        """Test Server-Timing spans, the rolling histogram and sampled profiles"""
+        mock_paypal_api()
+        data = {"customer_name": "Profiled", "customer_email": "profiled@example.com", "amount": 12, "currency": "USD"}
+
+        with override_settings(PAYMENT_PROFILING=True, PAYMENT_PROFILING_SAMPLE_RATE=1.0,
+                               PAYMENT_PROFILING_SLOW_MS=0, PAYMENT_PROFILING_DIR=self.profile_dir):
+            response = APIClient().post(reverse('initiate-payment'), data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        timing = response['Server-Timing']
+        for name in ('db;', 'paypal.create_order;', 'serialize;', 'total;'):
+            self.assertIn(name, timing)
+        self.assertIn('queries"', timing)
+        self.assertEqual(histogram.snapshot()['initiate-payment']['paypal.create_order']['count'], 1)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+
+    def test_disabled_by_default(self):
+        """Test that requests carry no Server-Timing header unless profiling is on"""
+        response = APIClient().get(reverse('payment-list'))
+
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(histogram.snapshot(), {})
+    def test_middleware_runs_natively_under_asgi(self):
+        """Test that the middleware does not force async requests through a thread"""
+        async def get_response(request):
+            return HttpResponse()
+
+        with override_settings(PAYMENT_PROFILING=True):
+            self.assertTrue(iscoroutinefunction(ProfilingMiddleware(get_response)))
+            self.assertFalse(iscoroutinefunction(ProfilingMiddleware(lambda request: HttpResponse())))
+
+    async def test_async_request_is_profiled(self):
+        """Test that queries run by a view under the ASGI handler are counted"""
+        await Payment.objects.acreate(customer_name="Async", customer_email="async@example.com", amount=5, currency="USD")
+
+        with override_settings(PAYMENT_PROFILING=True, PAYMENT_PROFILING_SAMPLE_RATE=0.0):
+            response = await AsyncClient().get(reverse('payment-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('db;', response['Server-Timing'])
+        self.assertIn('payment-list', histogram.snapshot())
+
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        mock.patch('payments.services.get_verification_scheduler').start()
+        self.addCleanup(mock.patch.stopall)
+
+    @responses.activate
+    def test_metrics_endpoint(self):
+        """Test request, PayPal latency and payment status metrics at /metrics"""
+        mock_paypal_api()
+        Payment.objects.create(customer_name="Done", customer_email="done@example.com", amount=5, status="completed")
+        data = {"customer_name": "Metered", "customer_email": "metered@example.com", "amount": 12, "currency": "USD"}
+        self.assertEqual(APIClient().post(reverse('initiate-payment'), data, format='json').status_code, 201)
+
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('payment_http_requests_total{method="POST",status="201",view="initiate-payment"}', body)
+        self.assertIn('paypal_request_duration_seconds_count{operation="create_order"}', body)
+        self.assertIn('payments{status="completed"} 1.0', body)
+
+    def test_status_gauge_does_not_scan_payments(self):
+        """Test that the status gauge comes from the hourly statistics and is reused between scrapes"""
+        Payment.objects.create(customer_name="Done", customer_email="done@example.com", amount=5, status="completed")
+
+        with CaptureQueriesContext(connection) as queries:
+            body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('payments{status="completed"} 1.0', body)
+        self.assertFalse([query for query in queries if 'payments_payment"' in query['sql']])
+
+        Payment.objects.create(customer_name="Done", customer_email="done@example.com", amount=5, status="completed")
+        with self.assertNumQueries(0):
+            body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('payments{status="completed"} 1.0', body)
+
+    def test_middleware_runs_natively_under_asgi(self):
+        """Test that the middleware does not force async requests through a thread"""
+        async def get_response(request):
+            return HttpResponse()
+
+        self.assertTrue(iscoroutinefunction(MetricsMiddleware(get_response)))
+        self.assertFalse(iscoroutinefunction(MetricsMiddleware(lambda request: HttpResponse())))
+
+    async def test_async_request_is_counted(self):
+        """Test that a request through the ASGI handler is counted"""
+        before = REQUESTS.labels('payment-list', 'GET', '200')._value.get()
+        response = await AsyncClient().get(reverse('payment-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(REQUESTS.labels('payment-list', 'GET', '200')._value.get(), before + 1)
+
+
+@override_settings(PAYPAL_RETRY_BACKOFF_BASE=0.001)
+class PayPalResilienceTest(TestCase):
+    ORDER_URL = "https://api-m.sandbox.paypal.com/v2/checkout/orders/ORDER1"
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_rate=0.5, min_calls=10, window=60, reset_timeout=60)
+        self.client_ = PayPalHTTPClient(breaker=self.breaker, budget=RetryBudget(), limiter=AdaptiveLimiter(initial=10))
+
+    @responses.activate
+    def test_idempotent_calls_are_retried(self):
+        """Test that a GET retries a 503 and a POST only retries with a PayPal-Request-Id"""
+        responses.get(self.ORDER_URL, status=503)
+        responses.get(self.ORDER_URL, json={"status": "APPROVED"})
+        self.assertEqual(self.client_.get(self.ORDER_URL, 'verify_payment').status_code, 200)
+
+        responses.post(self.ORDER_URL, status=503)
+        responses.post(self.ORDER_URL, status=503)
+        responses.post(self.ORDER_URL, json={}, status=201)
+        self.assertEqual(self.client_.post(self.ORDER_URL, 'create_order').status_code, 503)
+        response = self.client_.post(self.ORDER_URL, 'create_order', headers={"PayPal-Request-Id": "payment-1"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client_.stats()["retries_total"], 2)
+
+    def test_retry_budget_runs_out(self):
+        """Test that retries stop once the budget is spent"""
+        budget = RetryBudget(ratio=0.1, min_per_second=0.1)
+
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        for _ in range(10):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_open_circuit_fails_fast(self):
+        """Test that an open circuit refuses payments with a 503 instead of calling PayPal"""
+        for _ in range(10):
+            self.breaker.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        service = PayPalService(http_client=self.client_)
+        service.token_cache.invalidate()
+        data = {"customer_name": "Jane", "customer_email": "jane@example.com", "amount": 10, "currency": "USD"}
+
+        with mock.patch('payments.views.get_paypal_service', return_value=service), \
+                mock.patch.object(self.client_.session, 'request') as request:
+            response = APIClient().post(reverse('initiate-payment'), data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertGreater(int(response['Retry-After']), 0)
+        request.assert_not_called()
+        # Nothing was created upstream, so no row is left pending without a way to resume it
+        payment = Payment.objects.get()
+        self.assertEqual((payment.status, payment.failure_reason), ("failed", "paypal_unavailable"))
+
+    @responses.activate
+    def test_overloaded_order_creation_fails_payment_with_reason(self):
+        """Test that a create_order still answered with 503 after the retries is PayPalUnavailable and an outage failure"""
+        responses.post("https://api-m.sandbox.paypal.com/v1/oauth2/token", json={"access_token": "T", "expires_in": 3600})
+        responses.post("https://api-m.sandbox.paypal.com/v2/checkout/orders", status=503, headers={"Retry-After": "7"})
+        service = PayPalService(http_client=PayPalHTTPClient(
+            breaker=self.breaker, budget=RetryBudget(), limiter=AdaptiveLimiter(initial=10), max_retries=0
+        ))
+        service.token_cache.invalidate()
+        payment = Payment.objects.create(customer_name="Jane", customer_email="jane@example.com", amount=10)
+
+        with self.assertRaises(PayPalUnavailable) as raised:
+            service.create_order(payment)
+
+        self.assertEqual(raised.exception.retry_after, 7)
+        payment = Payment.objects.get(pk=payment.pk)
+        self.assertEqual((payment.status, payment.failure_reason), ("failed", "paypal_unavailable"))
+        self.assertEqual(OutboxEvent.objects.get().payload["failure_reason"], "paypal_unavailable")
+        self.assertFalse(Payment.objects.filter(status="pending").exists())
+
+    def overloaded_service(self):
+        responses.post("https://api-m.sandbox.paypal.com/v1/oauth2/token", json={"access_token": "T", "expires_in": 3600})
+        service = PayPalService(http_client=PayPalHTTPClient(
+            breaker=self.breaker, budget=RetryBudget(), limiter=AdaptiveLimiter(initial=10), max_retries=0
+        ))
+        service.token_cache.invalidate()
+        return service
+
+    @responses.activate
+    def test_overloaded_verification_is_deferred(self):
+        """Test that a verification still answered with 503 is deferred without using up an attempt"""
+        responses.get(self.ORDER_URL, status=503, headers={"Retry-After": "30"})
+        service = self.overloaded_service()
+        due_at = timezone.now() - timedelta(seconds=1)
+        payment = Payment.objects.create(customer_name="Jane", customer_email="jane@example.com", amount=10,
+                                         status="processing", gateway_order_id="ORDER1", verify_due_at=due_at)
+        scheduler = VerificationScheduler(verify=service.verify_payment, max_attempts=5)
+
+        scheduler._verify(payment.id, due_at, 0)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, "processing")
+        self.assertEqual(payment.verify_attempts, 0)
+        self.assertGreater(payment.verify_due_at, timezone.now() + timedelta(seconds=20))
+
+    @responses.activate
+    def test_overloaded_capture_answers_503(self):
+        """Test that a capture still answered with 503 is a 503 with PayPal's Retry-After"""
+        responses.post(f"{self.ORDER_URL}/capture", status=503, headers={"Retry-After": "9"})
+        service = self.overloaded_service()
+        Payment.objects.create(customer_name="Jane", customer_email="jane@example.com", amount=10,
+                               status="processing", gateway_order_id="ORDER1")
+
+        with mock.patch('payments.views.get_paypal_service', return_value=service):
+            response = APIClient().get(reverse('paypal-success'), {"token": "ORDER1"})
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], "9")
+        self.assertEqual(Payment.objects.get().status, "processing")
+
+    def test_half_open_probe_closes_circuit(self):
+        """Test that one successful probe after the reset timeout closes the circuit"""
+        breaker = CircuitBreaker(failure_rate=0.5, min_calls=1, window=60, reset_timeout=0.01)
+        breaker.record(False)
+        time.sleep(0.02)
+
+        breaker.before_call()
+        with self.assertRaises(PayPalUnavailable):
+            breaker.before_call()
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @responses.activate
+    def test_probe_released_when_limiter_is_full(self):
+        """Test that a half-open probe refused by the concurrency limit does not wedge the circuit"""
+        breaker = CircuitBreaker(failure_rate=0.5, min_calls=1, window=60, reset_timeout=0.01)
+        limiter = AdaptiveLimiter(initial=1, min_limit=1, wait=0)
+        client = PayPalHTTPClient(breaker=breaker, budget=RetryBudget(), limiter=limiter, max_retries=0)
+        breaker.record(False)
+        time.sleep(0.02)
+
+        limiter.acquire()
+        with self.assertRaises(PayPalUnavailable):
+            client.get(self.ORDER_URL, 'verify_payment')
+        limiter.release(overloaded=False)
+
+        responses.get(self.ORDER_URL, json={"status": "APPROVED"})
+        self.assertEqual(client.get(self.ORDER_URL, 'verify_payment').status_code, 200)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_concurrency_limit_adapts(self):
+        """Test additive increase on success and multiplicative decrease on overload"""
+        limiter = AdaptiveLimiter(initial=10, min_limit=2, max_limit=20, backoff=0.5, wait=0)
+
+        limiter.acquire()
+        limiter.release(overloaded=False)
+        self.assertAlmostEqual(limiter.limit, 10.1)
+        limiter.acquire()
+        limiter.release(overloaded=True)
+        self.assertAlmostEqual(limiter.limit, 5.05)
+
+        for _ in range(5):
+            limiter.acquire()
+        with self.assertRaises(PayPalUnavailable):
+            limiter.acquire()
+
+    def test_unavailable_verification_is_deferred(self):
+        """Test that a verification refused by the breaker is rescheduled without using an attempt"""
+        due_at = timezone.now() - timedelta(seconds=1)
+        payment = Payment.objects.create(
+            customer_name="Test User", customer_email="test@example.com", amount=10, status="processing",
+            gateway_order_id="ORDER1", verify_due_at=due_at, verify_attempts=2,
+        )
+
+        def verify(payment):
+            raise PayPalUnavailable("PayPal circuit breaker is open", retry_after=30)
+
+        scheduler = VerificationScheduler(verify=verify)
+        scheduler._push(payment.id, due_at, 2)
+        scheduler.run_pending()
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.verify_attempts, 2)
+        self.assertGreater(payment.verify_due_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(scheduler.pending_count(), 1)
+
+
+class FastSerializationTest(TestCase):
+    def test_fast_paths_match_drf(self):
+        """Test that the row serializers and orjson renderer produce the same bytes as DRF"""
+        results = serializer_benchmark(count=50, repeat=1)
+
+        self.assertTrue(all(case["identical"] for case in results.values()), results)
+
+    def test_current_timezone_is_respected(self):
+        """Test that datetimes are rendered in the active timezone, as DRF does"""
+        payment = Payment.objects.create(customer_name="Zone", customer_email="zone@example.com", amount=Decimal("7.5"))
+        payment.refresh_from_db()
+
+        with timezone.override('America/New_York'):
+            expected = PaymentSerializer(payment).data
+            row = Payment.objects.values(*fast_payment_serializer.fields).get(pk=payment.pk)
+            self.assertEqual(fast_payment_serializer.many([row]), [expected])
+        self.assertEqual(expected["amount"], "7.50")
+
+    def test_invalid_json_is_rejected(self):
+        """Test that the orjson parser answers malformed JSON with a 400"""
+        response = APIClient().post(reverse('initiate-payment'), '{"amount": ', content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("JSON parse error", response.json()["detail"])
+
+
+class PaymentStatusStreamTest(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.payment = Payment.objects.create(
+            customer_name="Streamer", customer_email="stream@example.com", amount=20, status="processing"
+        )
+
+    def test_status_change_is_published_on_commit(self):
+        """Test that saving a new status notifies clients waiting on the payment"""
+        with broker.subscribe(self.payment.id) as subscription:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.payment.status = "completed"
+                self.payment.save()
+
+            self.assertEqual(async_to_sync(subscription.get)(1), "completed")
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    async def test_stream_sends_changes_until_terminal(self):
+        """Test that the SSE stream sends the current status, then each change, then ends"""
+        request = self.factory.get(f'/api/v1/payments/{self.payment.id}/events/', HTTP_ACCEPT='text/event-stream')
+        response = await async_views.PaymentStatusStreamView.as_view()(request, id=self.payment.id)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        self.assertTrue((await anext(events)).startswith(b'retry:'))
+        self.assertIn(b'"status":"processing"', await anext(events))
+
+        await Payment.objects.filter(pk=self.payment.pk).aupdate(status="completed")
+        broker.publish(self.payment.id, "completed")
+
+        self.assertIn(b'"status":"completed"', await anext(events))
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+
+    async def test_long_poll(self):
+        """Test that /wait/ answers at once for a stale status and times out on the current one"""
+        view = async_views.PaymentStatusWaitView.as_view()
+
+        response = await view(self.factory.get('/wait/', {"status": "pending"}), id=self.payment.id)
+        self.assertTrue(response.data["changed"])
+        self.assertEqual(response.data["payment"]["status"], "processing")
+
+        response = await view(self.factory.get('/wait/', {"status": "processing", "timeout": "0.05"}), id=self.payment.id)
+        self.assertFalse(response.data["changed"])
+
+        response = await view(self.factory.get('/wait/'), id=uuid.uuid4())
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_wsgi_serves_long_poll_but_not_stream(self):
+        """Test that under WSGI the buffered SSE stream is not routed while /wait/ still answers"""
+        client = Client()
+
+        response = client.get(f'/api/v1/payments/{self.payment.id}/events/', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = client.get(f'/api/v1/payments/{self.payment.id}/wait/', {"status": "pending"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()["changed"])
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="completed"
+        )
+        self.url = reverse('payment-detail', args=[self.payment.id])
+
+    def test_detail_not_modified(self):
+        """Test that a matching If-None-Match gets an empty 304 and a save changes the ETag"""
+        etag = self.client.get(self.url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        # Without a cached entry only updated_at is read
+        cache.clear()
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"stale", W/{etag}')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.payment.status = "refunded"
+        self.payment.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_page_not_modified(self):
+        """Test that an unchanged list page is answered with a 304 until a payment on it changes"""
+        url = reverse('payment-list')
+        etag = self.client.get(url)['ETag']
+
+        with mock.patch('payments.views.fast_payment_serializer.many') as many:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        many.assert_not_called()
+
+        self.payment.status = "refunded"
+        self.payment.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['payments'][0]['status'], 'refunded')
+
+    def test_list_page_changes_when_next_page_appears(self):
+        """Test that a full page whose rows are unchanged is not a 304 once another page follows it"""
+        url = reverse('payment-list')
+        first = self.client.get(url, {"page_size": 1})
+        self.assertIsNone(first.data['next'])
+
+        older = Payment.objects.create(customer_name="Older User", customer_email="older@example.com", amount=5, currency="USD")
+        Payment.objects.filter(pk=older.pk).update(created_at=self.payment.created_at - timedelta(minutes=1))
+        response = self.client.get(url, {"page_size": 1}, HTTP_IF_NONE_MATCH=first['ETag'])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['next'])
+        # Same rows and cursor, but a different query: its next link differs
+        self.assertNotEqual(self.client.get(url, {"page_size": 1, "currency": "USD"})['ETag'], response['ETag'])
+
+    async def test_async_detail_not_modified(self):
+        """Test that the async detail view honours If-None-Match too"""
+        factory = AsyncRequestFactory()
+        view = async_views.PaymentDetailView.as_view()
+        response = await view(factory.get(self.url), id=self.payment.id)
+        etag = response['ETag']
+
+        request = factory.get(self.url, headers={'If-None-Match': etag})
+        response = await view(request, id=self.payment.id)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class PaymentTransitionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment.objects.create(
+            customer_name="Test User",
+            customer_email="test@example.com",
+            amount=100.00,
+            currency="USD",
+            status="processing",
+            gateway_order_id="ORDER123",
+            gateway_status="APPROVED"
+        )
+
+    def test_transition_writes_only_named_fields(self):
+        """Test that a transition is one conditional UPDATE of status, updated_at and the given fields"""
+        self.payment.customer_name = "Not Saved"
+        self.payment.gateway_status = "COMPLETED"
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.payment.transition("completed", ['gateway_status']))
+
+        update = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "payments_payment"')]
+        self.assertEqual(len(update), 1)
+        self.assertIn('"status" = ', update[0].split('WHERE')[1])
+        self.assertNotIn('customer_name', update[0])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.customer_name, "Test User")
+        self.assertEqual(self.payment.gateway_status, "COMPLETED")
+        self.assertEqual(OutboxEvent.objects.get().payload["previous_status"], "processing")
+
+    def test_stale_instance_cannot_undo_a_transition(self):
+        """Test that a transition made from an outdated copy neither overwrites nor announces anything"""
+        stale = Payment.objects.get(pk=self.payment.pk)
+        self.assertTrue(self.payment.transition("completed"))
+
+        self.assertFalse(stale.transition("failed"))
+        self.assertEqual(stale.status, "completed")
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).status, "completed")
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+        # A status change made elsewhere is picked up when the move is still allowed
+        other = Payment.objects.create(
+            customer_name="Test User", customer_email="test@example.com", amount=5, status="pending"
+        )
+        stale = Payment.objects.get(pk=other.pk)
+        other.transition("processing")
+        self.assertTrue(stale.transition("completed"))
+        self.assertEqual(OutboxEvent.objects.filter(payment=other).last().payload["previous_status"], "processing")
+
+    def test_cancel_after_capture_conflicts(self):
+        """Test that cancelling a captured payment is refused"""
+        self.payment.transition("completed")
+
+        response = APIClient().get(reverse('paypal-cancel'), {"token": "ORDER123"})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).status, "completed")
+
+
+class GatewayPayloadMigrationTest(TransactionTestCase):
+    """Data migrations over gateway_response, run against the schema they were written for"""
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate_to(self, name):
+        self.executor.migrate([('payments', name)])
+        self.executor.loader.build_graph()
+        return self.executor.loader.project_state(('payments', name)).apps
+
+    def create_legacy(self, state_apps, gateway_response, **fields):
+        return state_apps.get_model('payments', 'Payment').objects.create(
+            customer_name="Legacy User",
+            customer_email="legacy@example.com",
+            amount=5,
+            gateway_response=gateway_response,
+            **fields
+        )
+
+    def test_backfill_extracts_order_id(self):
+        """Test the data migration copying order ids out of gateway_response"""
+        old_apps = self.migrate_to('0006_backfill_gateway_order_id')
+        legacy = self.create_legacy(old_apps, {"id": "LEGACY1", "status": "CREATED"})
+        duplicate = self.create_legacy(old_apps, {"id": "LEGACY1", "status": "CREATED"})
+
+        migration = import_module('payments.migrations.0006_backfill_gateway_order_id')
+        migration.backfill_gateway_order_id(old_apps, None)
+
+        Payment = old_apps.get_model('payments', 'Payment')
+        order_ids = set(Payment.objects.filter(id__in=[legacy.id, duplicate.id]).values_list('gateway_order_id', flat=True))
+        self.assertEqual(order_ids, {"LEGACY1", None})
+
+    def test_gateway_response_moved_to_events(self):
+        """Test that stored payloads become compressed gateway events and the extracted fields are filled"""
+        old_apps = self.migrate_to('0011_paymentgatewayevent')
+        response = {
+            "id": "LEGACY2",
+            "status": "APPROVED",
+            "links": [{"rel": "approve", "href": "https://approval-url.com"}],
+        }
+        legacy = self.create_legacy(old_apps, response, gateway_order_id="LEGACY2")
+        self.create_legacy(old_apps, None)
+
+        # Through to the latest schema, which the Payment model below is written for
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.executor.loader.graph.leaf_nodes())
+
+        payment = Payment.objects.get(pk=legacy.pk)
+        self.assertEqual(payment.gateway_status, "APPROVED")
+        self.assertEqual(payment.approval_url, "https://approval-url.com")
+        event = payment.gateway_events.get()
+        self.assertEqual((event.kind, event.provider_status, event.compressed), ("legacy", "APPROVED", True))
+        self.assertEqual(event.payload, response)
+        self.assertEqual(PaymentGatewayEvent.objects.count(), 1)
+
+    def test_gateway_response_move_can_resume(self):
+        """Test that rerunning an interrupted move skips the payments already copied"""
+        old_apps = self.migrate_to('0011_paymentgatewayevent')
+        self.create_legacy(old_apps, {"id": "LEGACY3", "status": "CREATED"})
+        self.create_legacy(old_apps, {"id": "LEGACY4", "status": "CREATED"})
+
+        migration = import_module('payments.migrations.0012_move_gateway_response')
+        with mock.patch.object(migration, 'BATCH_SIZE', 1), \
+                mock.patch.object(old_apps.get_model('payments', 'Payment').objects, 'bulk_update', side_effect=[None, RuntimeError]):
+            with self.assertRaises(RuntimeError):
+                migration.move_gateway_response(old_apps, None)
+        migration.move_gateway_response(old_apps, None)
+
+        Event = old_apps.get_model('payments', 'PaymentGatewayEvent')
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(Event.objects.values('payment_id').distinct().count(), 2)
+
+
+class PaymentStatsTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.payments = [
+            Payment.objects.create(
+                customer_name="Test User",
+                customer_email="test@example.com",
+                amount=amount,
+                currency=currency,
+                status="pending"
+            )
+            for amount, currency in ((Decimal("10.00"), "USD"), (Decimal("25.50"), "USD"), (Decimal("7.00"), "EUR"))
+        ]
+
+    def rollup(self):
+        return {
+            (row.currency, row.status): (row.count, row.amount)
+            for row in PaymentStatsHour.objects.all() if row.count
+        }
+
+    def test_rollup_follows_every_write_path(self):
+        """Test that creation, transitions, bulk updates and deletes keep the hourly rollup current"""
+        self.payments[0].transition("processing")
+        self.payments[0].transition("completed")
+        self.payments[1].status = "failed"
+        self.payments[1].save()
+        previous = [self.payments[2].status]
+        self.payments[2].status = "processing"
+        bulk_update_payments([self.payments[2]], ['status'], previous)
+        bulk_create_payments([
+            Payment(customer_name="Batch", customer_email="b@example.com", amount=amount, status="pending")
+            for amount in (Decimal("1.00"), Decimal("2.00"))
+        ])
+        self.payments[1].delete()
+        self.assertEqual(bulk_delete_payments(Payment.objects.filter(amount=Decimal("2.00"))), 1)
+
+        self.assertEqual(self.rollup(), {
+            ("USD", "completed"): (1, Decimal("10.00")),
+            ("EUR", "processing"): (1, Decimal("7.00")),
+            ("USD", "pending"): (1, Decimal("1.00")),
+        })
+        expected = self.rollup()
+
+        call_command('rebuild_payment_stats', stdout=io.StringIO())
+        self.assertEqual(self.rollup(), expected)
+
+    def test_stats_endpoint(self):
+        """Test totals per interval and the query filters"""
+        self.payments[0].transition("processing")
+        url = reverse('payment-stats')
+
+        response = self.client.get(url, {"interval": "total", "currency": "usd"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row["status"], row["count"], row["amount"]) for row in response.data["stats"]],
+            [("pending", 1, Decimal("25.50")), ("processing", 1, Decimal("10.00"))]
+        )
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {"interval": "hour", "status": "pending", "since": (timezone.now() - timedelta(hours=2)).isoformat()})
+        self.assertEqual(sum(row["count"] for row in response.data["stats"]), 2)
+        self.assertIn("period", response.data["stats"][0])
+
+        response = self.client.get(url, {"interval": "week"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from payments.metrics import TOKEN_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# The refresh margin never exceeds this share of a token's lifetime, so short-lived tokens are still reused
+MAX_REFRESH_MARGIN_FRACTION = 0.5
+
+
+class LocalTokenBackend:
+    """Keeps the access token in process memory"""
+
+    def __init__(self, key):
+        self.key = key
+        self._entry = None
+
+    def get(self):
+        return self._entry
+
+    def set(self, entry, timeout):
+        self._entry = entry
+
+    def delete(self):
+        self._entry = None
+
+    def acquire_refresh_lock(self, timeout):
+        # The in-process lock in TokenCache already serializes refreshes
+        return True
+
+    def release_refresh_lock(self):
+        pass
+
+
+class DjangoCacheTokenBackend:
+    """Shares the access token between worker processes through Django's cache framework"""
+
+    def __init__(self, key, alias=None):
+        self.key = key
+        self.lock_key = f"{key}:refresh-lock"
+        self.cache = caches[alias or getattr(settings, 'PAYPAL_TOKEN_CACHE_ALIAS', 'default')]
+
+    def get(self):
+        return self.cache.get(self.key)
+
+    def set(self, entry, timeout):
+        self.cache.set(self.key, entry, timeout)
+
+    def delete(self):
+        self.cache.delete(self.key)
+
+    def acquire_refresh_lock(self, timeout):
+        # cache.add is atomic on shared backends, so only one process wins the refresh
+        return self.cache.add(self.lock_key, 1, timeout)
+
+    def release_refresh_lock(self):
+        self.cache.delete(self.lock_key)
+
+
+TOKEN_BACKENDS = {
+    'local': LocalTokenBackend,
+    'django': DjangoCacheTokenBackend,
+}
+
+
+class TokenCache:
+    """
+    Caches a PayPal OAuth token until shortly before it expires.
+
+    Only one caller refreshes at a time. While a refresh is running, other
+    callers keep using the current token if it is still valid, otherwise they
+    wait for the refresh to finish.
+    """
+
+    def __init__(self, backend, refresh_margin=60, lock_timeout=10):
+        self.backend = backend
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _hit(self):
+        self.hits += 1
+        TOKEN_CACHE_REQUESTS.labels('hit').inc()
+
+    def _is_valid(self, entry):
+        return bool(entry) and time.time() < entry["expires_at"]
+
+    def _is_fresh(self, entry):
+        if not entry:
+            return False
+        return time.time() < entry.get("refresh_at", entry["expires_at"] - self.refresh_margin)
+
+    def get_token(self, fetch):
+        """
+        Return a cached token, calling fetch() to refresh it when needed.
+        fetch() must return a (token, expires_in) tuple.
+        """
+        entry = self.backend.get()
+        if self._is_fresh(entry):
+            self._hit()
+            return entry["access_token"]
+
+        usable = self._is_valid(entry)
+        if not self._lock.acquire(blocking=not usable):
+            # Another thread is already refreshing and the current token still works
+            self._hit()
+            return entry["access_token"]
+
+        try:
+            entry = self.backend.get()
+            if self._is_fresh(entry):
+                self._hit()
+                return entry["access_token"]
+            return self._refresh(entry, fetch)
+        finally:
+            self._lock.release()
+
+    def _refresh(self, entry, fetch):
+        if not self.backend.acquire_refresh_lock(self.lock_timeout):
+            # Another worker process is refreshing the shared token
+            if self._is_valid(entry):
+                self._hit()
+                return entry["access_token"]
+            entry = self._wait_for_refresh()
+            if entry:
+                self._hit()
+                return entry["access_token"]
+            # The other process did not finish in time, refresh ourselves
+            return self._store(fetch)
+
+        try:
+            return self._store(fetch)
+        finally:
+            self.backend.release_refresh_lock()
+
+    def _store(self, fetch):
+        token, expires_in = fetch()
+        return self.store(token, expires_in)
+
+    def cached_token(self):
+        """Return the cached token if it does not need a refresh yet, otherwise None"""
+        entry = self.backend.get()
+        if self._is_fresh(entry):
+            self._hit()
+            return entry["access_token"]
+        return None
+
+    def store(self, token, expires_in):
+        """Cache a freshly fetched token"""
+        self.misses += 1
+        TOKEN_CACHE_REQUESTS.labels('miss').inc()
+        now = time.time()
+        margin = min(self.refresh_margin, expires_in * MAX_REFRESH_MARGIN_FRACTION)
+        entry = {"access_token": token, "expires_at": now + expires_in, "refresh_at": now + expires_in - margin}
+        self.backend.set(entry, expires_in)
+        return token
+
+    def _wait_for_refresh(self):
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = self.backend.get()
+            if self._is_fresh(entry):
+                return entry
+        return None
+
+    def invalidate(self):
+        """Drop the cached token, e.g. after PayPal rejected it"""
+        self.backend.delete()
+
+    def clear(self):
+        self.invalidate()
+        self.hits = 0
+        self.misses = 0
+
+
+_token_caches = {}
+_token_caches_lock = threading.Lock()
+
+
+def get_token_cache(base_url, client_id):
+    """Return the process-wide token cache for a PayPal account"""
+    cache_key = (base_url, client_id)
+    token_cache = _token_caches.get(cache_key)
+    if token_cache is not None:
+        return token_cache
+
+    with _token_caches_lock:
+        token_cache = _token_caches.get(cache_key)
+        if token_cache is None:
+            backend_name = getattr(settings, 'PAYPAL_TOKEN_CACHE_BACKEND', 'local')
+            backend_class = TOKEN_BACKENDS.get(backend_name) or import_string(backend_name)
+            account = hashlib.sha256(f"{base_url}|{client_id}".encode()).hexdigest()[:16]
+            token_cache = TokenCache(
+                backend_class(f"paypal:access-token:{account}"),
+                refresh_margin=getattr(settings, 'PAYPAL_TOKEN_REFRESH_MARGIN', 60),
+            )
+            _token_caches[cache_key] = token_cache
+        return token_cache
+
+
+def clear_token_caches():
+    """Forget every cached token (used by tests)"""
+    with _token_caches_lock:
+        for token_cache in _token_caches.values():
+            token_cache.clear()
+        _token_caches.clear()
@@ -1,15 +1,36 @@
+from django.conf import settings
 from django.urls import path
-from .views import InitiatePaymentView, PaymentDetailView, PayPalSuccessView, PayPalCancelView, PaymentListView, DocumentationView
+from .views import InitiatePaymentView, BatchInitiatePaymentView, PaymentDetailView, PayPalSuccessView, PayPalCancelView, PayPalWebhookView, PaymentListView, PaymentExportView, PaymentStatsView, ProfilingView, DocumentationView
+
+if settings.PAYMENTS_ASYNC_VIEWS:
+    # Under ASGI the PayPal-bound endpoints await upstream calls instead of blocking a worker
+    from .async_views import InitiatePaymentView, PaymentDetailView, PayPalSuccessView, PayPalCancelView
+# Always async: it holds the connection open while waiting for a status change
+from .async_views import PaymentStatusWaitView
 
 urlpatterns = [
     path('', DocumentationView.as_view(), name='default-page'),
     path('v1/payments/', InitiatePaymentView.as_view(), name='initiate-payment'),
+    path('v1/payments/batch/', BatchInitiatePaymentView.as_view(), name='batch-initiate-payment'),
     path('v1/payments/all/', PaymentListView.as_view(), name='payment-list'),  
+    path('v1/payments/export/', PaymentExportView.as_view(), name='payment-export'),
+    path('v1/payments/stats/', PaymentStatsView.as_view(), name='payment-stats'),
     path('v1/payments/<uuid:id>/', PaymentDetailView.as_view(), name='payment-detail'),
+    path('v1/payments/<uuid:id>/wait/', PaymentStatusWaitView.as_view(), name='payment-wait'),
     path('v1/payments/paypal/success/', PayPalSuccessView.as_view(), name='paypal-success'),
     path('v1/payments/paypal/cancel/', PayPalCancelView.as_view(), name='paypal-cancel'),
+    path('v1/payments/paypal/webhook/', PayPalWebhookView.as_view(), name='paypal-webhook'),
 ]
 
+if settings.PAYMENTS_ASYNC_VIEWS:
+    # WSGI buffers an async streaming response to the end before sending any of it, so the
+    # SSE stream is only served under ASGI
+    from .async_views import PaymentStatusStreamView
+    urlpatterns.append(path('v1/payments/<uuid:id>/events/', PaymentStatusStreamView.as_view(), name='payment-events'))
+
+if settings.PAYMENT_PROFILING:
+    urlpatterns.append(path('v1/payments/profile/', ProfilingView.as_view(), name='payment-profile'))
+
 '''
 
 urlpatterns = [
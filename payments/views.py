@@ -1,11 +1,28 @@
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import Http404
-from .models import Payment
-from .serializers import PaymentSerializer, PaymentCreateSerializer, PaymentResponseSerializer
-from .services import PayPalService
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
+from rest_framework.negotiation import BaseContentNegotiation
+from .models import Payment, bulk_create_payments
+from .serializers import (
+    PaymentCreateSerializer,
+    PaymentResponseSerializer,
+    fast_payment_response_serializer,
+    fast_payment_serializer,
+)
+from .services import get_paypal_service
+from .pagination import paginate_payments, parse_datetime_param, parse_uuid_param
+from .idempotency import IDEMPOTENCY_HEADER, run_idempotent
+from .cache import TERMINAL_STATUSES, cache_payment, claim_verification, get_cached_payment
+from .etags import etag_matches, not_modified, page_etag, payment_etag
+from .export import EXPORT_FORMATS, aiter_export, iter_export
+from .paypal_webhooks import TRANSMISSION_HEADERS, record_event
+from .profiling import histogram, span
+from .stats import payment_stats
+from .resilience import PayPalUnavailable, retry_after_header
 import logging
 from uuid import uuid4
 from django.db import IntegrityError
@@ -13,7 +30,7 @@ from django.db import IntegrityError
 from django.conf import settings
 from payments.mocks.paypal_mock import mock_paypal_api
 
-if settings.DEBUG:
+if settings.DEBUG and settings.PAYPAL_MOCK_RESPONSES:
     import responses
     responses.start()
     mock_paypal_api()
@@ -32,6 +49,13 @@ class InitiatePaymentView(APIView):
     API endpoint for initiating a PayPal payment
     """
     def post(self, request, format=None):
+        # Retries carrying the same Idempotency-Key replay the first response
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            return run_idempotent(request, idempotency_key, self.initiate_payment)
+        return self.initiate_payment(request)
+
+    def initiate_payment(self, request):
         serializer = PaymentCreateSerializer(data=request.data)
         
         if serializer.is_valid():
@@ -40,25 +64,33 @@ class InitiatePaymentView(APIView):
                 payment = serializer.save(status='pending')
                 
                 # Process the payment with PayPal
-                paypal_service = PayPalService()
+                paypal_service = get_paypal_service()
                 processed_payment, approval_url = paypal_service.create_order(payment)
                 
                 # Prepare the response
-                response_serializer = PaymentResponseSerializer(processed_payment)
+                with span('serialize'):
+                    payment_data = PaymentResponseSerializer(processed_payment).data
                 
                 return Response({
-                    "payment": response_serializer.data,
+                    "payment": payment_data,
                     "redirect_url": approval_url,
                     "status": "success",
                     "message": "Payment initiated successfully. Redirect the customer to complete payment."
                 }, status=status.HTTP_201_CREATED)
             
+            except PayPalUnavailable as e:
+                logger.warning(f"Payment initiation refused, PayPal unavailable: {str(e)}")
+                return Response({
+                    "status": "error",
+                    "message": "PayPal is temporarily unavailable. Please try again shortly."
+                }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": retry_after_header(e)})
             except Exception as e:
                 logger.error(f"Payment initiation error: {str(e)}")
+                # A PayPal failure, not a bad request: 5xx keeps it out of the idempotency store
                 return Response({
                     "status": "error",
                     "message": f"Payment processing failed: {str(e)}"
-                }, status=status.HTTP_400_BAD_REQUEST)
+                }, status=status.HTTP_502_BAD_GATEWAY)
         
         return Response({
             "status": "error",
@@ -66,34 +98,143 @@ class InitiatePaymentView(APIView):
             "errors": serializer.errors
         }, status=status.HTTP_400_BAD_REQUEST)
 
+class BatchInitiatePaymentView(APIView):
+    """
+    API endpoint for initiating many PayPal payments in one request
+    """
+    def post(self, request, format=None):
+        # Retries carrying the same Idempotency-Key replay the first response
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            return run_idempotent(request, idempotency_key, self.initiate_payments)
+        return self.initiate_payments(request)
+
+    def initiate_payments(self, request):
+        items = request.data.get('payments') if isinstance(request.data, dict) else request.data
+        
+        if not isinstance(items, list) or not items:
+            return Response({
+                "status": "error",
+                "message": "Provide a non-empty list of payments."
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if len(items) > settings.PAYMENT_BATCH_MAX_SIZE:
+            return Response({
+                "status": "error",
+                "message": f"A batch can contain at most {settings.PAYMENT_BATCH_MAX_SIZE} payments."
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        serializer = PaymentCreateSerializer(data=items, many=True)
+        results = [None] * len(items)
+        valid = []
+        failures = []
+        
+        if serializer.is_valid():
+            valid = list(enumerate(serializer.validated_data))
+        else:
+            # Keep the valid items and report errors for the rest
+            for index, errors in enumerate(serializer.errors):
+                if errors:
+                    results[index] = {"index": index, "status": "error", "errors": errors}
+                else:
+                    valid.append((index, serializer.child.run_validation(items[index])))
+        
+        if valid:
+            try:
+                # One INSERT for the whole batch, then the PayPal orders in parallel
+                payments = bulk_create_payments(
+                    [Payment(status='pending', **data) for _, data in valid]
+                )
+                paypal_service = get_paypal_service()
+                outcomes = paypal_service.create_orders(payments)
+            except Exception as e:
+                logger.error(f"Batch payment initiation error: {str(e)}")
+                return Response({
+                    "status": "error",
+                    "message": f"Payment processing failed: {str(e)}"
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            
+            for (index, _), (payment, approval_url, error) in zip(valid, outcomes):
+                result = {"index": index, "payment": PaymentResponseSerializer(payment).data}
+                if error is None:
+                    result.update({"status": "success", "redirect_url": approval_url})
+                else:
+                    result.update({"status": "error", "message": f"Payment processing failed: {str(error)}"})
+                    failures.append(error)
+                results[index] = result
+        
+        succeeded = sum(1 for result in results if result["status"] == "success")
+        headers = None
+        if succeeded == len(results):
+            batch_status, http_status = "success", status.HTTP_201_CREATED
+        elif succeeded:
+            batch_status, http_status = "partial", status.HTTP_207_MULTI_STATUS
+        elif failures and all(isinstance(error, PayPalUnavailable) for error in failures):
+            # PayPal is down rather than refusing the orders; ask the client to come back when the longest wait is over
+            batch_status, http_status = "error", status.HTTP_503_SERVICE_UNAVAILABLE
+            headers = {"Retry-After": retry_after_header(max(failures, key=lambda error: error.retry_after or 0))}
+        elif any("payment" in result for result in results):
+            # Every order PayPal was asked for failed; let an Idempotency-Key retry run again
+            batch_status, http_status = "error", status.HTTP_502_BAD_GATEWAY
+        else:
+            batch_status, http_status = "error", status.HTTP_400_BAD_REQUEST
+        
+        return Response({
+            "results": results,
+            "status": batch_status,
+            "message": f"{succeeded} of {len(results)} payments initiated successfully."
+        }, status=http_status, headers=headers)
+
 class PaymentDetailView(APIView):
     """
     API endpoint for retrieving payment details
     """
     def get(self, request, id, format=None):
         try:
-            # Find the payment by ID
-            payment = get_object_or_404(Payment, id=id)
+            # Serve from the cache unless a pending payment is due for an upstream check
+            payment_data, etag = get_cached_payment(id)
+            verify_due = False
+            if payment_data is None or payment_data["status"] not in TERMINAL_STATUSES:
+                verify_due = claim_verification(id)
             
-            # If the payment is still processing, check its status
-            if payment.status in ['pending', 'processing']:
-                try:
-                    # Verify the payment status with PayPal
-                    paypal_service = PayPalService()
-                    payment = paypal_service.verify_payment(payment)
-                except Exception as e:
-                    logger.error(f"Payment verification error: {str(e)}")
-                    # If verification fails, just continue with the current payment status
-                    pass
+            if etag is None and not verify_due and request.headers.get('If-None-Match'):
+                # Revalidation on a cache miss: compare against updated_at before loading the whole row
+                updated_at = Payment.objects.filter(id=id).values_list('updated_at', flat=True).first()
+                if updated_at is None:
+                    raise Http404
+                current_etag = payment_etag(id, updated_at)
+                if etag_matches(request, current_etag):
+                    return not_modified(current_etag)
             
-            # Prepare the response
-            response_serializer = PaymentResponseSerializer(payment)
+            if payment_data is None or verify_due:
+                # Find the payment by ID
+                payment = get_object_or_404(Payment, id=id)
+                
+                # If the payment is still processing, check its status at most once per interval
+                if payment.status in ['pending', 'processing'] and verify_due:
+                    try:
+                        # Verify the payment status with PayPal
+                        paypal_service = get_paypal_service()
+                        payment = paypal_service.verify_payment(payment)
+                    except Exception as e:
+                        logger.error(f"Payment verification error: {str(e)}")
+                        # If verification fails, just continue with the current payment status
+                        pass
+                
+                # Prepare the response
+                with span('serialize'):
+                    payment_data = fast_payment_response_serializer.to_representation(payment)
+                etag = payment_etag(payment.id, payment.updated_at)
+                cache_payment(id, payment_data, etag)
+            
+            if etag_matches(request, etag):
+                return not_modified(etag)
             
             return Response({
-                "payment": response_serializer.data,
+                "payment": payment_data,
                 "status": "success",
                 "message": "Payment details retrieved successfully."
-            }, status=status.HTTP_200_OK)
+            }, status=status.HTTP_200_OK, headers={'ETag': etag})
             
         except Http404:
             return Response({
@@ -109,21 +250,37 @@ class PaymentDetailView(APIView):
 
 class PaymentListView(APIView):
     """
-    API endpoint for retrieving all payments
+    API endpoint for listing payments, newest first, one cursor page at a time
     """
     def get(self, request, format=None):
         try:
-            # Retrieve all payments
-            payments = Payment.objects.all()
+            # Retrieve one filtered page of payments, as plain rows
+            payments, paginator = paginate_payments(
+                request, Payment.objects.values(*fast_payment_serializer.fields, 'updated_at')
+            )
+            
+            # A client holding this exact page gets a 304 without it being serialized again
+            etag = page_etag(payments, paginator.next_cursor, request.query_params.urlencode())
+            if etag_matches(request, etag):
+                return not_modified(etag)
             
             # Serialize the payments
-            serializer = PaymentSerializer(payments, many=True)
+            with span('serialize'):
+                payments_data = fast_payment_serializer.many(payments)
             
             return Response({
-                "payments": serializer.data,
+                "payments": payments_data,
+                "next_cursor": paginator.next_cursor,
+                "next": paginator.get_next_link(),
                 "status": "success",
-                "message": "All payments retrieved successfully."
-            }, status=status.HTTP_200_OK)
+                "message": "Payments retrieved successfully."
+            }, status=status.HTTP_200_OK, headers={'ETag': etag})
+        except ValidationError as e:
+            return Response({
+                "status": "error",
+                "message": "Invalid query parameters",
+                "errors": e.detail
+            }, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error retrieving all payments: {str(e)}")
             return Response({
@@ -131,6 +288,86 @@ class PaymentListView(APIView):
                 "message": f"Error retrieving payments: {str(e)}"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class PaymentStatsView(APIView):
+    """
+    API endpoint for payment counts and totals per period, currency and status,
+    served from the hourly rollup
+    """
+    def get(self, request, format=None):
+        try:
+            return Response({
+                "stats": payment_stats(request.query_params),
+                "status": "success",
+                "message": "Payment statistics retrieved successfully."
+            }, status=status.HTTP_200_OK)
+        except ValidationError as e:
+            return Response({
+                "status": "error",
+                "message": "Invalid query parameters",
+                "errors": e.detail
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            logger.error(f"Error retrieving payment statistics: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": f"Error retrieving payment statistics: {str(e)}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Always render errors as JSON; the export picks its own content type"""
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+class PaymentExportView(APIView):
+    """
+    API endpoint for streaming every payment as NDJSON or CSV
+    """
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get(self, request, format=None):
+        export_format = request.query_params.get('output', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return Response({
+                "status": "error",
+                "message": f"output must be one of {', '.join(sorted(EXPORT_FORMATS))}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        since = request.query_params.get('since')
+        after = request.query_params.get('after')
+        try:
+            since = parse_datetime_param('since', since) if since else None
+            after = parse_uuid_param('after', after) if after else None
+        except ValidationError as e:
+            return Response({
+                "status": "error",
+                "message": "Invalid query parameters",
+                "errors": e.detail
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if isinstance(request._request, ASGIRequest):
+            # ASGI reads a sync iterator to the end before sending; fetch page by page instead
+            chunks = aiter_export(export_format, since=since, after=after)
+        else:
+            # Rows are read through a server-side cursor and written as they arrive
+            chunks = iter_export(export_format, since=since, after=after)
+        response = StreamingHttpResponse(chunks, content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="payments.{export_format}"'
+        return response
+
+class ProfilingView(APIView):
+    """
+    Recent per-view span percentiles recorded by ProfilingMiddleware
+    (only routed when PAYMENT_PROFILING is on)
+    """
+    def get(self, request, format=None):
+        return Response({
+            "views": histogram.snapshot(),
+            "status": "success"
+        }, status=status.HTTP_200_OK)
+
 class PayPalSuccessView(APIView):
     """
     Webhook endpoint for successful PayPal payments
@@ -145,17 +382,12 @@ class PayPalSuccessView(APIView):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            # Find the payment by ID
-            payment = get_object_or_404(Payment, id=order_id)
-            
-            # Capture the payment
-            paypal_service = PayPalService()
-            capture_result = paypal_service.capture_payment(payment)
+            # Find the payment by PayPal order ID
+            payment = get_object_or_404(Payment, gateway_order_id=order_id)
             
-            # Update payment status
-            payment.status = "completed"
-            payment.gateway_response = capture_result
-            payment.save()
+            # Capture the payment; this also marks it completed
+            paypal_service = get_paypal_service()
+            paypal_service.capture_payment(payment)
             
             return Response({
                 "status": "success",
@@ -168,6 +400,12 @@ class PayPalSuccessView(APIView):
                 "status": "error",
                 "message": "Payment not found."
             }, status=status.HTTP_404_NOT_FOUND)
+        except PayPalUnavailable as e:
+            logger.warning(f"Capture refused, PayPal unavailable: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": "PayPal is temporarily unavailable. Reload this page shortly to complete the payment."
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": retry_after_header(e)})
         except Exception as e:
             logger.error(f"PayPal success callback error: {str(e)}")
             return Response({
@@ -175,6 +413,39 @@ class PayPalSuccessView(APIView):
                 "message": f"Error completing payment: {str(e)}"
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class PayPalWebhookView(APIView):
+    """
+    Receiver for PayPal webhook events. Events are only stored here and
+    acknowledged; `manage.py process_webhook_events` verifies them and
+    applies them to payments.
+    """
+    def post(self, request, format=None):
+        event = request.data
+        
+        if not isinstance(event, dict) or not event.get("id") or not event.get("event_type"):
+            return Response({
+                "status": "error",
+                "message": "Invalid webhook event."
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if any(name not in request.headers for name in TRANSMISSION_HEADERS):
+            return Response({
+                "status": "error",
+                "message": "Missing PayPal transmission headers."
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            record_event(event, request.headers)
+        except Exception as e:
+            # PayPal redelivers events that were not acknowledged
+            logger.error(f"PayPal webhook receive error: {str(e)}")
+            return Response({
+                "status": "error",
+                "message": "Could not store webhook event."
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        return Response({"status": "success"}, status=status.HTTP_200_OK)
+
 class PayPalCancelView(APIView):
     """
     Webhook endpoint for cancelled PayPal payments
@@ -190,11 +461,15 @@ class PayPalCancelView(APIView):
         
         try:
             # Find the payment by PayPal order ID
-            payment = get_object_or_404(Payment, reference_id=order_id)
+            payment = get_object_or_404(Payment, gateway_order_id=order_id)
             
-            # Update payment status
-            payment.status = "failed"
-            payment.save()
+            # Update payment status, unless it was captured in the meantime
+            if not payment.transition("failed"):
+                return Response({
+                    "status": "error",
+                    "message": f"Payment is already {payment.status} and can no longer be cancelled.",
+                    "payment_id": str(payment.id)
+                }, status=status.HTTP_409_CONFLICT)
             
             # Return cancel page or redirect to frontend
             return Response({